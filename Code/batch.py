@@ -0,0 +1,95 @@
+# batch.py
+# Samuel Angarita
+# English: Batch runner - renders many input.json files concurrently, each in its own work directory
+# Español: Ejecutor por lotes - renderiza muchos archivos input.json en paralelo, cada uno en su propio directorio de trabajo
+
+import argparse
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from config import (workdir, JobContext, ENCODE_PROFILE, BATCH_MAX_JOBS, BATCH_MAX_API_CALLS, BATCH_MAX_ENCODES)
+from main import main as run_job
+from policy import CircuitBreaker
+
+# Default parent folder for per-job work directories
+# Carpeta padre por defecto para los directorios de trabajo de cada trabajo
+JOBS_ROOT = workdir / "jobs"
+
+
+# Picks a unique, readable job name from the input file path
+# Elige un nombre de trabajo único y legible a partir de la ruta del archivo de entrada
+def _job_name(path: Path, taken: set) -> str:
+    base = path.parent.name if path.name == "input.json" else path.stem
+    name, n = base or "job", 2
+    while name in taken:
+        name = f"{base}-{n}"
+        n += 1
+    taken.add(name)
+    return name
+
+# Creates the job work directory and places input.json inside it
+# Crea el directorio de trabajo del trabajo y coloca input.json dentro
+def _prepare_job(src: Path, name: str, jobs_root: Path, api_slots, encode_slots, breaker,
+                 profile: str) -> JobContext:
+    ctx = JobContext(jobs_root / name, name=name, api_slots=api_slots, encode_slots=encode_slots,
+                     breaker=breaker, profile=profile).ensure()
+    if src.resolve() != ctx.input_json.resolve():
+        shutil.copyfile(src, ctx.input_json)
+    return ctx
+
+
+# Renders every input file, running up to max_jobs pipelines at once
+# Renderiza cada archivo de entrada, ejecutando hasta max_jobs pipelines a la vez
+def run_batch(input_files: list, jobs_root: Path = JOBS_ROOT, max_jobs: int = BATCH_MAX_JOBS,
+              max_api_calls: int = BATCH_MAX_API_CALLS, max_encodes: int = BATCH_MAX_ENCODES,
+              profile: str = ENCODE_PROFILE) -> dict:
+    """
+    Each input.json gets its own JobContext under jobs_root/<name>.
+    max_api_calls caps Veo operations in flight across all jobs and
+    max_encodes caps CPU-heavy ffmpeg encodes across all jobs, so API-bound
+    and encode-bound stages of different jobs overlap without overload.
+    All jobs share one circuit breaker, so quota errors pause them together.
+    profile is the encode profile for jobs whose input.json doesn't set one.
+    Returns {job name: Final.mp4 path or the exception that stopped it}.
+    """
+    api_slots = threading.BoundedSemaphore(max_api_calls)
+    encode_slots = threading.BoundedSemaphore(max_encodes)
+    breaker = CircuitBreaker()
+    taken = set()
+    contexts = []
+    for f in input_files:
+        src = Path(f)
+        if not src.exists():
+            raise FileNotFoundError(f"Input file not found: {src}")
+        contexts.append(_prepare_job(src, _job_name(src, taken), Path(jobs_root), api_slots, encode_slots, breaker,
+                                     profile))
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_jobs)) as pool:
+        futures = {ctx.name: pool.submit(run_job, ctx) for ctx in contexts}
+        for name, fut in futures.items():
+            try:
+                results[name] = fut.result()
+                print(f"Job finished/ Trabajo terminado [{name}]: {results[name]}")
+            except (Exception, SystemExit) as e:
+                # Keep going: one broken job must not stop the others
+                # Continuar: un trabajo fallido no debe detener a los demás
+                results[name] = e
+                print(f"Job failed/ Trabajo falló [{name}]: {e}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render many input.json files concurrently")
+    parser.add_argument("inputs", nargs="+", help="input.json files (one video each)")
+    parser.add_argument("--out", default=str(JOBS_ROOT), help="parent folder for job work directories")
+    parser.add_argument("--jobs", type=int, default=BATCH_MAX_JOBS, help="pipelines running at once")
+    parser.add_argument("--api-calls", type=int, default=BATCH_MAX_API_CALLS, help="Veo operations in flight across jobs")
+    parser.add_argument("--encodes", type=int, default=BATCH_MAX_ENCODES, help="ffmpeg encodes running across jobs")
+    parser.add_argument("--profile", default=ENCODE_PROFILE, help="encode profile: draft, standard or archive")
+    args = parser.parse_args()
+    outcome = run_batch(args.inputs, Path(args.out), args.jobs, args.api_calls, args.encodes, args.profile)
+    failed = [name for name, res in outcome.items() if isinstance(res, BaseException)]
+    raise SystemExit(1 if failed else 0)
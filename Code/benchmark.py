@@ -0,0 +1,367 @@
+# benchmark.py
+# Samuel Angarita
+# English: Offline benchmarks - full pipeline jobs against the fake Veo backend, plus the combine.py concat steps
+# Español: Benchmarks sin conexión - trabajos completos contra el backend Veo falso, más los pasos de combine.py
+
+import argparse
+import functools
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from PIL import Image
+
+from config import workdir, JobContext, ENCODE_PROFILE, FAKE_VEO_LATENCY, FAKE_VEO_FAILURE_RATE, FAKE_VEO_CLIP_SECONDS
+from veo_backend import FakeVeoBackend
+from main import main as run_job
+from combine import can_stream_copy, prepare_clips, concat_clips, render_single_pass, combine_videos
+from probe import set_cache_file as set_probe_cache_file
+
+# Default parent folder for benchmark runs
+# Carpeta padre por defecto para las ejecuciones del benchmark
+BENCH_ROOT = workdir / "bench"
+BENCH_SIZES = (1, 10, 100)
+
+# Entry-point modules and the budget for importing one in a fresh interpreter (above bare Python startup)
+# Módulos de entrada y el presupuesto para importar uno en un intérprete nuevo (sobre el arranque de Python)
+STARTUP_MODULES = ("main", "combine", "batch", "service")
+STARTUP_BUDGET = 0.3
+
+# Synthetic clip variants for the combine benchmark: (width, height, fps, has audio)
+# Variantes de clips sintéticos para el benchmark de combinación: (ancho, alto, fps, tiene audio)
+COMBINE_VARIANTS = {
+    "720p30": (1280, 720, 30, True),
+    "1080p30": (1920, 1080, 30, True),
+    "720p24": (1280, 720, 24, True),
+    "720p30_silent": (1280, 720, 30, False),
+}
+# Signature matrix: each scenario cycles through its variants clip by clip
+# Matriz de firmas: cada escenario recorre sus variantes clip por clip
+COMBINE_SCENARIOS = {
+    "uniform": ("720p30",),
+    "mixed_size": ("720p30", "1080p30"),
+    "mixed_fps": ("720p30", "720p24"),
+    "no_audio": ("720p30", "720p30_silent"),
+    "mixed_all": ("720p30", "1080p30", "720p24", "720p30_silent"),
+}
+COMBINE_SIZES = (2, 8, 32)
+COMBINE_CLIP_SECONDS = 2.0
+# Timed steps, in the order they run for every case
+# Pasos medidos, en el orden en que se ejecutan para cada caso
+COMBINE_STEPS = ("check", "prepare", "concat", "single_pass", "combine")
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+# Creates distinct test images and a music track long enough for `count` clips
+# Crea imágenes de prueba distintas y una pista de música suficiente para `count` clips
+def _make_assets(root: Path, count: int, clip_seconds: float):
+    root.mkdir(parents=True, exist_ok=True)
+    for i in range(1, count + 1):
+        path = root / f"image{i}.jpg"
+        if not path.exists():
+            # Different colours so identical-input dedup doesn't collapse the run
+            # Colores distintos para que la deduplicación no colapse la ejecución
+            color = ((i * 53) % 256, (i * 97) % 256, (i * 191) % 256)
+            Image.new("RGB", (1600, 1200), color).save(path, format="JPEG", quality=90)
+    music = root / f"music{count}.mp4"
+    if not music.exists():
+        seconds = count * clip_seconds + 1
+        cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+               "-f", "lavfi", "-i", f"sine=frequency=220:sample_rate=48000:duration={seconds}",
+               "-c:a", "aac", "-ac", "2", str(music)]
+        subprocess.run(cmd, check=True, capture_output=True)
+    return music.name
+
+
+# Serves the asset folder over local HTTP so the download stage runs for real
+# Sirve la carpeta de assets por HTTP local para que la etapa de descarga se ejecute de verdad
+def _serve(root: Path):
+    handler = functools.partial(_QuietHandler, directory=str(root))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# Runs one pipeline job with `count` images and returns its stage timings
+# Ejecuta un trabajo del pipeline con `count` imágenes y devuelve sus tiempos por etapa
+def _run_one(count: int, base_url: str, music_name: str, root: Path, backend: FakeVeoBackend) -> dict:
+    job_dir = root / f"run{count}"
+    shutil.rmtree(job_dir, ignore_errors=True)
+    # Cold runs: no clip cache, and asset / music caches inside the (just emptied) run folder
+    # Ejecuciones en frío: sin caché de clips, y cachés de assets / música dentro de la carpeta (recién vaciada)
+    ctx = JobContext(job_dir, name=f"bench{count}", backend=backend, use_clip_cache=False,
+                     cache_root=job_dir / "cache").ensure()
+    spec = {
+        "music": {"enabled": True, "url": f"{base_url}/{music_name}"},
+        "images": [{"url": f"{base_url}/image{i}.jpg", "transition": ("zoom_in", "zoom_out", "pan")[i % 3],
+                    "engine": "veo"} for i in range(1, count + 1)],
+    }
+    ctx.input_json.write_text(json.dumps(spec, indent=2), encoding="utf-8")
+
+    submitted, failed = backend.submitted, backend.failed
+    start = time.perf_counter()
+    run_job(ctx)
+    total = time.perf_counter() - start
+
+    # Stage timings come from the job's run metrics (also saved as metrics.json)
+    # Los tiempos por etapa vienen de las métricas del trabajo (también en metrics.json)
+    report = ctx.metrics.to_dict()
+    veo = report["veo"].values()
+    return {"images": count, "total": round(total, 3),
+            "stages": {name: round(s["wall"], 3) for name, s in report["stages"].items()},
+            "cpu": {name: round(s["cpu"], 3) for name, s in report["stages"].items()},
+            "veo_queue": round(sum(v["queue"] for v in veo), 3),
+            "veo_generation": round(sum(v["generation"] for v in veo), 3),
+            "veo_calls": backend.submitted - submitted, "veo_failures": backend.failed - failed}
+
+
+# Runs the benchmark for every size and prints a per-stage table
+# Ejecuta el benchmark para cada tamaño e imprime una tabla por etapa
+def run_benchmark(sizes=BENCH_SIZES, latency: float = FAKE_VEO_LATENCY, failure_rate: float = FAKE_VEO_FAILURE_RATE,
+                  clip_seconds: float = FAKE_VEO_CLIP_SECONDS, root: Path = BENCH_ROOT, seed: int = 1) -> list:
+    """
+    Each size runs a fresh job (download -> generate -> render) with images
+    served from a local HTTP server and clips from FakeVeoBackend, so only
+    our own code and ffmpeg are measured. Returns one dict per size with
+    total seconds, seconds per stage, and fake Veo calls / failures.
+    """
+    root = Path(root)
+    assets = root / "assets"
+    backend = FakeVeoBackend(latency=latency, failure_rate=failure_rate, clip_seconds=clip_seconds, seed=seed)
+    music_name = _make_assets(assets, max(sizes), clip_seconds)
+    server, base_url = _serve(assets)
+    # Keep probes in memory so the shared probe store is neither read nor written
+    # Guardar los probes en memoria para no leer ni escribir el almacén compartido
+    probe_store = set_probe_cache_file(None)
+    try:
+        reports = [_run_one(n, base_url, music_name, root, backend) for n in sizes]
+    finally:
+        set_probe_cache_file(probe_store)
+        server.shutdown()
+        server.server_close()
+
+    names = []
+    for r in reports:
+        names += [n for n in r["stages"] if n not in names]
+    print("\n" + "images".rjust(8) + "".join(n.rjust(12) for n in names) + "total".rjust(12))
+    for r in reports:
+        row = "".join(f"{r['stages'].get(n, 0.0):12.2f}" for n in names)
+        print(f"{r['images']:8d}{row}{r['total']:12.2f}")
+    return reports
+
+
+# Times `import <module>` in fresh interpreters and checks it against STARTUP_BUDGET
+# Mide `import <module>` en intérpretes nuevos y lo compara con STARTUP_BUDGET
+def measure_startup(modules=STARTUP_MODULES, runs: int = 5, budget: float = STARTUP_BUDGET) -> list:
+    """
+    For each module: median wall time of `python -c "import module"` minus
+    the median of `python -c pass`, whether the import printed anything
+    (imports must be silent), and the slowest imports from -X importtime.
+    Returns one dict per module; "ok" is False when over budget or noisy.
+    """
+    code = Path(__file__).resolve().parent
+
+    def _median(source: str) -> tuple:
+        times, out = [], ""
+        for _ in range(runs):
+            start = time.perf_counter()
+            res = subprocess.run([sys.executable, "-c", source], cwd=code, capture_output=True, text=True, check=True)
+            times.append(time.perf_counter() - start)
+            out = res.stdout
+        return statistics.median(times), out
+
+    base, _ = _median("pass")
+    reports = []
+    for module in modules:
+        seconds, out = _median(f"import {module}")
+        # "import time: self [us] | cumulative | imported package" on stderr
+        # "import time: self [us] | cumulative | imported package" en stderr
+        res = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             cwd=code, capture_output=True, text=True, check=True)
+        slowest = []
+        for line in res.stderr.splitlines():
+            parts = line.split("|")
+            if len(parts) == 3 and parts[1].strip().isdigit():
+                slowest.append((int(parts[1]), parts[2].strip()))
+        slowest = [name for _, name in sorted(slowest, reverse=True) if not name.startswith(" ")][:5]
+        cost = max(0.0, seconds - base)
+        reports.append({"module": module, "seconds": round(cost, 4), "silent": not out.strip(),
+                        "slowest": slowest, "ok": cost <= budget and not out.strip()})
+
+    print(f"\nPython startup/ Arranque de Python: {base:.3f}s, budget/ presupuesto: {budget:.3f}s")
+    for r in reports:
+        flag = "ok" if r["ok"] else "OVER/ EXCEDIDO" if r["silent"] else "PRINTS/ IMPRIME"
+        print(f"{r['module']:>10} {r['seconds']:8.3f}s  {flag:<16} {', '.join(r['slowest'])}")
+    return reports
+
+
+# Renders (once) a testsrc / anullsrc clip for a variant of COMBINE_VARIANTS
+# Renderiza (una vez) un clip testsrc / anullsrc para una variante de COMBINE_VARIANTS
+def _synthetic_clip(root: Path, variant: str, seconds: float) -> Path:
+    width, height, fps, audio = COMBINE_VARIANTS[variant]
+    path = root / f"{variant}_{seconds:g}s.mp4"
+    if path.exists():
+        return path
+    root.mkdir(parents=True, exist_ok=True)
+    sound = ["-f", "lavfi", "-i", "anullsrc=r=48000:cl=stereo", "-c:a", "aac", "-ac", "2"] if audio else []
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+           "-f", "lavfi", "-i", f"testsrc=size={width}x{height}:rate={fps}", *sound, "-t", f"{seconds:g}",
+           "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", str(path)]
+    subprocess.run(cmd, check=True, capture_output=True)
+    return path
+
+# Fresh job folder holding its own copies of the clips as AIvideo1.mp4 ... and its own caches (so every probe is cold)
+# Carpeta de trabajo nueva con sus propias copias de los clips como AIvideo1.mp4 ... y sus propias cachés (cada probe es en frío)
+def _combine_job(job_dir: Path, sources: list[Path], profile: str) -> JobContext:
+    shutil.rmtree(job_dir, ignore_errors=True)
+    ctx = JobContext(job_dir, name=job_dir.name, profile=profile, cache_root=job_dir / "cache").ensure()
+    for i, src in enumerate(sources, start=1):
+        shutil.copyfile(src, ctx.clip(i))
+    return ctx
+
+# Total size of the files under path (files may vanish while ffmpeg works)
+# Tamaño total de los archivos bajo path (pueden desaparecer mientras ffmpeg trabaja)
+def _dir_bytes(path: Path) -> int:
+    total = 0
+    for folder, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.stat(os.path.join(folder, name)).st_size
+            except OSError:
+                pass
+    return total
+
+# Runs fn while sampling the job folder, returning wall time, throughput and peak extra disk
+# Ejecuta fn mientras muestrea la carpeta del trabajo y devuelve tiempo, rendimiento y disco extra pico
+def _measure(path: Path, media_seconds: float, fn) -> dict:
+    """
+    speed is media seconds processed per wall second (1.0 = realtime);
+    peak_mb is the largest growth of the folder over its size at the start.
+    A step that raises RuntimeError (an ffmpeg failure) is reported with ok False.
+    """
+    base = _dir_bytes(path)
+    peak, done = [base], threading.Event()
+
+    def _sample():
+        while not done.wait(0.05):
+            peak[0] = max(peak[0], _dir_bytes(path))
+
+    sampler = threading.Thread(target=_sample, daemon=True)
+    sampler.start()
+    ok, start = True, time.perf_counter()
+    try:
+        fn()
+    except RuntimeError:
+        ok = False
+    finally:
+        seconds = time.perf_counter() - start
+        done.set()
+        sampler.join()
+    peak[0] = max(peak[0], _dir_bytes(path))
+    return {"seconds": round(seconds, 3), "speed": round(media_seconds / seconds, 2) if seconds else 0.0,
+            "peak_mb": round((peak[0] - base) / (1024 * 1024), 2), "ok": ok}
+
+# Times every concat strategy for one scenario and clip count
+# Mide cada estrategia de concatenación para un escenario y una cantidad de clips
+def _run_combine_case(scenario: str, count: int, clip_seconds: float, root: Path, profile: str) -> dict:
+    variants = COMBINE_SCENARIOS[scenario]
+    sources = [_synthetic_clip(root / "assets", variants[i % len(variants)], clip_seconds) for i in range(count)]
+    media = count * clip_seconds
+    case = {"scenario": scenario, "clips": count, "media_seconds": media}
+
+    # The public steps one by one on the same clips: pre-flight, prepare (conform / normalize), concat
+    # Los pasos públicos uno a uno sobre los mismos clips: pre-vuelo, preparar (conformar / normalizar), concatenar
+    ctx = _combine_job(root / f"{scenario}{count}" / "steps", sources, profile)
+    files = [ctx.clip(i) for i in range(1, count + 1)]
+    copyable, prepared = [], []
+    case["check"] = _measure(ctx.workdir, media, lambda: copyable.append(can_stream_copy(files)))
+    case["stream_copy"] = copyable[0]
+    case["prepare"] = _measure(ctx.workdir, media, lambda: prepared.extend(prepare_clips(files, ctx)))
+    case["concat"] = _measure(ctx.workdir, media, lambda: concat_clips(*prepared, ctx))
+
+    # Each entry point on fresh copies: the single-pass render (clip audio) and combine_videos
+    # Cada punto de entrada sobre copias nuevas: el renderizado de una pasada (audio de clips) y combine_videos
+    ctx = _combine_job(root / f"{scenario}{count}" / "single_pass", sources, profile)
+    case["single_pass"] = _measure(ctx.workdir, media, lambda: render_single_pass(music=False, ctx=ctx))
+    ctx = _combine_job(root / f"{scenario}{count}" / "combine", sources, profile)
+    case["combine"] = _measure(ctx.workdir, media, lambda: combine_videos(ctx))
+    return case
+
+# Runs the combine benchmark over the signature matrix and prints a table (and deltas to a baseline)
+# Ejecuta el benchmark de combinación sobre la matriz de firmas e imprime una tabla (y diferencias con una base)
+def run_combine_benchmark(sizes=COMBINE_SIZES, scenarios=tuple(COMBINE_SCENARIOS),
+                          clip_seconds: float = COMBINE_CLIP_SECONDS, root: Path = BENCH_ROOT / "combine",
+                          profile: str = ENCODE_PROFILE, baseline: dict = None) -> dict:
+    """
+    Synthetic clips (lavfi testsrc + anullsrc, no network, no Veo) for every
+    scenario x clip count. Each case times can_stream_copy, prepare_clips,
+    concat_clips over what it returned, a render_single_pass without music
+    and a full combine_videos call, with throughput and peak disk for each. Returns {"ffmpeg", "profile", "clip_seconds",
+    "cases"}; pass a previous result as baseline to print time ratios.
+    """
+    root = Path(root)
+    version = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True, check=True).stdout
+    probe_store = set_probe_cache_file(None)
+    try:
+        cases = [_run_combine_case(name, n, clip_seconds, root, profile) for name in scenarios for n in sizes]
+    finally:
+        set_probe_cache_file(probe_store)
+    result = {"ffmpeg": version.splitlines()[0] if version else "", "profile": profile,
+              "clip_seconds": clip_seconds, "cases": cases}
+
+    old = {(c["scenario"], c["clips"]): c for c in (baseline or {}).get("cases", [])}
+    print(f"\n{result['ffmpeg']} | profile/ perfil: {profile} | seconds per step/ segundos por paso")
+    print("scenario".ljust(14) + "clips".rjust(6) + "".join(s.rjust(12) for s in COMBINE_STEPS)
+          + "speed".rjust(8) + "peak MB".rjust(9))
+    for c in cases:
+        cells = "".join((f"{c[s]['seconds']:12.2f}" if c[s]["ok"] else "failed".rjust(12)) for s in COMBINE_STEPS)
+        print(f"{c['scenario']:<14}{c['clips']:6d}{cells}{c['combine']['speed']:8.2f}{c['combine']['peak_mb']:9.1f}")
+        before = old.get((c["scenario"], c["clips"]))
+        if before is not None:
+            ratios = "".join((f"x{c[s]['seconds'] / before[s]['seconds']:.2f}".rjust(12)
+                              if before.get(s, {}).get("seconds") else "-".rjust(12)) for s in COMBINE_STEPS)
+            print(f"{'  vs baseline':<14}{'':6}{ratios}")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the full pipeline against the local fake Veo backend")
+    parser.add_argument("--sizes", type=int, nargs="+", help="images per job (clips per case with --combine)")
+    parser.add_argument("--latency", type=float, default=FAKE_VEO_LATENCY, help="seconds per fake generation")
+    parser.add_argument("--failure-rate", type=float, default=FAKE_VEO_FAILURE_RATE, help="0..1 transient failures")
+    parser.add_argument("--clip-seconds", type=float, help="length of each fake / synthetic clip")
+    parser.add_argument("--out", default=str(BENCH_ROOT), help="folder for benchmark jobs")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    parser.add_argument("--startup", action="store_true", help="only measure import time of the entry points")
+    parser.add_argument("--combine", action="store_true", help="only time the combine.py concat steps")
+    parser.add_argument("--scenarios", nargs="+", choices=list(COMBINE_SCENARIOS), default=list(COMBINE_SCENARIOS),
+                        help="signature scenarios for --combine")
+    parser.add_argument("--profile", default=ENCODE_PROFILE, help="encode profile for --combine re-encodes")
+    parser.add_argument("--baseline", help="earlier --combine --json file to compare against")
+    args = parser.parse_args()
+    if args.startup:
+        results = measure_startup()
+        if args.json:
+            Path(args.json).write_text(json.dumps(results, indent=2), encoding="utf-8")
+        raise SystemExit(0 if all(r["ok"] for r in results) else 1)
+    if args.combine:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8")) if args.baseline else None
+        results = run_combine_benchmark(args.sizes or COMBINE_SIZES, args.scenarios,
+                                        args.clip_seconds or COMBINE_CLIP_SECONDS, Path(args.out) / "combine",
+                                        args.profile, baseline)
+    else:
+        results = run_benchmark(args.sizes or BENCH_SIZES, args.latency, args.failure_rate,
+                                args.clip_seconds or FAKE_VEO_CLIP_SECONDS, Path(args.out))
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2), encoding="utf-8")
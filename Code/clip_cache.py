@@ -0,0 +1,224 @@
+# clip_cache.py
+# Samuel Angarita
+# English: Content-addressed on-disk caches for generated Veo clips, prepared music and downloaded assets, with size-bounded LRU eviction
+# Español: Cachés en disco direccionadas por contenido para clips Veo, música preparada y assets descargados, con expulsión LRU limitada por tamaño
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from config import (CLIP_CACHE_DIR, CLIP_CACHE_MAX_BYTES, MUSIC_CACHE_DIR, MUSIC_CACHE_MAX_BYTES,
+                    ASSET_CACHE_DIR, ASSET_CACHE_MAX_BYTES)
+
+# Bump when the key layout changes so old entries are ignored
+# Incrementar cuando cambie el formato de la clave para ignorar entradas viejas
+KEY_VERSION = "1"
+
+
+# Hashes a file in chunks so large images are never fully loaded in memory
+# Calcula el hash de un archivo por fragmentos para no cargar imágenes grandes en memoria
+def _file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Content address of a Veo clip: every input that affects it (usable without a cache on disk)
+# Dirección de contenido de un clip Veo: cada entrada que lo afecta (usable sin caché en disco)
+def clip_key(image_path, prompt: str, model: str, config: dict) -> str:
+    h = hashlib.sha256()
+    h.update(KEY_VERSION.encode())
+    h.update(_file_digest(Path(image_path)).encode())
+    h.update(b"\0" + prompt.encode("utf-8"))
+    h.update(b"\0" + model.encode("utf-8"))
+    h.update(b"\0" + json.dumps(config, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+# Places src at dst as a hardlink when possible, otherwise as a copy
+# Coloca src en dst como enlace duro cuando es posible, si no como copia
+def link_or_copy(src: Path, dst: Path):
+    # Remove dst first: writing into a hardlinked file would corrupt the cache entry
+    # Borrar dst primero: escribir en un archivo enlazado corrompería la entrada de caché
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ClipCache:
+    """
+    Stores finished clips under <root>/<key[:2]>/<key>.mp4.
+    The key is a SHA-256 over the image bytes, prompt, model and generation
+    config, so any change to those inputs produces a new entry. Entry mtime
+    is refreshed on every hit and the oldest entries are evicted once the
+    total size exceeds max_bytes.
+    """
+
+    # File extension of cache entries (subclasses store other media)
+    # Extensión de archivo de las entradas (las subclases guardan otros medios)
+    SUFFIX = ".mp4"
+
+    def __init__(self, root: Path = CLIP_CACHE_DIR, max_bytes: int = CLIP_CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+
+    def key_for(self, image_path, prompt: str, model: str, config: dict) -> str:
+        return clip_key(image_path, prompt, model, config)
+
+    def _entry(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}{self.SUFFIX}"
+
+    def get(self, key: str):
+        # Return the cached clip path (and mark it recently used) or None
+        # Devolver la ruta del clip en caché (y marcarlo como usado) o None
+        entry = self._entry(key)
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            return None  # never stored, or evicted by another job meanwhile
+        return entry
+
+    def put(self, key: str, src: Path) -> Path:
+        # Copy a freshly generated clip into the cache atomically
+        # Copiar un clip recién generado a la caché de forma atómica
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        # Unique temp name so concurrent jobs never share a partial file
+        # Nombre temporal único para que trabajos concurrentes no compartan un archivo parcial
+        tmp = entry.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, entry)
+        self.evict(keep=entry)
+        return entry
+
+    def materialize(self, key: str, dst: Path):
+        # Place a cached clip at dst without calling the API; None on miss
+        # Colocar un clip en caché en dst sin llamar a la API; None si no existe
+        entry = self.get(key)
+        if entry is None:
+            return None
+        link_or_copy(entry, dst)
+        return dst
+
+    def evict(self, keep: Path = None):
+        # Delete least recently used entries until the cache fits in max_bytes (never the entry just stored)
+        # Borrar las entradas menos usadas hasta que la caché quepa en max_bytes (nunca la recién guardada)
+        if not self.root.exists():
+            return
+        entries = []
+        total = 0
+        for p in self.root.glob(f"*/*{self.SUFFIX}"):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue  # evicted by another job meanwhile
+            entries.append((st.st_mtime, st.st_size, p))
+            total += st.st_size
+        entries.sort()
+        for _, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            p.unlink(missing_ok=True)
+            total -= size
+            print(f"Cache evicted/ Caché expulsó: {p.name}")
+
+
+class MusicCache(ClipCache):
+    """
+    Stores music tracks already transcoded to AAC and loudness-normalized,
+    keyed by the source track's content hash plus the processing settings,
+    so a track reused across many videos is processed only once.
+    """
+
+    def __init__(self, root: Path = MUSIC_CACHE_DIR, max_bytes: int = MUSIC_CACHE_MAX_BYTES):
+        super().__init__(root, max_bytes)
+
+    def track_key(self, music_path, settings: dict) -> str:
+        h = hashlib.sha256()
+        h.update(KEY_VERSION.encode())
+        h.update(_file_digest(Path(music_path)).encode())
+        h.update(b"\0" + json.dumps(settings, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+
+class AssetCache(ClipCache):
+    """
+    Downloaded files stored by the SHA-256 of their bytes (identical content
+    behind different URLs is kept once), plus a small record per URL with
+    the content hash and the ETag / Last-Modified validators the server sent,
+    so the next download can be a conditional request.
+    """
+
+    SUFFIX = ".blob"
+
+    def __init__(self, root: Path = ASSET_CACHE_DIR, max_bytes: int = ASSET_CACHE_MAX_BYTES):
+        super().__init__(root, max_bytes)
+
+    def _record(self, url: str) -> Path:
+        return self.root / "urls" / f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json"
+
+    def lookup(self, url: str):
+        # Return (record, cached file) for a URL, or (None, None) when unknown or evicted
+        # Devolver (registro, archivo en caché) para una URL, o (None, None) si es desconocida o fue expulsada
+        try:
+            record = json.loads(self._record(url).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None, None
+        entry = self.get(record.get("sha256", ""))
+        if entry is None:
+            self._record(url).unlink(missing_ok=True)
+            return None, None
+        return record, entry
+
+    def store(self, url: str, tmp: Path, sha256: str, etag=None, last_modified=None) -> Path:
+        # Move a fully downloaded temp file into place and remember its validators
+        # Mover un archivo temporal ya descargado a su lugar y recordar sus validadores
+        entry = self._entry(sha256)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, entry)
+        self.remember(url, sha256, etag, last_modified)
+        self.evict(keep=entry)
+        return entry
+
+    def remember(self, url: str, sha256: str, etag=None, last_modified=None):
+        record = self._record(url)
+        record.parent.mkdir(parents=True, exist_ok=True)
+        tmp = record.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps({"url": url, "sha256": sha256, "etag": etag,
+                                   "last_modified": last_modified}), encoding="utf-8")
+        os.replace(tmp, record)
+
+    def temp_path(self) -> Path:
+        # Download target inside the cache folder, so the final rename never crosses filesystems
+        # Destino de descarga dentro de la carpeta de caché, para que el renombrado nunca cruce sistemas de archivos
+        self.root.mkdir(parents=True, exist_ok=True)
+        return self.root / f".download.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+# Returns the configured cache (under cache_root when given), or None when caching is disabled (size 0)
+# Devuelve la caché configurada (bajo cache_root si se indica), o None cuando la caché está deshabilitada (tamaño 0)
+def default_clip_cache(cache_root: Path = None):
+    if CLIP_CACHE_MAX_BYTES <= 0:
+        return None
+    return ClipCache(Path(cache_root) / "clips") if cache_root is not None else ClipCache()
+
+# Same for the downloaded asset cache (ASSET_CACHE_MAX_MB=0 disables it)
+# Igual para la caché de assets descargados (ASSET_CACHE_MAX_MB=0 la deshabilita)
+def default_asset_cache(cache_root: Path = None):
+    if ASSET_CACHE_MAX_BYTES <= 0:
+        return None
+    return AssetCache(Path(cache_root) / "assets") if cache_root is not None else AssetCache()
+
+# Same for the music cache (MUSIC_CACHE_MAX_MB=0 disables it)
+# Igual para la caché de música (MUSIC_CACHE_MAX_MB=0 la deshabilita)
+def default_music_cache(cache_root: Path = None):
+    if MUSIC_CACHE_MAX_BYTES <= 0:
+        return None
+    return MusicCache(Path(cache_root) / "music") if cache_root is not None else MusicCache()
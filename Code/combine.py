@@ -7,41 +7,47 @@ import subprocess
 from pathlib import Path
 import shutil
 import re
+import threading
+from collections import Counter
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
 
 
-# Import centralized work directory from config module
-# Importar directorio de trabajo centralizado desde el módulo de configuración
-from config import workdir as WORKDIR
-# Ensure work directory exists before proceeding
-# Asegurar que el directorio de trabajo existe antes de continuar
-WORKDIR.mkdir(parents=True, exist_ok=True)
-
-# Default artifact paths/names
-# Rutas y nombres de artefactos por defecto
-MYLIST_TXT   = WORKDIR / "mylist.txt"
-MERGED_OUT   = WORKDIR / "merged.mp4"
-FINAL_OUT    = WORKDIR / "Final.mp4"
-MUSIC_IN     = WORKDIR / "downloaded_music.mp4"  # matches read.download_song()
-
-# Normalization settings & outputs
-# Configuraciones de normalización y salidas
-TARGET_W     = 1920
-TARGET_H     = 1080
-TARGET_FPS   = 30
+# Import shared settings from config module (work directories come from the JobContext)
+# Importar configuración compartida desde el módulo config (los directorios vienen del JobContext)
+from config import (CPU_COUNT, NORMALIZE_JOBS, SEGMENT_JOBS, MOTION_FALLBACK, MUSIC_LOUDNORM,
+                    CROSSFADE_TRANSITION, INTERMEDIATE_EXT, JobContext, default_context)
+from clip_cache import MusicCache, default_music_cache
+from probe import probe, keyframes
+from profiles import Rendition, bits_per_second, get_profile
+from metrics import run_ffmpeg
+from kenburns import render_motion, render_placeholder
+
+# Artifact paths/names come from the JobContext (mylist.txt, merged.nut, Final.mp4, ...)
+# Las rutas/nombres de artefactos vienen del JobContext (mylist.txt, merged.nut, Final.mp4, ...)
+
+# Intermediates (normalized clips, segments, merged video) use INTERMEDIATE_EXT and no faststart:
+# only Final.mp4 is rewritten with the moov atom in front
+# Los intermedios (clips normalizados, segmentos, video fusionado) usan INTERMEDIATE_EXT y sin faststart:
+# solo Final.mp4 se reescribe con el átomo moov al inicio
+
+# Audio normalization settings (canvas, fps and x264 settings come from the job's encode profile)
+# Configuraciones de normalización de audio (lienzo, fps y ajustes x264 vienen del perfil del trabajo)
 TARGET_AR    = 48000  # audio sample rate
 TARGET_AC    = 2      # audio channels
-NORM_DIR     = WORKDIR / "normalized"
-MYLIST_NORM  = WORKDIR / "mylist_normalized.txt"
 
 
 # Executes subprocess commands with error handling and user-friendly error messages
 # Ejecuta comandos de subproceso con manejo de errores y mensajes de error amigables
-def _run(cmd: list[str]):
-    """Run a command and raise with a short, friendly message on failure."""
+def _run(cmd: list[str], ctx: JobContext = None, label: str = "ffmpeg"):
+    """
+    Run a command and raise with a short, friendly message on failure.
+    With a ctx, ffmpeg progress and timings are recorded in ctx.metrics under label.
+    """
     # Execute subprocess command with error handling
     # Ejecutar comando de subproceso con manejo de errores
     try:
-        res = subprocess.run(cmd, check=True, capture_output=True, text=True)   
+        res = run_ffmpeg(cmd, ctx.metrics if ctx is not None else None, label)
         return res
     except subprocess.CalledProcessError as e:
         # Extract last error line for user-friendly message
@@ -61,34 +67,13 @@ def ensure_ffmpeg_available():
         raise SystemExit("ffprobe not found on PATH. Please install ffmpeg.")
     print("FFmpeg tools available/ Herramientas FFmpeg disponibles")
 
-# Extracts specific video/audio stream information using FFprobe in CSV format
-# Extrae información específica de streams de video/audio usando FFprobe en formato CSV
-def _ffprobe_csv(path: Path, stream: str, fields: list[str]) -> str:
-    """
-    Return a CSV line of requested fields for the first matching stream.
-    Empty string means the stream is missing (e.g., no audio).
-    """
-    # Query specific stream properties using ffprobe
-    # Consultar propiedades específicas del stream usando ffprobe
-    cmd = [
-        "ffprobe",
-        "-v", "error",
-        "-select_streams", stream,              # e.g., v:0 or a:0
-        "-show_entries", f"stream={','.join(fields)}",
-        "-of", "csv=p=0:s=|",
-        str(path),
-    ]
-    res = subprocess.run(cmd, capture_output=True, text=True)
-    return (res.stdout or "").strip()
-
-
 # Determines if video clips need normalization before concatenation based on stream compatibility
 # Determina si los clips de video necesitan normalización antes de la concatenación basado en compatibilidad de streams
 def _needs_normalize(files: list[Path]) -> bool:
     """
     Decide if we must normalize BEFORE concat:
       - any file missing audio
-      - any mismatch in v: codec/size/pix_fmt/SAR/fps
+      - any mismatch in v: codec/size/pix_fmt/SAR/fps or extradata (SPS/PPS)
       - any mismatch in a: codec/sample_rate/channels
     """
     # Check if video files need normalization before concatenation
@@ -96,32 +81,32 @@ def _needs_normalize(files: list[Path]) -> bool:
     if not files:
         return True
 
-    # Define video and audio properties to check for consistency
-    # Definir propiedades de video y audio para verificar consistencia
-    v_fields = ["codec_name", "width", "height", "pix_fmt", "sample_aspect_ratio", "avg_frame_rate"]  
-    a_fields = ["codec_name", "sample_rate", "channels"]
-
-    # Get reference properties from first file
-    # Obtener propiedades de referencia del primer archivo
-    v_sig0 = _ffprobe_csv(files[0], "v:0", v_fields)
-    a_sig0 = _ffprobe_csv(files[0], "a:0", a_fields)
+    # One cached probe per file (see probe.py)
+    # Un probe en caché por archivo (ver probe.py)
+    infos = [probe(f) for f in files]
+    ref = infos[0]
 
     # If first clip has no audio, we will normalize to inject silent audio
     # Si el primer clip no tiene audio, normalizaremos para inyectar audio silencioso
-    if not a_sig0:
+    if not ref.has_audio:
         return True
 
     # Compare all files against reference properties
     # Comparar todos los archivos contra las propiedades de referencia
-    for f in files[1:]:
-        v_sig = _ffprobe_csv(f, "v:0", v_fields)
-        a_sig = _ffprobe_csv(f, "a:0", a_fields)
+    for info in infos[1:]:
         # any missing audio OR any difference in signatures -> normalize
         # cualquier audio faltante O cualquier diferencia en firmas -> normalizar
-        if (not a_sig) or (v_sig != v_sig0) or (a_sig != a_sig0):
+        if (not info.has_audio) or (info.video_signature() != ref.video_signature()) \
+                or (info.video and ref.video and info.video.extradata != ref.video.extradata) \
+                or (info.audio_signature() != ref.audio_signature()):
             return True
     return False
 
+# True when the clips can be joined by concat-demuxer stream copy as they are
+# Verdadero cuando los clips pueden unirse por copia con el demuxer de concatenación tal como están
+def can_stream_copy(files: list[Path]) -> bool:
+    return not _needs_normalize(files)
+
 # Parses FFmpeg concat list file and extracts video file paths for processing
 # Analiza archivo de lista de concatenación de FFmpeg y extrae rutas de archivos de video para procesamiento
 def _parse_mylist(list_path: Path) -> list[Path]:
@@ -143,11 +128,11 @@ def _parse_mylist(list_path: Path) -> list[Path]:
 
 # Scans work directory for AI-generated video files and returns them sorted by index
 # Escanea directorio de trabajo para archivos de video generados por IA y los devuelve ordenados por índice
-def _find_input_clips() -> list[Path]:
+def _find_input_clips(ctx: JobContext) -> list[Path]:
     # Scan work directory for AI-generated video files
     # Escanear directorio de trabajo para archivos de video generados por IA
     clips = []
-    for p in WORKDIR.glob("AIvideo*.mp4"):
+    for p in ctx.workdir.glob("AIvideo*.mp4"):
         # Extract numeric index from filename for proper ordering
         # Extraer índice numérico del nombre de archivo para ordenamiento correcto
         m = re.search(r"AIvideo(\d+)\.mp4$", p.name)
@@ -170,26 +155,50 @@ def _write_list_for(files, list_path: Path):
     list_path.write_text("\n".join(lines), encoding="utf-8")
     print(f"List file created/ Archivo de lista creado: {list_path}")
 
+# Reads the concat list (or scans the work directory) and returns the clips to combine
+# Lee la lista de concatenación (o escanea el directorio de trabajo) y devuelve los clips a combinar
+def _load_clip_list(ctx: JobContext) -> list[Path]:
+    # Build/validate list
+    # Construir/validar lista
+    if ctx.mylist.exists():
+        files = _parse_mylist(ctx.mylist)
+    else:
+        files = _find_input_clips(ctx)
+        if files:
+            _write_list_for(files, ctx.mylist)
+
+    if not files:
+        raise FileNotFoundError("No input clips found. Run the Veo step first.")
+    return files
+
 def _has_audio(src: Path) -> bool:
     # Check if video file contains audio stream
     # Verificar si el archivo de video contiene stream de audio
-    return bool(_ffprobe_csv(src, "a:0", ["codec_name"]))
+    return probe(src).has_audio
+
+def _duration(src: Path) -> float:
+    # Read container duration in seconds (0.0 if unknown)
+    # Leer duración del contenedor en segundos (0.0 si se desconoce)
+    return probe(src).duration
 
 # Creates FFmpeg concat list file for video concatenation with fallback to dummy videos
 # Crea archivo de lista de concatenación de FFmpeg para concatenación de videos con respaldo a videos ficticios
-def create_txt(num: int):
+def create_txt(num: int, ctx: JobContext = None, transitions: list[str] = None) -> list[Path]:
     """
     Build concat list for ffmpeg demuxer:
     file 'AIvideo1.mp4'
     file 'AIvideo2.mp4'
     ...
+    When no clips exist and transitions are given, placeholders are local
+    Ken Burns renders of downloaded_image{i}.jpg instead of black clips.
     """
     # Create concatenation list file for ffmpeg
     # Crear archivo de lista de concatenación para ffmpeg
     if num <= 0:
         raise ValueError("Number of clips must be > 0")
 
-    files = _find_input_clips()
+    ctx = ctx or default_context()
+    files = _find_input_clips(ctx)
     if len(files) != num:
         print(f"Found {len(files)} AI videos but expected {num}/ Encontrados {len(files)} videos IA pero se esperaban {num}. Using existing videos only.")
     if not files:
@@ -197,227 +206,865 @@ def create_txt(num: int):
         # Create dummy videos for testing
         # Crear videos dummy para pruebas
         for i in range(1, num + 1):
-            dummy_file = WORKDIR / f"AIvideo{i}.mp4"
+            dummy_file = ctx.clip(i)
+            image = ctx.image(i)
+            if not dummy_file.exists() and transitions and MOTION_FALLBACK == "local" and image.exists():
+                # Real motion from the still image, no API needed
+                # Movimiento real desde la imagen fija, sin necesidad de la API
+                try:
+                    render_motion(image, transitions[i - 1], dummy_file, ctx)
+                except RuntimeError as e:
+                    print(f"Local fallback failed/ Respaldo local falló ({i}): {e}")
             if not dummy_file.exists():
-                import subprocess
-                # Generate 2-second black video as placeholder
-                # Generar video negro de 2 segundos como marcador de posición
-                cmd = [
-                    "ffmpeg", "-y", "-f", "lavfi", 
-                    "-i", f"color=black:size=1920x1080:duration=2",
-                    "-c:v", "libx264", "-preset", "fast", 
-                    str(dummy_file)
-                ]
-                subprocess.run(cmd, check=True, capture_output=True)
-                print(f"Dummy video created/ Video ficticio creado: {dummy_file}")
-        files = _find_input_clips()
-    _write_list_for(files, MYLIST_TXT)
+                # Black placeholder at the profile canvas and frame rate
+                # Marcador negro con el lienzo y la frecuencia de cuadros del perfil
+                render_placeholder(dummy_file, ctx)
+        files = _find_input_clips(ctx)
+    _write_list_for(files, ctx.mylist)
+    return files
+
 
+# Builds and runs the ffmpeg command that normalizes one clip
+# Construye y ejecuta el comando ffmpeg que normaliza un clip
+def _normalize_one(src: Path, dst: Path, threads: int, ctx: JobContext, canvas: tuple = None) -> Path:
+    # Build video filter for scaling, padding, and format conversion (canvas = (width, height, fps) override)
+    # Construir filtro de video para escalado, relleno y conversión de formato (canvas = (ancho, alto, fps) opcional)
+    profile = get_profile(ctx.profile)
+    vf = profile.canvas_filter(*(canvas or ()))
+
+    if _has_audio(src):
+        # Process video with existing audio
+        # Procesar video con audio existente
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-hide_banner", "-loglevel", "error",
+            "-i", str(src),
+            "-vf", vf,
+            *profile.video_args(threads),
+            "-c:a", "aac", "-b:a", profile.audio_bitrate, "-ar", str(TARGET_AR), "-ac", str(TARGET_AC),
+            str(dst),
+        ]
+    else:
+        # Inject silent audio for videos without audio
+        # Inyectar audio silencioso para videos sin audio
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-hide_banner", "-loglevel", "error",
+            "-i", str(src),
+            "-f", "lavfi", "-i", f"anullsrc=r={TARGET_AR}:cl=stereo",
+            "-vf", vf,
+            "-map", "0:v:0", "-map", "1:a:0",
+            *profile.video_args(threads),
+            "-c:a", "aac", "-b:a", profile.audio_bitrate, "-ar", str(TARGET_AR), "-ac", str(TARGET_AC),
+            "-shortest",
+            str(dst),
+        ]
+
+    with ctx.encode_slot():
+        _run(cmd, ctx, f"normalize:{src.name}")
+    print(f"Video normalized/ Video normalizado: {dst}")
+    return dst
 
 # Normalizes video clips to consistent format (resolution, FPS, audio) for reliable concatenation
 # Normaliza clips de video a formato consistente (resolución, FPS, audio) para concatenación confiable
-def _normalize_clips(src_files: list[Path]) -> list[Path]:
+def _normalize_clips(src_files: list[Path], jobs: int = NORMALIZE_JOBS, ctx: JobContext = None,
+                     canvas: tuple = None) -> list[Path]:
     """
     Normalize each clip to consistent canvas (WxH), CFR fps, SAR=1:1, yuv420p,
     and audio (AAC, 48kHz, stereo). Inject silent audio if the source has none.
+    The canvas is the profile's unless `canvas` gives (width, height, fps).
+    Up to `jobs` ffmpeg encoders run at once, each limited to CPU_COUNT // jobs
+    threads; output names and list order always follow the input order.
     """
     # Normalize video clips to consistent format for reliable concatenation
     # Normalizar clips de video a formato consistente para concatenación confiable
     if not src_files:
         raise FileNotFoundError("No clips to normalize.")
 
-    NORM_DIR.mkdir(parents=True, exist_ok=True)
-    norm_files = []
-
-    for i, src in enumerate(src_files, start=1):
-        dst = NORM_DIR / f"clip{i:03d}.mp4"
-
-        # Build video filter for scaling, padding, and format conversion
-        # Construir filtro de video para escalado, relleno y conversión de formato
-        vf = (
-            f"scale={TARGET_W}:{TARGET_H}:force_original_aspect_ratio=decrease,"
-            f"pad={TARGET_W}:{TARGET_H}:(ow-iw)/2:(oh-ih)/2:color=black,"
-            f"setsar=1,fps={TARGET_FPS},format=yuv420p"
-        )
-
-        if _has_audio(src):
-            # Process video with existing audio
-            # Procesar video con audio existente
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-hide_banner", "-loglevel", "error",
-                "-i", str(src),
-                "-vf", vf,
-                "-c:v", "libx264", "-preset", "medium", "-crf", "20",
-                "-c:a", "aac", "-ar", str(TARGET_AR), "-ac", str(TARGET_AC),
-                "-movflags", "+faststart",
-                str(dst),
-            ]
-        else:
-            # Inject silent audio for videos without audio
-            # Inyectar audio silencioso para videos sin audio
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-hide_banner", "-loglevel", "error",
-                "-i", str(src),
-                "-f", "lavfi", "-i", f"anullsrc=r={TARGET_AR}:cl=stereo",
-                "-vf", vf,
-                "-map", "0:v:0", "-map", "1:a:0",
-                "-c:v", "libx264", "-preset", "medium", "-crf", "20",
-                "-c:a", "aac", "-ar", str(TARGET_AR), "-ac", str(TARGET_AC),
-                "-shortest",
-                "-movflags", "+faststart",
-                str(dst),
-            ]
-
-        _run(cmd)
-        norm_files.append(dst)
-        print(f"Video normalized/ Video normalizado: {dst}")
-
-    _write_list_for(norm_files, MYLIST_NORM)
+    ctx = ctx or default_context()
+    ctx.norm_dir.mkdir(parents=True, exist_ok=True)
+    dst_files = [ctx.norm_dir / f"clip{i:03d}{INTERMEDIATE_EXT}" for i in range(1, len(src_files) + 1)]
+
+    # Split the CPU between workers so parallel encoders don't oversubscribe it
+    # Repartir la CPU entre trabajadores para que los codificadores no la saturen
+    jobs = max(1, min(jobs, len(src_files)))
+    threads = max(1, CPU_COUNT // jobs)
+
+    # ffmpeg does the work in child processes, so threads are enough here
+    # ffmpeg hace el trabajo en procesos hijos, así que los hilos bastan aquí
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        norm_files = list(pool.map(_normalize_one, src_files, dst_files, [threads] * len(src_files),
+                                   [ctx] * len(src_files), [canvas] * len(src_files)))
+
+    _write_list_for(norm_files, ctx.mylist_norm)
     return norm_files
 
 
-# Combines multiple video clips into single merged video using smart concatenation strategy
-# Combina múltiples clips de video en un solo video fusionado usando estrategia de concatenación inteligente
-def combine_videos():
+class OverlapNormalizer:
     """
-    Strategy:
-      PRE-FLIGHT with ffprobe. If any mismatch → normalize path.
-      Otherwise:
-        1) Fast concat (demuxer, copy)
-      If fast concat fails:
-        2) Normalize then concat (copy)
-      If that fails:
-        3) Concat filter (re-encode once) over normalized clips
+    Normalizes clips to the profile canvas while the rest are still being
+    generated: submit(index, path) is generate_all's on_clip callback, so
+    each clip goes to one of `jobs` ffmpeg encoders as soon as it's ready.
+    Clips already in the profile layout are used as is, unless their H.264
+    parameter sets differ from the other clips'. drain() waits for the
+    encoders; finish(clips) normalizes anything never submitted (e.g. when
+    the generate stage was skipped) and returns the clips in order.
     """
-    # Main video concatenation function with multiple fallback strategies
-    # Función principal de concatenación de video con múltiples estrategias de respaldo
-    # Build/validate list
-    # Construir/validar lista
-    if MYLIST_TXT.exists():
-        files = _parse_mylist(MYLIST_TXT)
-    else:
-        files = _find_input_clips()
-        if files:
-            _write_list_for(files, MYLIST_TXT)
 
-    if not files:
-        raise FileNotFoundError("No input clips found. Run the Veo step first.")
+    def __init__(self, ctx: JobContext = None, jobs: int = NORMALIZE_JOBS):
+        self.ctx = ctx or default_context()
+        self.jobs = max(1, jobs)
+        self.threads = max(1, CPU_COUNT // self.jobs)
+        self._pool = None
+        self._futures = {}   # source clip -> Future of the clip to concat
+        self._lock = threading.Lock()
 
+    def submit(self, index: int, src: Path):
+        src = Path(src)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.jobs)
+            self._futures[src] = self._pool.submit(self._one, src)
+
+    def _one(self, src: Path) -> Path:
+        # Same target as _normalize_one: profile canvas, fps, yuv420p, AAC TARGET_AR / TARGET_AC
+        # Mismo objetivo que _normalize_one: lienzo y fps del perfil, yuv420p, AAC TARGET_AR / TARGET_AC
+        profile = get_profile(self.ctx.profile)
+        info = probe(src)
+        if info.video_signature() == ("h264", profile.width, profile.height, "yuv420p", "1:1", f"{profile.fps}/1") \
+                and info.audio_signature() == ("aac", TARGET_AR, TARGET_AC):
+            return src
+        self.ctx.norm_dir.mkdir(parents=True, exist_ok=True)
+        return _normalize_one(src, self.ctx.norm_dir / f"{src.stem}{INTERMEDIATE_EXT}", self.threads, self.ctx)
+
+    def drain(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def finish(self, clips: list[Path]) -> list[Path]:
+        self.drain()
+        missing = [Path(c) for c in clips if Path(c) not in self._futures]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.jobs, len(missing)))) as pool:
+            for src in missing:
+                self._futures[src] = pool.submit(self._one, src)
+            out = [self._futures[Path(c)].result() for c in clips]
+            # Kept clips must share the SPS/PPS of our encodes, or the concat copy breaks at the joins
+            # Los clips conservados deben compartir los SPS/PPS de nuestras codificaciones, o la copia se rompe en las uniones
+            kept = [k for k, c in enumerate(clips) if out[k] == Path(c)]
+            videos = [probe(o).video for o in out]
+            for c, video in zip(clips, videos):
+                if video is None:
+                    raise RuntimeError(f"No readable video stream in {Path(c).name}")
+            if kept and len({v.extradata for v in videos}) > 1:
+                print("Kept clips have different H.264 parameters - normalizing them/ "
+                      "Clips conservados tienen parámetros H.264 distintos - normalizándolos")
+                self.ctx.norm_dir.mkdir(parents=True, exist_ok=True)
+                dst = {k: self.ctx.norm_dir / f"{out[k].stem}{INTERMEDIATE_EXT}" for k in kept}
+                futures = {k: pool.submit(_normalize_one, out[k], dst[k], self.threads, self.ctx) for k in kept}
+                for k, future in futures.items():
+                    out[k] = future.result()
+        _write_list_for(out, self.ctx.mylist_norm)
+        return out
+
+
+# Picks the most common video and audio signatures among the clips (the conform target)
+# Elige las firmas de video y audio más comunes entre los clips (el objetivo de conformado)
+def _majority_target(files: list[Path]):
+    """
+    Returns (video_signature, audio_signature), or None when the majority
+    isn't something we can match by encoding (H.264 video, AAC audio).
+    Clips without audio don't vote on audio; with no audio at all the
+    target is AAC at TARGET_AR / TARGET_AC.
+    """
+    infos = [probe(f) for f in files]
+    videos = Counter(i.video_signature() for i in infos if i.video)
+    audios = Counter(i.audio_signature() for i in infos if i.has_audio)
+    if not videos:
+        return None
+    video = videos.most_common(1)[0][0]
+    audio = audios.most_common(1)[0][0] if audios else ("aac", TARGET_AR, TARGET_AC)
+    if video[0] != "h264" or audio[0] != "aac" or not video[3] \
+            or not re.fullmatch(r"[1-9]\d*(/[1-9]\d*)?", video[5] or ""):
+        return None
+    return video, audio
+
+# Brings one clip to the target audio layout: keep it or rebuild only its audio
+# Lleva un clip a la disposición de audio objetivo: conservarlo o rehacer solo su audio
+def _conform_one(src: Path, dst: Path, target, ctx: JobContext) -> Path:
+    _, (_, ar, ac) = target
+    info = probe(src)
+    if info.audio_signature() == target[1]:
+        return src  # already matches: concat copies it as is
+
+    audio_in = ["-map", "0:a:0"]
+    extra_in = []
+    if not info.has_audio:
+        # Silent track so every clip has 1 video + 1 audio stream
+        # Pista silenciosa para que cada clip tenga 1 stream de video + 1 de audio
+        extra_in = ["-f", "lavfi", "-i", f"anullsrc=r={ar}:cl={'stereo' if ac == 2 else 'mono'}"]
+        audio_in = ["-map", "1:a:0", "-shortest"]
+    profile = get_profile(ctx.profile)
+    audio_out = ["-c:a", "aac", "-b:a", profile.audio_bitrate, "-ar", str(ar), "-ac", str(ac)]
+
+    # Video already matches: copy it (same SPS/PPS) and only rebuild the audio (a remux, no video encode)
+    # El video ya coincide: copiarlo (mismos SPS/PPS) y solo rehacer el audio (un remux, sin codificar video)
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", str(src), *extra_in,
+           "-map", "0:v:0", *audio_in, "-c:v", "copy", *audio_out, str(dst)]
+    _run(cmd, ctx, f"remux:{src.name}")
+    print(f"Clip audio conformed/ Audio del clip conformado: {dst}")
+    return dst
+
+# Conforms only the clips whose audio differs from the majority stream layout
+# Conforma solo los clips cuyo audio difiere de la disposición de streams mayoritaria
+def _conform_clips(src_files: list[Path], target, jobs: int = NORMALIZE_JOBS, ctx: JobContext = None) -> list[Path]:
+    """
+    Every clip's video must already match the target, parameter sets
+    included (see _video_matches): matching clips are used untouched and
+    the rest are remuxed (video copy + AAC). Output order follows the input
+    order.
+    """
+    ctx = ctx or default_context()
+    ctx.norm_dir.mkdir(parents=True, exist_ok=True)
+    dst_files = [ctx.norm_dir / f"clip{i:03d}{INTERMEDIATE_EXT}" for i in range(1, len(src_files) + 1)]
+    jobs = max(1, min(jobs, len(src_files)))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        out = list(pool.map(lambda s, d: _conform_one(s, d, target, ctx), src_files, dst_files))
+
+    kept = sum(1 for s, o in zip(src_files, out) if s == o)
+    print(f"Clips conformed/ Clips conformados: {kept} kept/ conservados, {len(out) - kept} rebuilt/ reconstruidos")
+    _write_list_for(out, ctx.mylist_norm)
+    return out
+
+# True when every clip has the target video layout and the same codec extradata
+# Verdadero cuando cada clip tiene la disposición de video objetivo y los mismos extradata de códec
+def _video_matches(files: list[Path], video_target: tuple) -> bool:
+    """
+    The concat demuxer keeps only the first input's extradata, so H.264
+    clips joined by -c copy must share their SPS/PPS as well as the
+    layout; a clip re-encoded by our x264 next to an untouched Veo clip
+    would decode as garbage at the join.
+    """
+    infos = [probe(f) for f in files]
+    return all(i.video_signature() == video_target for i in infos) \
+        and len({i.video.extradata for i in infos}) == 1
+
+
+# Normalizes the clips only when their streams can't be stream-copied together
+# Normaliza los clips solo cuando sus streams no pueden copiarse juntos
+def prepare_clips(files: list[Path], ctx: JobContext = None) -> tuple[list[Path], bool]:
+    """
+    PRE-FLIGHT with ffprobe. If only the audio differs -> conform the
+    outliers to the majority audio layout (see _conform_clips). When any
+    video differs (layout or parameter sets), every clip is re-encoded at
+    the majority canvas and frame rate, never scaled up to the profile
+    canvas: an outlier re-encoded alone would carry SPS/PPS that differ
+    from the untouched clips, which Final.mp4 (one avcC) can't hold. Only
+    when the majority isn't H.264 / AAC are the clips normalized to the
+    profile canvas. Returns (clips_to_concat, normalized).
+    """
     # --- PRE-FLIGHT: skip fast path if streams differ ---
     # --- PRE-VUELO: omitir ruta rápida si los streams difieren ---
-    if _needs_normalize(files):                                                  
-        print("Stream parameters differ - normalizing first/ Parámetros de stream difieren - normalizando primero") 
-        norm_files = _normalize_clips(files)                                     
-        # Try fast concatenation after normalization
-        # Intentar concatenación rápida después de normalización
-        cmd_norm_copy = [
-            "ffmpeg",
-            "-y",
-            "-hide_banner", "-loglevel", "error",
-            "-f", "concat", "-safe", "0",
-            "-i", str(MYLIST_NORM),
-            "-c", "copy",
-            str(MERGED_OUT),
-        ]
-        try:
-            _run(cmd_norm_copy)
-            print(f"Videos concatenated/ Videos concatenados: {MERGED_OUT}")
-            return
-        except RuntimeError:
+    if _needs_normalize(files):
+        target = _majority_target(files)
+        if target is not None and _video_matches(files, target[0]):
+            print("Audio parameters differ - conforming outliers/ Parámetros de audio difieren - conformando clips atípicos")
+            return _conform_clips(files, target, ctx=ctx), True
+        if target is not None:
+            _, width, height, _, _, fps = target[0]
+            print(f"Video parameters differ - normalizing to the majority {width}x{height}@{fps}/ "
+                  f"Parámetros de video difieren - normalizando a la mayoría {width}x{height}@{fps}")
+            return _normalize_clips(files, ctx=ctx, canvas=(width, height, fps)), True
+        print("Stream parameters differ - normalizing first/ Parámetros de stream difieren - normalizando primero")
+        return _normalize_clips(files, ctx=ctx), True
+    return files, False
+
+# Concatenates prepared clips into the merged video, falling back to normalize / concat filter
+# Concatena los clips preparados en el video fusionado, con respaldo a normalizar / filtro de concatenación
+def concat_clips(files: list[Path], normalized: bool, ctx: JobContext = None) -> Path:
+    """
+    1) Concat demuxer, stream copy
+    2) If that fails on raw clips: normalize, then concat filter
+    3) If it fails on normalized clips: concat filter (re-encode once), split
+       into SEGMENT_JOBS parallel segments joined by stream copy
+    """
+    if not files:
+        raise FileNotFoundError("No clips to concat.")
+    ctx = ctx or default_context()
+    merged_out = ctx.merged
+    list_path = ctx.mylist_norm if normalized else ctx.mylist
+    _write_list_for(files, list_path)
+
+    # --- 1) Fast path: concat demuxer (no re-encode) ---
+    # --- 1) Ruta rápida: demuxer de concatenación (sin re-codificación) ---
+    cmd_copy = [
+        "ffmpeg",
+        "-y",
+        "-hide_banner", "-loglevel", "error",
+        "-f", "concat", "-safe", "0",
+        "-i", str(list_path),
+        "-c", "copy",
+        str(merged_out),
+    ]
+    try:
+        _run(cmd_copy, ctx, "concat")
+        print(f"Videos concatenated/ Videos concatenados: {merged_out}")
+        return merged_out
+    except RuntimeError:
+        if normalized:
             print("Concat after normalization failed - using filter/ Concatenación después de normalización falló - usando filtro")
-            # Fall through to concat filter on normalized clips
-            # Continuar con filtro de concatenación en clips normalizados
-            files = norm_files                                                  
-    else:
-        # --- 1) Fast path: concat demuxer (no re-encode) ---
-        # --- 1) Ruta rápida: demuxer de concatenación (sin re-codificación) ---
-        cmd_fast = [
-            "ffmpeg",
-            "-y",
-            "-hide_banner", "-loglevel", "error",
-            "-f", "concat", "-safe", "0",
-            "-i", str(MYLIST_TXT),
-            "-c", "copy",
-            str(MERGED_OUT),
-        ]
+        else:
+            print("Fast concat failed - normalizing clips/ Concatenación rápida falló - normalizando clips")
+            files = _normalize_clips(files, ctx=ctx)
+
+    # --- 3) Last resort: concat filter (re-encode once), in parallel segments when possible ---
+    # --- 3) Último recurso: filtro de concatenación (re-codificar una vez), en segmentos paralelos si es posible ---
+    segments = max(1, min(SEGMENT_JOBS, len(files)))
+    if segments > 1:
         try:
-            _run(cmd_fast)
-            print(f"Videos concatenated/ Videos concatenados: {MERGED_OUT}")
-            return
+            return _concat_segments(files, segments, ctx)
         except RuntimeError:
-            print("Fast concat failed - normalizing clips/ Concatenación rápida falló - normalizando clips")
-            files = _normalize_clips(files)                                      
+            print("Segmented encode failed - using one encoder/ Codificación por segmentos falló - usando un codificador")
+    with ctx.encode_slot():
+        _run(_concat_filter_cmd(files, merged_out, ctx), ctx, "concat_filter")
+    print(f"Videos concatenated with filter/ Videos concatenados con filtro: {merged_out}")
+    return merged_out
 
-    # --- 3) Last resort: concat filter (re-encode once) ---
-    # --- 3) Último recurso: filtro de concatenación (re-codificar una vez) ---
+# Builds the concat-filter command that re-encodes `files` (1 video + 1 audio each) into out
+# Construye el comando del filtro de concatenación que re-codifica `files` (1 video + 1 audio cada uno) en out
+def _concat_filter_cmd(files: list[Path], out: Path, ctx: JobContext, threads: int = 0):
     inputs = []
     for p in files:
         inputs += ["-i", str(p)]
     n = len(files)
-    if n == 0:
-        raise FileNotFoundError("No clips to concat.")
 
     # For normalized files we know 1v/1a per input
     # Para archivos normalizados sabemos 1v/1a por entrada
-    filter_graph = "".join(f"[{i}:v:0][{i}:a:0]" for i in range(n)) + f"concat=n={n}:v=1:a=1[outv][outa]" 
-
-    cmd_concat_filter = [
+    filter_graph = "".join(f"[{i}:v:0][{i}:a:0]" for i in range(n)) + f"concat=n={n}:v=1:a=1[outv][outa]"
+    profile = get_profile(ctx.profile)
+    return [
         "ffmpeg",
         "-y",
         "-hide_banner", "-loglevel", "error",
         *inputs,
         "-filter_complex", filter_graph,
         "-map", "[outv]", "-map", "[outa]",
-        "-c:v", "libx264", "-preset", "medium", "-crf", "20",
-        "-c:a", "aac", "-ar", str(TARGET_AR), "-ac", str(TARGET_AC),
-        "-movflags", "+faststart",
-        str(MERGED_OUT),
+        *profile.video_args(threads),
+        "-c:a", "aac", "-b:a", profile.audio_bitrate, "-ar", str(TARGET_AR), "-ac", str(TARGET_AC),
+        str(out),
+    ]
+
+# Re-encodes the timeline as independent segments in parallel, then joins them by stream copy
+# Re-codifica la línea de tiempo como segmentos independientes en paralelo y luego los une por copia
+def _concat_segments(files: list[Path], segments: int, ctx: JobContext) -> Path:
+    """
+    The timeline is split at clip boundaries into `segments` contiguous runs
+    of clips. Each run is encoded by its own ffmpeg with the same profile
+    settings and thread share, so every segment starts on an IDR frame with
+    identical H.264 / AAC parameters, and the concat demuxer joins them with
+    -c copy, exactly like the fast path joins matching clips.
+    """
+    size, extra = divmod(len(files), segments)
+    runs, start = [], 0
+    for k in range(segments):
+        end = start + size + (1 if k < extra else 0)
+        runs.append(files[start:end])
+        start = end
+    ctx.norm_dir.mkdir(parents=True, exist_ok=True)
+    outs = [ctx.norm_dir / f"segment{k:03d}{INTERMEDIATE_EXT}" for k in range(1, segments + 1)]
+    threads = max(1, CPU_COUNT // segments)
+
+    def _encode(run: list[Path], out: Path) -> Path:
+        with ctx.encode_slot():
+            _run(_concat_filter_cmd(run, out, ctx, threads), ctx, f"segment:{out.name}")
+        return out
+
+    print(f"Encoding {segments} segments in parallel/ Codificando {segments} segmentos en paralelo")
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        outs = list(pool.map(_encode, runs, outs))
+
+    _write_list_for(outs, ctx.mylist_segments)
+    cmd_join = [
+        "ffmpeg",
+        "-y",
+        "-hide_banner", "-loglevel", "error",
+        "-f", "concat", "-safe", "0",
+        "-i", str(ctx.mylist_segments),
+        "-c", "copy",
+        str(ctx.merged),
+    ]
+    _run(cmd_join, ctx, "join")
+    for out in outs:
+        out.unlink(missing_ok=True)
+    print(f"Videos concatenated from segments/ Videos concatenados desde segmentos: {ctx.merged}")
+    return ctx.merged
+
+# Plans a crossfaded timeline: stream-copied clip middles and re-encoded overlap windows
+# Planifica una línea de tiempo con fundidos: centros de clips copiados y ventanas de solapamiento re-codificadas
+def _crossfade_plan(durations: list[float], keyframes: list[list[float]], seconds: float) -> list:
+    """
+    Returns the pieces in timeline order:
+      ("copy", i, start, end)            clip i between two keyframes, stream-copied
+      ("window", [(i, start, end), ...]) parts crossfaded together and re-encoded
+    A clip's middle starts at its first keyframe after the incoming fade and
+    ends at its last keyframe before the outgoing fade; a clip with no such
+    keyframes is pulled whole into the surrounding window.
+    """
+    eps = 1e-3
+    n = len(durations)
+    plan, window = [], []
+    for i, (dur, kfs) in enumerate(zip(durations, keyframes)):
+        start = 0.0 if i == 0 else next((k for k in kfs if k >= seconds - eps), dur)
+        end = dur if i == n - 1 else max((k for k in kfs if k <= dur - seconds + eps), default=0.0)
+        if start < end:
+            if i > 0:
+                window.append((i, 0.0, start))
+                plan.append(("window", window))
+            plan.append(("copy", i, start, end))
+            window = [(i, end, dur)] if i < n - 1 else []
+        else:
+            window.append((i, 0.0, dur))
+    if window:
+        plan.append(("window", window))
+    return plan
+
+# Builds the ffmpeg command that crossfades consecutive parts of clips into out
+# Construye el comando ffmpeg que funde partes consecutivas de clips en out
+def _crossfade_cmd(parts: list, files: list[Path], out: Path, seconds: float, audio, ctx: JobContext,
+                   threads: int = 0) -> list[str]:
+    inputs, chains = [], []
+    for k, (i, start, end) in enumerate(parts):
+        if start > 0:
+            inputs += ["-ss", f"{start:.6f}"]
+        inputs += ["-to", f"{end:.6f}", "-i", str(files[i])]
+        chains.append(f"[{k}:v:0]settb=AVTB,setpts=PTS-STARTPTS[v{k}]")
+        chains.append(f"[{k}:a:0]asetpts=PTS-STARTPTS[a{k}]")
+
+    # Chain the fades: each one starts `seconds` before the end of what is merged so far
+    # Encadenar los fundidos: cada uno empieza `seconds` antes del final de lo ya unido
+    video, sound, length = "v0", "a0", parts[0][2] - parts[0][1]
+    for k in range(1, len(parts)):
+        chains.append(f"[{video}][v{k}]xfade=transition={CROSSFADE_TRANSITION}:duration={seconds}"
+                      f":offset={length - seconds:.6f}[x{k}]")
+        chains.append(f"[{sound}][a{k}]acrossfade=d={seconds}[c{k}]")
+        video, sound = f"x{k}", f"c{k}"
+        length += parts[k][2] - parts[k][1] - seconds
+
+    profile = get_profile(ctx.profile)
+    return [
+        "ffmpeg",
+        "-y",
+        "-hide_banner", "-loglevel", "error",
+        *inputs,
+        "-filter_complex", ";".join(chains),
+        "-map", f"[{video}]", "-map", f"[{sound}]",
+        *profile.video_args(threads),
+        "-c:a", "aac", "-b:a", profile.audio_bitrate, "-ar", str(audio.sample_rate), "-ac", str(audio.channels),
+        str(out),
+    ]
+
+# Joins clips with crossfades, re-encoding only the overlap windows
+# Une los clips con fundidos, re-codificando solo las ventanas de solapamiento
+def crossfade_clips(files: list[Path], seconds: float, normalized: bool = False, ctx: JobContext = None) -> Path:
+    """
+    Clips must share one stream layout (run prepare_clips first). Each clip
+    middle between keyframes is stream-copied; only the windows around the
+    joins (tail of one clip + head of the next) are decoded, crossfaded with
+    xfade / acrossfade and encoded with the profile settings. Pieces are
+    MPEG-TS so every piece carries its own H.264 parameter sets, and the
+    concat demuxer joins them into the merged video with -c copy. Final.mp4
+    keeps a single avcC, so the copy join is only used when every piece
+    has the same SPS/PPS (e.g. clips normalized with the same profile);
+    otherwise, or if the join fails, the whole timeline is crossfaded in
+    one encode.
+    """
+    ctx = ctx or default_context()
+    if len(files) < 2:
+        return concat_clips(files, normalized, ctx)
+    infos = [probe(f) for f in files]
+    durations = [i.duration for i in infos]
+    # A fade can't be longer than half of the shortest clip
+    # Un fundido no puede durar más que la mitad del clip más corto
+    limit = min(durations) / 2
+    if limit <= 0:
+        raise RuntimeError("Cannot crossfade clips with unknown duration")
+    if seconds > limit:
+        print(f"Crossfade shortened to {limit:.2f}s/ Fundido acortado a {limit:.2f}s")
+        seconds = round(limit, 3)
+    audio = infos[0].audio
+
+    plan = _crossfade_plan(durations, [keyframes(f) for f in files], seconds)
+    ctx.norm_dir.mkdir(parents=True, exist_ok=True)
+    pieces = [ctx.norm_dir / f"piece{k:03d}.ts" for k in range(1, len(plan) + 1)]
+    windows = sum(1 for step in plan if step[0] == "window")
+    jobs = max(1, min(NORMALIZE_JOBS, windows))
+    threads = max(1, CPU_COUNT // jobs)
+
+    def _piece(step, out: Path) -> Path:
+        if step[0] == "copy":
+            _, i, start, end = step
+            cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+                   *(["-ss", f"{start:.6f}"] if start > 0 else []), "-to", f"{end:.6f}", "-i", str(files[i]),
+                   "-map", "0:v:0", "-map", "0:a:0", "-c", "copy", str(out)]
+            _run(cmd, ctx, f"cut:{out.name}")
+            return out
+        with ctx.encode_slot():
+            _run(_crossfade_cmd(step[1], files, out, seconds, audio, ctx, threads), ctx, f"xfade:{out.name}")
+        return out
+
+    print(f"Crossfading {windows} windows/ Fundiendo {windows} ventanas ({seconds}s)")
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            pieces = list(pool.map(_piece, plan, pieces))
+        # Windows are our x264 encodes: joining them by copy to untouched middles needs identical SPS/PPS
+        # Las ventanas son codificaciones de nuestro x264: unirlas por copia a centros intactos requiere SPS/PPS idénticos
+        videos = [probe(p).video for p in pieces]
+        if any(v is None or not v.extradata for v in videos) or len({v.extradata for v in videos}) > 1:
+            raise RuntimeError("crossfade windows and copied pieces have different H.264 parameters")
+        _write_list_for(pieces, ctx.mylist_crossfade)
+        cmd_join = [
+            "ffmpeg",
+            "-y",
+            "-hide_banner", "-loglevel", "error",
+            "-f", "concat", "-safe", "0",
+            "-i", str(ctx.mylist_crossfade),
+            "-map", "0", "-c", "copy", "-bsf:a", "aac_adtstoasc",
+            str(ctx.merged),
+        ]
+        _run(cmd_join, ctx, "join")
+        print(f"Videos crossfaded/ Videos fundidos: {ctx.merged}")
+    except RuntimeError as e:
+        # Last resort: crossfade the whole timeline in one encode
+        # Último recurso: fundir toda la línea de tiempo en una sola codificación
+        print(f"Crossfade join failed - re-encoding timeline/ Unión con fundidos falló - re-codificando línea de tiempo: {e}")
+        whole = [(i, 0.0, d) for i, d in enumerate(durations)]
+        with ctx.encode_slot():
+            _run(_crossfade_cmd(whole, files, ctx.merged, seconds, audio, ctx), ctx, "xfade")
+        print(f"Videos crossfaded/ Videos fundidos: {ctx.merged}")
+    finally:
+        for piece in ctx.norm_dir.glob("piece*.ts"):
+            piece.unlink(missing_ok=True)
+    return ctx.merged
+
+# Combines multiple video clips into single merged video using smart concatenation strategy
+# Combina múltiples clips de video en un solo video fusionado usando estrategia de concatenación inteligente
+def combine_videos(ctx: JobContext = None) -> Path:
+    """
+    Strategy:
+      prepare_clips: PRE-FLIGHT with ffprobe. Matching clips are used as is;
+        audio-only outliers get their audio rebuilt (video copied); any
+        video mismatch re-encodes every clip at the majority canvas.
+      concat_clips:
+        1) Concat demuxer, stream copy
+        2) If that fails on raw clips: normalize, then concat filter
+        3) On normalized clips: concat filter (re-encode once), in parallel
+           segments joined by stream copy
+    """
+    # Main video concatenation function with multiple fallback strategies
+    # Función principal de concatenación de video con múltiples estrategias de respaldo
+    ctx = ctx or default_context()
+    files = _load_clip_list(ctx)
+    files, normalized = prepare_clips(files, ctx)
+    return concat_clips(files, normalized, ctx)
+
+
+# Transcodes and loudness-normalizes the music once per track (cached), ready for a stream-copy mux
+# Transcodifica y normaliza el volumen de la música una vez por pista (en caché), lista para un mux por copia
+def prepare_music(ctx: JobContext = None, cache: MusicCache = None) -> Path:
+    """
+    Turn downloaded_music.mp4 into music_prepared.m4a: audio only, AAC at the
+    profile bitrate, TARGET_AR / TARGET_AC, loudnorm (MUSIC_LOUDNORM).
+    The result is kept in the music cache keyed by the track's content and
+    these settings, so later renders with the same track skip the encode.
+    """
+    ctx = ctx or default_context()
+    if not ctx.music.exists():
+        raise FileNotFoundError("downloaded_music.mp4 not found. Run the download step first.")
+    bitrate = get_profile(ctx.profile).audio_bitrate
+    settings = {"loudnorm": MUSIC_LOUDNORM, "bitrate": bitrate, "ar": TARGET_AR, "ac": TARGET_AC}
+    cache = cache if cache is not None else default_music_cache(ctx.cache_root)
+    out = ctx.music_prepared
+
+    key = cache.track_key(ctx.music, settings) if cache is not None else None
+    if key is not None and cache.materialize(key, out) is not None:
+        print(f"Music cache hit/ Acierto de caché de música: {out}")
+        return out
+
+    out.unlink(missing_ok=True)  # never write through a hardlink into the music cache
+    loudnorm = ["-af", f"loudnorm={MUSIC_LOUDNORM}"] if MUSIC_LOUDNORM else []
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-hide_banner", "-loglevel", "error",
+        "-i", str(ctx.music),
+        "-vn",
+        *loudnorm,
+        "-c:a", "aac", "-b:a", bitrate, "-ar", str(TARGET_AR), "-ac", str(TARGET_AC),
+        str(out),
     ]
-    _run(cmd_concat_filter)
-    print(f"Videos concatenated with filter/ Videos concatenados con filtro: {MERGED_OUT}")
+    with ctx.encode_slot():
+        _run(cmd, ctx, "music")
+    if key is not None:
+        try:
+            cache.put(key, out)
+        except OSError as e:
+            print(f"Music cache write failed/ Fallo al escribir caché de música: {e}")
+    print(f"Music prepared/ Música preparada: {out}")
+    return out
 
 
-# Adds background music to merged video or copies video without music if music file is missing
-# Añade música de fondo al video fusionado o copia video sin música si falta el archivo de música
-def add_music():
+# Remuxes the merged video into Final.mp4 with faststart (stream copy, no re-encode)
+# Remuxa el video fusionado en Final.mp4 con faststart (copia de streams, sin re-codificar)
+def finalize_video(ctx: JobContext = None) -> Path:
+    """
+    The merged video is left in place so the concat stage stays resumable.
+    This is the only write of the timeline that pays for faststart.
+    """
+    ctx = ctx or default_context()
+    if not ctx.merged.exists():
+        raise FileNotFoundError(f"{ctx.merged.name} not found. Run combine_videos() first.")
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-hide_banner", "-loglevel", "error",
+        "-i", str(ctx.merged),
+        "-map", "0", "-c", "copy",
+        "-movflags", "+faststart",
+        str(ctx.final),
+    ]
+    _run(cmd, ctx, "finalize")
+    print(f"Final video saved/ Video final guardado: {ctx.final}")
+    return ctx.final
+
+# Adds background music to merged video or remuxes video without music if music file is missing
+# Añade música de fondo al video fusionado o remuxa video sin música si falta el archivo de música
+def add_music(ctx: JobContext = None) -> Path:
     """
     Replace audio on merged video using the downloaded music.
-    If MUSIC_IN is missing, we just copy merged -> Final.mp4.
+    With music_prepared.m4a (see prepare_music) this is a pure stream copy
+    trimmed to the video duration; otherwise the raw track is encoded here.
+    If downloaded_music.mp4 is missing, merged is just remuxed to Final.mp4.
     """
     # Add background music to the concatenated video
     # Agregar música de fondo al video concatenado
-    if not MERGED_OUT.exists():
-        raise FileNotFoundError("merged.mp4 not found. Run combine_videos() first.")
+    ctx = ctx or default_context()
+    merged_out, final_out, music_in = ctx.merged, ctx.final, ctx.music
+    if not merged_out.exists():
+        raise FileNotFoundError(f"{merged_out.name} not found. Run combine_videos() first.")
 
-    if not MUSIC_IN.exists():
+    if not music_in.exists():
         print("No music found - copying merged video/ No se encontró música - copiando video fusionado")
-        WORKDIR.mkdir(parents=True, exist_ok=True)
-        # Copy video without music if no music file available
-        # Copiar video sin música si no hay archivo de música disponible
-        FINAL_OUT.write_bytes(MERGED_OUT.read_bytes())
-        print(f"Final video saved/ Video final guardado: {FINAL_OUT}")
-        return
-
-    # Replace video audio with music track
-    # Reemplazar audio del video con pista de música
+        # Remux video without music if no music file available
+        # Remuxar video sin música si no hay archivo de música disponible
+        return finalize_video(ctx)
+
+    # Replace video audio with music track (already AAC when prepared: copy both streams)
+    # Reemplazar audio del video con pista de música (ya en AAC si está preparada: copiar ambos streams)
+    prepared = ctx.music_prepared.exists()
+    if prepared:
+        audio_in = ctx.music_prepared
+        audio_args = ["-c:a", "copy", "-t", f"{probe(merged_out).duration:.3f}"]
+    else:
+        audio_in = music_in
+        audio_args = ["-c:a", "aac", "-b:a", get_profile(ctx.profile).audio_bitrate]
     cmd = [
         "ffmpeg",
         "-y",
         "-hide_banner", "-loglevel", "error",
-        "-i", str(MERGED_OUT),
-        "-i", str(MUSIC_IN),
+        "-i", str(merged_out),
+        "-i", str(audio_in),
         "-map", "0:v:0", "-map", "1:a:0",
         "-c:v", "copy",
-        "-c:a", "aac", "-b:a", "192k",
+        *audio_args,
         "-shortest",
         "-movflags", "+faststart",
-        str(FINAL_OUT),
+        str(final_out),
+    ]
+    _run(cmd, ctx, "mux")
+    print(f"Music added to video/ Música añadida al video: {final_out}")
+    return final_out
+
+
+# Renders Final.mp4 straight from the AI clips and music with a single ffmpeg graph
+# Renderiza Final.mp4 directamente desde los clips IA y la música con un solo grafo ffmpeg
+def render_single_pass(music: bool = True, ctx: JobContext = None) -> Path:
+    """
+    One decode, one video encode, no intermediates:
+      every clip -> scale/pad/setsar/fps/format -> concat -> Final.mp4
+    Audio is replaced by the music when music is True and it exists (copied
+    from music_prepared.m4a when prepare_music ran, else encoded here);
+    otherwise each clip's own audio is kept (silence for clips without audio).
+    Raises RuntimeError on ffmpeg failure (or a silent clip of unknown
+    duration) so callers can fall back to combine_videos() + add_music().
+    """
+    # Single-pass render used instead of normalize + concat + add_music
+    # Renderizado de una sola pasada usado en lugar de normalizar + concatenar + add_music
+    ctx = ctx or default_context()
+    final_out, music_in = ctx.final, ctx.music
+    files = _load_clip_list(ctx)
+    n = len(files)
+    # Prefer the prepared (cached, loudness-normalized AAC) track: its audio is copied, not re-encoded
+    # Preferir la pista preparada (en caché, AAC normalizado): su audio se copia, no se re-codifica
+    prepared = ctx.music_prepared.exists()
+    if prepared:
+        music_in = ctx.music_prepared
+    use_music = music and music_in.exists()
+    if music and not use_music:
+        print("No music found - keeping clip audio/ No se encontró música - conservando audio de los clips")
+
+    inputs = []
+    for p in files:
+        inputs += ["-i", str(p)]
+
+    # Per-clip video chain: same canvas/fps/pixel format as _normalize_clips
+    # Cadena de video por clip: mismo lienzo/fps/formato de píxel que _normalize_clips
+    profile = get_profile(ctx.profile)
+    chains = [f"[{i}:v:0]{profile.canvas_filter()}[v{i}]" for i in range(n)]
+
+    if use_music:
+        # Music replaces clip audio: concat video only, map the music track
+        # La música reemplaza el audio de los clips: concatenar solo video, mapear la pista de música
+        inputs += ["-i", str(music_in)]
+        filter_graph = ";".join(chains) + ";" + "".join(f"[v{i}]" for i in range(n)) + f"concat=n={n}:v=1:a=0[outv]"
+        audio_map = f"{n}:a:0"
+        if prepared:
+            audio_args = ["-c:a", "copy", "-shortest"]
+        else:
+            audio_args = ["-c:a", "aac", "-b:a", profile.audio_bitrate, "-shortest"]
+    else:
+        # Keep clip audio, generating silence for clips that have none
+        # Conservar audio de los clips, generando silencio para los que no tienen
+        for i, p in enumerate(files):
+            if _has_audio(p):
+                chains.append(f"[{i}:a:0]aresample={TARGET_AR},aformat=channel_layouts=stereo[a{i}]")
+            elif _duration(p) <= 0:
+                # atrim=duration=0 doesn't trim: the silence would never end and the concat never finish
+                # atrim=duration=0 no recorta: el silencio nunca terminaría y la concatenación tampoco
+                raise RuntimeError(f"Unknown duration for silent clip {p.name}")
+            else:
+                chains.append(f"anullsrc=r={TARGET_AR}:cl=stereo,atrim=duration={_duration(p):.3f}[a{i}]")
+        filter_graph = ";".join(chains) + ";" + "".join(f"[v{i}][a{i}]" for i in range(n)) + f"concat=n={n}:v=1:a=1[outv][outa]"
+        audio_map = "[outa]"
+        audio_args = ["-c:a", "aac", "-b:a", profile.audio_bitrate, "-ar", str(TARGET_AR), "-ac", str(TARGET_AC)]
+
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-hide_banner", "-loglevel", "error",
+        *inputs,
+        "-filter_complex", filter_graph,
+        "-map", "[outv]", "-map", audio_map,
+        *profile.video_args(),
+        *audio_args,
+        "-movflags", "+faststart",
+        str(final_out),
     ]
-    _run(cmd)
-    print(f"Music added to video/ Música añadida al video: {FINAL_OUT}")
+    with ctx.encode_slot():
+        _run(cmd, ctx, "render")
+    print(f"Final video rendered in one pass/ Video final renderizado en una pasada: {final_out}")
+    return final_out
+
+
+# Escapes a path or option value for the tee muxer's "[options]file|..." syntax
+# Escapa una ruta o valor de opción para la sintaxis "[opciones]archivo|..." del muxer tee
+def _tee_escape(value) -> str:
+    return re.sub(r"([\\:|\[\]])", r"\\\1", str(value))
+
+# Encodes every rendition (and optional HLS variants) from a single decode of Final.mp4
+# Codifica cada resolución (y variantes HLS opcionales) con una sola decodificación de Final.mp4
+def render_ladder(ladder: list[Rendition], hls_seconds: float = 0, ctx: JobContext = None) -> list[Path]:
+    """
+    One ffmpeg run: Final.mp4 is decoded once and split into one scaled
+    branch per rung, each encoded with the job profile's x264 settings capped
+    at the rung's maxrate (CPU split between the encoders); audio is copied.
+    Rungs taller than Final.mp4 are skipped; widths follow its display
+    aspect and the playlist its frame rate. With hls_seconds > 0 keyframes
+    are forced on segment boundaries and each encode is teed into both the
+    MP4 and an fMP4 HLS variant, listed in hls/master.m3u8.
+    """
+    ctx = ctx or default_context()
+    if not ctx.final.exists():
+        raise FileNotFoundError("Final.mp4 not found. Run the mux stage first.")
+    info = probe(ctx.final)
+    video = info.video
+    if video is None or not video.height:
+        raise RuntimeError(f"No readable video stream in {ctx.final.name}")
+    # Frame rate and display aspect come from Final.mp4 itself (clips may have been stream-copied)
+    # La frecuencia de cuadros y la relación de aspecto vienen del propio Final.mp4 (los clips pueden venir copiados)
+    try:
+        fps = float(Fraction(video.fps))
+    except (ValueError, ZeroDivisionError):
+        fps = 0.0
+    try:
+        sar = Fraction(video.sar.replace(":", "/")) if video.sar and video.sar != "0:1" else Fraction(1)
+    except (ValueError, ZeroDivisionError):
+        sar = Fraction(1)
+    aspect = float(video.width * sar / video.height)
+    # Never upscale: a taller rung would only cost bits without adding detail
+    # Nunca ampliar: una resolución más alta solo costaría bits sin agregar detalle
+    rungs = [r for r in ladder if r.height <= video.height]
+    for r in ladder:
+        if r not in rungs:
+            print(f"Rendition skipped (taller than Final.mp4)/ Resolución omitida (más alta que Final.mp4): {r.name}")
+    if not rungs:
+        return []
+
+    profile = get_profile(ctx.profile)
+    threads = max(1, CPU_COUNT // len(rungs))
+    ctx.renditions_dir.mkdir(parents=True, exist_ok=True)
+    if hls_seconds > 0:
+        # Old segments would linger next to a shorter new playlist
+        # Segmentos viejos quedarían junto a una nueva lista más corta
+        shutil.rmtree(ctx.hls_dir, ignore_errors=True)
+
+    # Decode once, split the frames, scale each branch to its rung
+    # Decodificar una vez, dividir los cuadros y escalar cada rama a su resolución
+    chains = [f"[0:v:0]split={len(rungs)}" + "".join(f"[s{k}]" for k in range(len(rungs)))]
+    chains += [f"[s{k}]scale={r.width_for(aspect)}:{r.height}:flags=lanczos,setsar=1[v{k}]"
+               for k, r in enumerate(rungs)]
+    keyframes_args = ["-force_key_frames", f"expr:gte(t,n_forced*{hls_seconds:g})"] if hls_seconds > 0 else []
+
+    outputs, cmd = [], ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", str(ctx.final),
+                        "-filter_complex", ";".join(chains)]
+    for k, r in enumerate(rungs):
+        mp4 = ctx.rendition(r.name)
+        cmd += ["-map", f"[v{k}]", "-map", "0:a:0?", *r.video_args(profile, threads), *keyframes_args,
+                "-c:a", "copy"]
+        if hls_seconds > 0:
+            # One encode, two muxers: the MP4 file and the HLS variant
+            # Una codificación, dos muxers: el archivo MP4 y la variante HLS
+            variant = ctx.hls_dir / r.name
+            variant.mkdir(parents=True, exist_ok=True)
+            hls = ":".join([
+                "f=hls", f"hls_time={hls_seconds:g}", "hls_playlist_type=vod", "hls_segment_type=fmp4",
+                "hls_flags=independent_segments", "hls_fmp4_init_filename=init.mp4",
+                f"hls_segment_filename={_tee_escape(_tee_escape(variant / 'seg%03d.m4s'))}",
+            ])
+            cmd += ["-flags:v", "+global_header", "-f", "tee",
+                    f"[f=mp4:movflags=+faststart]{_tee_escape(mp4)}|[{hls}]{_tee_escape(variant / 'index.m3u8')}"]
+        else:
+            cmd += ["-movflags", "+faststart", str(mp4)]
+        outputs.append(mp4)
 
+    print(f"Encoding {len(rungs)} renditions from one decode/ Codificando {len(rungs)} resoluciones con una decodificación")
+    with ctx.encode_slot():
+        _run(cmd, ctx, "ladder")
 
+    if hls_seconds > 0:
+        # Master playlist: peak bandwidth = video maxrate + audio bitrate
+        # Lista maestra: ancho de banda pico = maxrate de video + bitrate de audio
+        audio_bps = bits_per_second(profile.audio_bitrate) if info.has_audio else 0
+        lines = ["#EXTM3U", "#EXT-X-VERSION:7", "#EXT-X-INDEPENDENT-SEGMENTS"]
+        for r in rungs:
+            frame_rate = f",FRAME-RATE={fps:.3f}" if fps > 0 else ""
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={bits_per_second(r.maxrate) + audio_bps},"
+                         f"RESOLUTION={r.width_for(aspect)}x{r.height}{frame_rate}")
+            lines.append(f"{r.name}/index.m3u8")
+        ctx.hls_master.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        outputs.append(ctx.hls_master)
+        print(f"HLS playlist saved/ Lista HLS guardada: {ctx.hls_master}")
+    print(f"Renditions saved/ Resoluciones guardadas: {ctx.renditions_dir}")
+    return outputs
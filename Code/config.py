@@ -3,7 +3,15 @@
 # English: Central configuration module defining project paths and work directory
 # Español: Módulo de configuración central que define rutas del proyecto y directorio de trabajo
 
+import os
+import threading
+from contextlib import nullcontext
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Callable, Optional
+
+from policy import CircuitBreaker, TokenBucket
+from metrics import RunMetrics
 
 # Project root = the folder where THIS file lives
 # Raíz del proyecto = la carpeta donde vive ESTE archivo
@@ -12,6 +20,261 @@ PROJECT_ROOT = Path(__file__).resolve().parent
 # Centralized work folder under the Code directory
 # Carpeta de trabajo centralizada bajo el directorio Code
 workdir = PROJECT_ROOT / ".work"
-# Create work directory if it doesn't exist
-# Crear directorio de trabajo si no existe
-workdir.mkdir(parents=True, exist_ok=True)  # create it once at import time
\ No newline at end of file
+# Created on first use by JobContext.ensure(); importing config never touches the disk
+# Se crea en el primer uso con JobContext.ensure(); importar config nunca toca el disco
+
+# Maximum number of Veo generations running at the same time
+# Número máximo de generaciones Veo ejecutándose al mismo tiempo
+VEO_MAX_IN_FLIGHT = int(os.getenv("VEO_MAX_IN_FLIGHT", "4"))
+
+# Veo backend: "genai" (Google API) or "fake" (local stand-in for offline load tests, see veo_backend.py)
+# Backend Veo: "genai" (API de Google) o "fake" (sustituto local para pruebas de carga sin conexión, ver veo_backend.py)
+VEO_BACKEND = os.getenv("VEO_BACKEND", "genai").lower()
+FAKE_VEO_LATENCY = float(os.getenv("FAKE_VEO_LATENCY", "5"))            # seconds per generation
+FAKE_VEO_FAILURE_RATE = float(os.getenv("FAKE_VEO_FAILURE_RATE", "0"))  # 0..1, transient failures
+FAKE_VEO_CLIP_SECONDS = float(os.getenv("FAKE_VEO_CLIP_SECONDS", "4"))
+
+# Default motion engine per image ("veo" or "local" Ken Burns) and what replaces a failed Veo clip
+# Motor de movimiento por defecto por imagen ("veo" o Ken Burns "local") y qué reemplaza un clip Veo fallido
+MOTION_ENGINES = ("veo", "local")
+MOTION_ENGINE = os.getenv("MOTION_ENGINE", "veo").lower()
+MOTION_FALLBACK = os.getenv("MOTION_FALLBACK", "local").lower()  # "local" or "dummy"
+
+# Encode profile used when input.json has no "profile" (draft, standard, archive; see profiles.py)
+# Perfil de codificación usado cuando input.json no tiene "profile" (draft, standard, archive; ver profiles.py)
+ENCODE_PROFILE = os.getenv("ENCODE_PROFILE", "standard").lower()
+
+# Crossfade between consecutive clips in seconds when input.json has no "crossfade" (0 = hard cuts)
+# Fundido entre clips consecutivos en segundos cuando input.json no tiene "crossfade" (0 = cortes directos)
+CROSSFADE_SECONDS = float(os.getenv("CROSSFADE_SECONDS", "0"))
+CROSSFADE_TRANSITION = os.getenv("CROSSFADE_TRANSITION", "fade")  # any ffmpeg xfade transition
+
+# On-disk cache of generated clips (set CLIP_CACHE_MAX_MB=0 to disable)
+# Caché en disco de clips generados (usar CLIP_CACHE_MAX_MB=0 para deshabilitar)
+CLIP_CACHE_DIR = Path(os.getenv("CLIP_CACHE_DIR", str(PROJECT_ROOT / ".cache" / "clips")))
+CLIP_CACHE_MAX_BYTES = int(os.getenv("CLIP_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+# Downloaded images / music: pooled HTTP connections and a revalidated on-disk cache (ASSET_CACHE_MAX_MB=0 disables it)
+# Imágenes / música descargadas: conexiones HTTP reutilizadas y caché en disco revalidada (ASSET_CACHE_MAX_MB=0 la deshabilita)
+HTTP_POOL_SIZE = max(1, int(os.getenv("HTTP_POOL_SIZE", "16")))
+ASSET_CACHE_DIR = Path(os.getenv("ASSET_CACHE_DIR", str(PROJECT_ROOT / ".cache" / "assets")))
+ASSET_CACHE_MAX_BYTES = int(os.getenv("ASSET_CACHE_MAX_MB", "1024")) * 1024 * 1024
+
+# Cache of pre-transcoded, loudness-normalized music tracks (set MUSIC_CACHE_MAX_MB=0 to disable)
+# Caché de pistas de música pre-transcodificadas y normalizadas en volumen (usar MUSIC_CACHE_MAX_MB=0 para deshabilitar)
+MUSIC_CACHE_DIR = Path(os.getenv("MUSIC_CACHE_DIR", str(PROJECT_ROOT / ".cache" / "music")))
+MUSIC_CACHE_MAX_BYTES = int(os.getenv("MUSIC_CACHE_MAX_MB", "512")) * 1024 * 1024
+# ffmpeg loudnorm target (EBU R128); empty = transcode without normalizing loudness
+# Objetivo de loudnorm de ffmpeg (EBU R128); vacío = transcodificar sin normalizar el volumen
+MUSIC_LOUDNORM = os.getenv("MUSIC_LOUDNORM", "I=-16:TP=-1.5:LRA=11")
+
+# Parallel ffmpeg encoders used for clip normalization (each gets cpu_count / jobs threads)
+# Codificadores ffmpeg en paralelo para normalizar clips (cada uno recibe cpu_count / jobs hilos)
+CPU_COUNT = os.cpu_count() or 1
+NORMALIZE_JOBS = max(1, int(os.getenv("NORMALIZE_JOBS", str(min(4, CPU_COUNT)))))
+# Parallel segments for the concat-filter fallback (1 = a single encoder for the whole timeline)
+# Segmentos en paralelo para el respaldo con filtro de concatenación (1 = un solo codificador para toda la línea de tiempo)
+SEGMENT_JOBS = max(1, int(os.getenv("SEGMENT_JOBS", str(NORMALIZE_JOBS))))
+
+# Concurrent downloads per job, and worker processes decoding / downscaling the downloaded images
+# Descargas concurrentes por trabajo, y procesos que decodifican / reducen las imágenes descargadas
+DOWNLOAD_JOBS = max(1, int(os.getenv("DOWNLOAD_JOBS", "8")))
+IMAGE_JOBS = max(1, int(os.getenv("IMAGE_JOBS", str(min(4, CPU_COUNT)))))
+# Images are shrunk (never enlarged) until they just cover this size: what Veo and Ken Burns render (16:9, 720p)
+# Las imágenes se reducen (nunca se amplían) hasta cubrir justo este tamaño: lo que renderizan Veo y Ken Burns (16:9, 720p)
+IMAGE_TARGET_W, IMAGE_TARGET_H = (int(v) for v in os.getenv("IMAGE_TARGET_SIZE", "1280x720").lower().split("x"))
+
+# "single" renders Final.mp4 in one ffmpeg pass when the clips must be re-encoded (matching clips are
+# still stream-copied); "multi" uses normalize + concat + add_music;
+# "overlap" is multi with each clip normalized as soon as it is generated
+# "single" renderiza Final.mp4 en una pasada de ffmpeg cuando los clips deben re-codificarse (los que
+# coinciden se siguen copiando); "multi" usa normalizar + concatenar + add_music;
+# "overlap" es multi con cada clip normalizado en cuanto se genera
+RENDER_MODE = os.getenv("RENDER_MODE", "single").lower()
+
+# Container of the intermediates (normalized clips, segments, merged video); none of them gets
+# faststart, only Final.mp4 does. "nut" streams straight into the concat demuxer, "mp4" is the old layout
+# Contenedor de los intermedios (clips normalizados, segmentos, video fusionado); ninguno lleva
+# faststart, solo Final.mp4. "nut" entra directo al demuxer de concatenación, "mp4" es el formato anterior
+INTERMEDIATE_FORMATS = {"nut": ".nut", "mp4": ".mp4"}
+INTERMEDIATE_FORMAT = os.getenv("INTERMEDIATE_FORMAT", "nut").lower()
+INTERMEDIATE_EXT = INTERMEDIATE_FORMATS.get(INTERMEDIATE_FORMAT, ".nut")
+
+# Extra renditions encoded from one decode of Final.mp4, as height:maxrate (empty = none, see profiles.Rendition)
+# Resoluciones extra codificadas con una sola decodificación de Final.mp4, como alto:maxrate (vacío = ninguna)
+RENDITIONS = os.getenv("RENDITIONS", "")
+# HLS (fMP4) segment length for the renditions, in seconds; 0 = MP4 files only
+# Duración de segmento HLS (fMP4) para las resoluciones, en segundos; 0 = solo archivos MP4
+HLS_SEGMENT_SECONDS = float(os.getenv("HLS_SEGMENT_SECONDS", "0"))
+
+# Persistent ffprobe results (set PROBE_CACHE_FILE= to keep them in memory only)
+# Resultados de ffprobe persistentes (usar PROBE_CACHE_FILE= para guardarlos solo en memoria)
+_probe_cache = os.getenv("PROBE_CACHE_FILE", str(PROJECT_ROOT / ".cache" / "probe.json"))
+PROBE_CACHE_FILE = Path(_probe_cache) if _probe_cache else None
+
+# Batch limits shared by all concurrent jobs (see batch.py)
+# Límites de lote compartidos por todos los trabajos concurrentes (ver batch.py)
+BATCH_MAX_JOBS = max(1, int(os.getenv("BATCH_MAX_JOBS", "2")))
+BATCH_MAX_API_CALLS = max(1, int(os.getenv("BATCH_MAX_API_CALLS", str(VEO_MAX_IN_FLIGHT))))
+BATCH_MAX_ENCODES = max(1, int(os.getenv("BATCH_MAX_ENCODES", str(NORMALIZE_JOBS))))
+
+# Local job service (see service.py)
+# Servicio local de trabajos (ver service.py)
+SERVICE_HOST = os.getenv("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8080"))
+SERVICE_MAX_JOBS = max(1, int(os.getenv("SERVICE_MAX_JOBS", "4")))
+# Finished jobs whose status is kept in memory; older ones are forgotten (their workdirs stay on disk)
+# Trabajos terminados cuyo estado se guarda en memoria; los más viejos se olvidan (sus directorios quedan en disco)
+SERVICE_KEEP_FINISHED = max(1, int(os.getenv("SERVICE_KEEP_FINISHED", "500")))
+VEO_CALLS_PER_MINUTE = float(os.getenv("VEO_CALLS_PER_MINUTE", "10"))
+
+# Extra folder for Prometheus .prom files (e.g. node_exporter's textfile collector); empty = job workdir only
+# Carpeta extra para archivos .prom de Prometheus (p. ej. textfile collector de node_exporter); vacío = solo el directorio del trabajo
+_textfile_dir = os.getenv("METRICS_TEXTFILE_DIR", "")
+METRICS_TEXTFILE_DIR = Path(_textfile_dir) if _textfile_dir else None
+
+
+@dataclass
+class JobContext:
+    """
+    Everything a single render needs; each job gets its own work directory,
+    so several jobs can run in one process without overwriting each other.
+      api_slots       semaphore capping Veo operations in flight across jobs
+      encode_slots    semaphore capping ffmpeg encodes across jobs
+      api_rate        token bucket limiting generate_videos calls per minute
+      breaker         circuit breaker shared so jobs back off together on quota errors
+      on_stage        called with each stage name as the pipeline advances
+      backend         veo_backend.VeoBackend overriding the default Veo backend
+      metrics         timings for the run report (see metrics.py)
+      profile         encode profile for every re-encode (see profiles.py)
+      use_clip_cache  False makes Veo generation skip the clip cache
+      cache_root      folder for this job's own clip / asset / music caches instead of the shared ones
+    """
+    workdir: Path
+    name: str = "default"
+    api_slots: Optional[threading.Semaphore] = None
+    encode_slots: Optional[threading.Semaphore] = None
+    api_rate: Optional[TokenBucket] = None
+    breaker: Optional[CircuitBreaker] = None
+    on_stage: Optional[Callable[[str], None]] = None
+    backend: Optional[object] = None
+    metrics: RunMetrics = field(default_factory=RunMetrics)
+    profile: str = ENCODE_PROFILE
+    use_clip_cache: bool = True
+    cache_root: Optional[Path] = None
+
+    # Artifact paths inside the job work directory
+    # Rutas de artefactos dentro del directorio de trabajo del trabajo
+    @property
+    def input_json(self) -> Path:
+        return self.workdir / "input.json"
+
+    @property
+    def music(self) -> Path:
+        return self.workdir / "downloaded_music.mp4"
+
+    @property
+    def music_prepared(self) -> Path:
+        return self.workdir / "music_prepared.m4a"
+
+    @property
+    def mylist(self) -> Path:
+        return self.workdir / "mylist.txt"
+
+    @property
+    def norm_dir(self) -> Path:
+        return self.workdir / "normalized"
+
+    @property
+    def mylist_norm(self) -> Path:
+        return self.workdir / "mylist_normalized.txt"
+
+    @property
+    def mylist_segments(self) -> Path:
+        return self.workdir / "mylist_segments.txt"
+
+    @property
+    def mylist_crossfade(self) -> Path:
+        return self.workdir / "mylist_crossfade.txt"
+
+    @property
+    def merged(self) -> Path:
+        return self.workdir / f"merged{INTERMEDIATE_EXT}"
+
+    @property
+    def final(self) -> Path:
+        return self.workdir / "Final.mp4"
+
+    @property
+    def renditions_dir(self) -> Path:
+        return self.workdir / "renditions"
+
+    @property
+    def hls_dir(self) -> Path:
+        return self.renditions_dir / "hls"
+
+    @property
+    def hls_master(self) -> Path:
+        return self.hls_dir / "master.m3u8"
+
+    @property
+    def manifest(self) -> Path:
+        return self.workdir / "manifest.json"
+
+    @property
+    def metrics_json(self) -> Path:
+        return self.workdir / "metrics.json"
+
+    @property
+    def metrics_prom(self) -> Path:
+        return self.workdir / "metrics.prom"
+
+    def image(self, index: int) -> Path:
+        return self.workdir / f"downloaded_image{index}.jpg"
+
+    def source_image(self, index: int) -> Path:
+        # Original bytes as downloaded when the asset cache is off; removed after the JPEG conversion
+        # Bytes originales descargados cuando la caché de assets está apagada; se borran tras la conversión a JPEG
+        return self.workdir / f"source_image{index}"
+
+    def clip(self, index: int) -> Path:
+        return self.workdir / f"AIvideo{index}.mp4"
+
+    def rendition(self, name: str) -> Path:
+        return self.renditions_dir / f"Final_{name}.mp4"
+
+    def ensure(self) -> "JobContext":
+        # Create the work directory on first use
+        # Crear el directorio de trabajo en el primer uso
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        return self
+
+    def try_acquire_api(self) -> bool:
+        # Non-blocking: the Veo scheduler loop just retries on its next tick
+        # Sin bloqueo: el ciclo del planificador Veo reintenta en su siguiente vuelta
+        return self.api_slots is None or self.api_slots.acquire(blocking=False)
+
+    def release_api(self):
+        if self.api_slots is not None:
+            self.api_slots.release()
+
+    def take_api_token(self) -> float:
+        # 0.0 when a generate_videos call may go out now, else seconds to wait
+        # 0.0 cuando una llamada generate_videos puede salir ahora, si no segundos de espera
+        return 0.0 if self.api_rate is None else self.api_rate.try_take()
+
+    def report(self, stage: str):
+        if self.on_stage is not None:
+            self.on_stage(stage)
+
+    def encode_slot(self):
+        # Context manager holding one CPU-heavy ffmpeg slot (no-op when unlimited)
+        # Gestor de contexto que reserva un espacio de ffmpeg pesado (sin efecto si no hay límite)
+        return self.encode_slots if self.encode_slots is not None else nullcontext()
+
+
+# Context for the classic single-job layout (Code/.work)
+# Contexto para el esquema clásico de un solo trabajo (Code/.work)
+def default_context() -> JobContext:
+    return JobContext(workdir).ensure()
+
@@ -3,117 +3,437 @@
 # English: Google Veo API integration for AI video generation from images and prompts
 # Español: Integración de API de Google Veo para generación de videos IA desde imágenes y prompts
 
+import hashlib
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from config import workdir
+from config import VEO_MAX_IN_FLIGHT, VEO_BACKEND, NORMALIZE_JOBS, JobContext, default_context
+from policy import PollSchedule, RetryPolicy, CircuitBreaker
+from clip_cache import ClipCache, clip_key, default_clip_cache, link_or_copy
+from veo_backend import VeoBackend, GenaiBackend, FakeVeoBackend
+from probe import quick_check
+from kenburns import render_placeholder
 
-# API key setup - get from environment variable only
-# Configuración de clave API - obtener solo de variable de entorno
-API_KEY = os.getenv("GOOGLE_API_KEY")
+_client = None
+_client_lock = threading.Lock()
 
 
-
-# Only import and initialize if API key is set
-# Solo importar e inicializar si la clave API está configurada
-if API_KEY:
-    try:
-        from google import genai
-        from google.genai import types
-        # Set the API key as environment variable for the client
-        # Establecer la clave API como variable de entorno para el cliente
-        import os
-        os.environ['GOOGLE_API_KEY'] = API_KEY
+# Creates the Google GenAI client on first use and reuses it (None without a key or the library)
+# Crea el cliente de Google GenAI en el primer uso y lo reutiliza (None sin clave o sin la librería)
+def get_client():
+    """
+    Importing google_api is cheap: google-genai is only imported, and the
+    client only built, when a generation actually needs it. The key is read
+    from GOOGLE_API_KEY at that moment and passed to the client directly.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            return _client
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            print("API key not set - Google AI features disabled/ Clave API no configurada - funciones de Google AI deshabilitadas")
+            print("Please set GOOGLE_API_KEY environment variable/ Por favor configure la variable de entorno GOOGLE_API_KEY")
+            return None
+        try:
+            from google import genai
+        except ImportError:
+            print("Google AI libraries not installed/ Librerías de Google AI no instaladas. Install with: pip install google-genai")
+            return None
         # Initialize Google GenAI client
         # Inicializar cliente de Google GenAI
-        client = genai.Client()
+        _client = genai.Client(api_key=api_key)
         print("API key loaded/ Clave API cargada: yes")
-    except ImportError:
-        print("Google AI libraries not installed/ Librerías de Google AI no instaladas. Install with: pip install google-genai")
-        client = None
-else:
-    print("API key not set - Google AI features disabled/ Clave API no configurada - funciones de Google AI deshabilitadas")
-    print("Please set GOOGLE_API_KEY environment variable/ Por favor configure la variable de entorno GOOGLE_API_KEY")
-    client = None
+        return _client
+
+
+# Model and output settings shared by every Veo request
+# Modelo y configuraciones de salida compartidos por cada solicitud Veo
+VEO_MODEL = "veo-3.1-fast-generate-preview"
+VEO_CONFIG = {"aspect_ratio": "16:9", "resolution": "720p"}
+
+
+class ClipDownloadError(RuntimeError):
+    """A generated clip arrived truncated or damaged; the download is worth retrying."""
+
+    status = "DATA_LOSS"
+
+
+_fake_backend = None
+
+
+# Backend used when the job context doesn't bring its own (VEO_BACKEND selects it)
+# Backend usado cuando el contexto del trabajo no trae uno propio (VEO_BACKEND lo selecciona)
+def default_backend():
+    global _fake_backend
+    if VEO_BACKEND == "fake":
+        if _fake_backend is None:
+            _fake_backend = FakeVeoBackend()
+        return _fake_backend
+    client = get_client()
+    return GenaiBackend(client, os.getenv("GOOGLE_API_KEY")) if client is not None else None
 
+# Downloads the clip from a finished operation and saves it as AIvideo{index}.mp4
+# Descarga el clip de una operación terminada y lo guarda como AIvideo{index}.mp4
+def _save_generated_video(operation, index: int, ctx: JobContext, backend: VeoBackend) -> Path:
+    # Check if video generation was successful
+    # Verificar si la generación de video fue exitosa
+    if operation.error:
+        raise RuntimeError(f"Veo operation failed: {operation.error}")
+    if not operation.response or not operation.response.generated_videos:
+        raise RuntimeError("No video was generated. This might be due to safety filters or content policy.")
+
+    # Get the generated video
+    # Obtener el video generado
+    generated_video = operation.response.generated_videos[0]
+
+    # Stream the clip to a temp file, verify it, then rename it into place
+    # Descargar el clip por partes a un archivo temporal, verificarlo y luego renombrarlo
+    print(f"Downloading video {index}/ Descargando video {index}")
+    out = ctx.clip(index)
+    tmp = out.with_name(f".{out.name}.{os.getpid()}.{threading.get_ident()}.part")
+    chunks, size, sha256 = backend.stream(generated_video.video)
+    digest, written = hashlib.sha256(), 0
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                written += len(chunk)
+                ctx.metrics.add_bytes(len(chunk), "veo")
+        if size is not None and written != size:
+            problem = f"{written} of {size} bytes"
+        elif sha256 and digest.hexdigest() != sha256.lower():
+            problem = "checksum mismatch"
+        else:
+            problem = quick_check(tmp)
+        if problem:
+            raise ClipDownloadError(f"Clip {index} download is damaged ({problem})")
+        # os.replace swaps the directory entry, so a cache hardlink at `out` is never written through
+        # os.replace cambia la entrada del directorio, así que un enlace de caché en `out` nunca se sobrescribe
+        os.replace(tmp, out)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    print(f"AI video saved/ Video IA guardado: {out}")
+    return out
+
+# Creates a black placeholder clip (job profile canvas) for an index whose generation failed
+# Crea un clip negro (lienzo del perfil del trabajo) para un índice cuya generación falló
+def _create_dummy_video(index: int, ctx: JobContext) -> Path:
+    return render_placeholder(ctx.clip(index), ctx)
 
 # Generates AI video using Google Veo API with fallback to dummy video on failure
 # Genera video IA usando la API de Google Veo con respaldo a video ficticio en caso de fallo
-def calling_veo(prompt: str, image_path: str, index: int) -> Path:
+def calling_veo(prompt: str, image_path: str, index: int, ctx: JobContext = None) -> Path:
     """
     Generate AI video using Google Veo API.
     Returns the path to the generated video file.
     """
+    # Single-image convenience wrapper around the concurrent engine
+    # Envoltorio de conveniencia para una imagen sobre el motor concurrente
+    results, _ = generate_all([(prompt, image_path, index)], max_in_flight=1, ctx=ctx)
+    return results[index]
+
+
+_GRPC_STATUS = {4: "DEADLINE_EXCEEDED", 8: "RESOURCE_EXHAUSTED", 10: "ABORTED", 13: "INTERNAL", 14: "UNAVAILABLE",
+                15: "DATA_LOSS"}
+
+
+class _OperationError(RuntimeError):
+    """Wraps the error payload of a failed Veo operation so policies can inspect it."""
+
+    def __init__(self, error):
+        payload = error if isinstance(error, dict) else {}
+        self.code = payload.get("code")
+        # Operation errors carry gRPC codes (8 = RESOURCE_EXHAUSTED, 14 = UNAVAILABLE, ...)
+        # Los errores de operación traen códigos gRPC (8 = RESOURCE_EXHAUSTED, 14 = UNAVAILABLE, ...)
+        self.status = payload.get("status") or _GRPC_STATUS.get(self.code)
+        super().__init__(f"Veo operation failed: {error}")
+
+
+# Submits every Veo generation up front and polls all of them from one scheduler loop
+# Envía todas las generaciones Veo desde el inicio y las consulta desde un solo ciclo planificador
+def generate_all(jobs: list[tuple[str, str, int]], max_in_flight: int = VEO_MAX_IN_FLIGHT,
+                 poll: PollSchedule = None, retry: RetryPolicy = None, breaker: CircuitBreaker = None,
+                 cache: ClipCache = None, ctx: JobContext = None, fallback=None, backend: VeoBackend = None,
+                 on_clip=None):
+    """
+    Run many Veo generations concurrently.
+
+    jobs is a list of (prompt, image_path, index). At most max_in_flight
+    operations are pending at once; the rest wait in a queue.
+    poll / retry / breaker plug in the polling, backoff and quota policies
+    (see policy.py); defaults are used when omitted.
+    Identical (image, prompt) pairs within the job are generated once and
+    reused. cache (see clip_cache.py) also serves clips whose inputs were
+    already generated; cache hits never call the API. Defaults to the
+    configured cache unless ctx.use_clip_cache is False.
+    ctx selects the job work directory; its api_slots (when set) cap the
+    operations in flight across every job sharing them and its api_rate
+    token bucket spaces out generate_videos calls; its breaker (when set) is
+    shared by every job so they all pause on quota errors.
+    fallback(index) -> Path renders a replacement clip on a worker thread when
+    generation fails (e.g. the local Ken Burns engine); without it, or if it
+    fails, a black dummy clip is used. Duplicates of a failed image reuse
+    that replacement. With a fallback and no API client, every image goes
+    straight to the fallback.
+    backend (see veo_backend.py) is the Veo provider; defaults to ctx.backend,
+    then default_backend() (the GenAI client, or the local fake when
+    VEO_BACKEND=fake).
+    on_clip(index, path) is called as soon as each clip is ready (cache hit,
+    generated, fallback or dummy), so post-processing can overlap generation.
+    Returns (results, failures): results maps index -> AIvideo{index}.mp4
+    (a fallback clip when generation failed) and failures maps index -> error text.
+    """
     # Main function to generate AI videos using Google Veo API
     # Función principal para generar videos IA usando la API de Google Veo
-    if client is None:
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be >= 1")
+    poll = poll or PollSchedule()
+    retry = retry or RetryPolicy()
+    ctx = ctx or default_context()
+    breaker = breaker or ctx.breaker or CircuitBreaker()
+    if cache is None and ctx.use_clip_cache:
+        cache = default_clip_cache(ctx.cache_root)
+    backend = backend or ctx.backend
+
+    # Validate inputs before spending any API quota
+    # Validar entradas antes de gastar cuota de la API
+    for _, image_path, _ in jobs:
+        p = Path(image_path)
+        if not p.exists():
+            raise FileNotFoundError(f"Image not found: {p}")
+
+    results = {}     # index -> Path
+    failures = {}    # index -> error message
+
+    def _ready(index: int, path: Path):
+        # Record a finished clip and hand it to on_clip right away
+        # Registrar un clip terminado y entregarlo a on_clip de inmediato
+        results[index] = path
+        if on_clip is not None:
+            on_clip(index, path)
+    keys = {}        # leader index -> cache key
+    followers = {}   # leader index -> [duplicate indexes]
+
+    # Collapse duplicate inputs (cache or not) and serve cache hits before touching the API
+    # Agrupar entradas duplicadas (con o sin caché) y servir aciertos de caché antes de usar la API
+    queue = []       # [prompt, index, failed_attempts, not_before]
+    leaders = {}     # clip key -> leader index
+    for prompt, image_path, index in jobs:
+        key = clip_key(image_path, prompt, VEO_MODEL, VEO_CONFIG)
+        if key in leaders:
+            followers[leaders[key]].append(index)
+            continue
+        leaders[key] = index
+        followers[index] = []
+        hit = cache.materialize(key, ctx.clip(index)) if cache is not None else None
+        if hit is not None:
+            print(f"Clip cache hit/ Acierto de caché de clip: {hit}")
+            _ready(index, hit)
+            continue
+        keys[index] = key
+        queue.append([prompt, index, 0, 0.0])
+
+    # The default backend (and with it the API client) is only built when something is left to generate
+    # El backend por defecto (y con él el cliente de la API) solo se crea si queda algo por generar
+    if queue and backend is None:
+        backend = default_backend()
+    if queue and backend is None and fallback is None:
         raise RuntimeError("Google API client not initialized. Set your API key in google_api.py")
-    
-    # Validate inputs
-    # Validar entradas
-    p = Path(image_path)
-    if not p.exists():
-        raise FileNotFoundError(f"Image not found: {p}")
+
+    # Seconds each index spent queued vs. generating (for ctx.metrics)
+    # Segundos que cada índice pasó en cola vs. generando (para ctx.metrics)
+    start = time.monotonic()
+    timing = {index: {"queued_at": start, "queue": 0.0, "generation": 0.0, "submits": 0} for _, index, _, _ in queue}
+
+    # Pending operations: index -> {"op", "prompt", "attempts", "interval", "next_poll", "errors"}
+    # Operaciones pendientes: índice -> {"op", "prompt", "attempts", "interval", "next_poll", "errors"}
+    in_flight = {}
+
+    # Fallback renders run on workers so the loop keeps polling the other operations meanwhile
+    # Los respaldos se renderizan en hilos para que el ciclo siga consultando las demás operaciones
+    fallback_pool = ThreadPoolExecutor(max_workers=NORMALIZE_JOBS)
+    fallback_work = []
+
+    def _render_fallback(index: int, err):
+        # Render a local clip (or a dummy) for a failed index
+        # Renderizar un clip local (o ficticio) para un índice fallido
+        if fallback is not None:
+            print(f"API call failed - rendering local clip/ Llamada API falló - renderizando clip local ({index}): {err}")
+            try:
+                _ready(index, fallback(index))
+                return
+            except (RuntimeError, OSError) as e:
+                print(f"Local fallback failed/ Respaldo local falló ({index}): {e}")
+        print(f"API call failed - creating dummy video/ Llamada API falló - creando video ficticio ({index}): {err}")
+        _ready(index, _create_dummy_video(index, ctx))
+
+    def _fail(index: int, err):
+        # Record the failure and queue its replacement clip
+        # Registrar el fallo y encolar su clip de reemplazo
+        failures[index] = str(err)
+        fallback_work.append(fallback_pool.submit(_render_fallback, index, err))
+
+    def _retry_or_fail(prompt: str, index: int, attempts: int, err: Exception):
+        # Requeue transient errors with jittered backoff, otherwise give up
+        # Reencolar errores temporales con espera aleatoria, si no rendirse
+        breaker.record_failure(err)
+        attempts += 1
+        if retry.should_retry(err, attempts):
+            wait = retry.delay(attempts)
+            print(f"Transient API error, retrying image {index} in {wait:.1f}s/ Error temporal de API, reintentando imagen {index} en {wait:.1f}s: {err}")
+            queue.append([prompt, index, attempts, time.monotonic() + wait])
+            timing[index]["queued_at"] = time.monotonic()
+        else:
+            _fail(index, err)
+
+    def _release_slot(pend: dict):
+        # Give back the shared API slot exactly once per operation
+        # Devolver el espacio de API compartido exactamente una vez por operación
+        if pend["slot"]:
+            pend["slot"] = False
+            ctx.release_api()
+            timing[pend["index"]]["generation"] += time.monotonic() - pend["submitted"]
 
     try:
-        print(f"Generating video for image {index}/ Generando video para imagen {index}")
-        
-        # Use the correct Veo API call based on your template
-        # Usar la llamada correcta de API Veo basada en tu plantilla
-        operation = client.models.generate_videos(
-            model="veo-3.1-fast-generate-preview",
-            prompt=prompt,
-            config=types.GenerateVideosConfig(
-                aspect_ratio="16:9",
-                resolution="720p",
-            ),
-        )
-
-        # Wait for the video to be generated
-        # Esperar a que el video sea generado
-        print("Waiting for video generation/ Esperando generación de video")
-        while not operation.done:
-            # Poll every 20 seconds for completion status
-            # Consultar cada 20 segundos el estado de finalización
-            time.sleep(20)
-            operation = client.operations.get(operation)
-            print(f"Generation status/ Estado de generación: {operation}")
-
-        # Check if video generation was successful
-        # Verificar si la generación de video fue exitosa
-        if not operation.response.generated_videos:
-            raise RuntimeError("No video was generated. This might be due to safety filters or content policy.")
-        
-        # Get the generated video
-        # Obtener el video generado
-        generated_video = operation.response.generated_videos[0]
-        
-        # Download the video file
-        # Descargar el archivo de video
-        print("Downloading video/ Descargando video")
-        video_bytes = client.files.download(file=generated_video.video)
-        
-        # Save to workdir
-        # Guardar en directorio de trabajo
-        out = workdir / f"AIvideo{index}.mp4"
-        with open(out, "wb") as f:
-            f.write(video_bytes)
-
-        print(f"AI video saved/ Video IA guardado: {out}")
-        return out
-        
-    except Exception as e:
-        print(f"API call failed - creating dummy video/ Llamada API falló - creando video ficticio: {e}")
-        # Fallback: create dummy video
-        # Respaldo: crear video dummy
-        out = workdir / f"AIvideo{index}.mp4"
-        import subprocess
-        # Generate 2-second black video as fallback
-        # Generar video negro de 2 segundos como respaldo
-        cmd = [
-            "ffmpeg", "-y", "-f", "lavfi", "-i", "color=black:size=1920x1080:duration=2",
-            "-c:v", "libx264", "-preset", "fast", str(out)
-        ]
-        subprocess.run(cmd, check=True, capture_output=True)
-        print(f"Dummy video created/ Video ficticio creado: {out}")
-        return out
\ No newline at end of file
+        if backend is None and queue:
+            # No API client: skip the scheduler and use the fallback for everything
+            # Sin cliente de API: omitir el planificador y usar el respaldo para todo
+            for _, index, _, _ in queue:
+                _fail(index, "Google API client not initialized")
+            queue.clear()
+
+        while queue or in_flight:
+            now = time.monotonic()
+
+            # Stop waiting on a circuit that has been open too long
+            # Dejar de esperar un circuito que lleva abierto demasiado tiempo
+            if queue and breaker.exhausted():
+                for _, index, _, _ in queue:
+                    _fail(index, "API quota exhausted")
+                queue.clear()
+
+            # Fill free slots with ready submissions while the breaker allows it
+            # Llenar espacios libres con solicitudes listas mientras el cortacircuitos lo permita
+            waiting_for_slot = False
+            rate_wait = 0.0
+            for job in [j for j in queue if j[3] <= now]:
+                if len(in_flight) >= max_in_flight:
+                    break
+                if not ctx.try_acquire_api():
+                    # Another job holds every shared API slot; check again shortly
+                    # Otro trabajo tiene todos los espacios de API compartidos; revisar en breve
+                    waiting_for_slot = True
+                    break
+                # Breaker first: a refused request must not spend a token of the bucket shared by every job
+                # Primero el cortacircuitos: una solicitud rechazada no debe gastar una ficha del cubo compartido
+                if not breaker.allow_request():
+                    ctx.release_api()
+                    break
+                rate_wait = ctx.take_api_token()
+                if rate_wait > 0:
+                    # Shared generate_videos rate limit reached; wait for the next token
+                    # Límite compartido de llamadas generate_videos alcanzado; esperar la próxima ficha
+                    breaker.cancel_request()
+                    ctx.release_api()
+                    break
+                queue.remove(job)
+                prompt, index, attempts, _ = job
+                timing[index]["queue"] += time.monotonic() - timing[index]["queued_at"]
+                try:
+                    print(f"Generating video for image {index}/ Generando video para imagen {index}")
+                    submitted = time.monotonic()
+                    timing[index]["submits"] += 1
+                    operation = backend.submit(prompt, VEO_MODEL, VEO_CONFIG)
+                    breaker.record_success()
+                    interval = poll.first()
+                    in_flight[index] = {"op": operation, "prompt": prompt, "attempts": attempts, "slot": True,
+                                        "interval": interval, "next_poll": time.monotonic() + interval, "errors": 0,
+                                        "index": index, "submitted": submitted}
+                except Exception as e:
+                    ctx.release_api()
+                    _retry_or_fail(prompt, index, attempts, e)
+
+            # Refresh operations whose poll time has come
+            # Actualizar operaciones cuyo tiempo de consulta ha llegado
+            now = time.monotonic()
+            for index, pend in list(in_flight.items()):
+                if pend["next_poll"] > now:
+                    continue
+                try:
+                    operation = pend["op"]
+                    if not operation.done:
+                        operation = backend.refresh(operation)
+                        pend["op"] = operation
+                    if not operation.done:
+                        pend["interval"] = poll.next(pend["interval"])
+                        pend["next_poll"] = time.monotonic() + pend["interval"]
+                        continue
+                    if operation.error:
+                        # The generation itself failed: resubmit if the error is temporary
+                        # La generación en sí falló: reenviar si el error es temporal
+                        del in_flight[index]
+                        _release_slot(pend)
+                        _retry_or_fail(pend["prompt"], index, pend["attempts"], _OperationError(operation.error))
+                        continue
+                    # Generation is over: free the shared slot before the download
+                    # La generación terminó: liberar el espacio compartido antes de la descarga
+                    _release_slot(pend)
+                    clip = _save_generated_video(operation, index, ctx, backend)
+                    del in_flight[index]
+                    if cache is not None:
+                        try:
+                            cache.put(keys[index], clip)
+                        except OSError as e:
+                            print(f"Clip cache write failed/ Fallo al escribir caché de clip: {e}")
+                    _ready(index, clip)
+                except Exception as e:
+                    # Polling / download hiccup: retry the same operation, don't resubmit
+                    # Fallo de consulta / descarga: reintentar la misma operación, sin reenviar
+                    pend["errors"] += 1
+                    if retry.should_retry(e, pend["errors"]):
+                        pend["next_poll"] = time.monotonic() + retry.delay(pend["errors"])
+                    else:
+                        del in_flight[index]
+                        _release_slot(pend)
+                        _fail(index, e)
+
+            # Sleep until the next poll, retry or breaker reset is due
+            # Dormir hasta la próxima consulta, reintento o reapertura del cortacircuitos
+            wake_times = [p["next_poll"] for p in in_flight.values()]
+            if queue and len(in_flight) < max_in_flight:
+                next_ready = min(j[3] for j in queue)
+                reopen = breaker.retry_at()
+                if waiting_for_slot:
+                    next_ready = max(next_ready, time.monotonic() + 1.0)
+                if rate_wait > 0:
+                    next_ready = max(next_ready, time.monotonic() + rate_wait)
+                wake_times.append(next_ready if reopen is None else max(next_ready, reopen))
+            if wake_times:
+                time.sleep(max(0.0, min(wake_times) - time.monotonic()))
+    finally:
+        fallback_pool.shutdown(wait=True)
+    for work in fallback_work:
+        work.result()
+
+    for index, t in timing.items():
+        if t["submits"]:
+            ctx.metrics.record_veo(index, t["queue"], t["generation"], t["submits"])
+
+    # Fan each leader's clip (generated or fallback) out to its duplicates
+    # Repartir el clip de cada líder (generado o de respaldo) a sus duplicados
+    for leader, dupes in followers.items():
+        for index in dupes:
+            if leader in failures:
+                failures[index] = failures[leader]
+            dst = ctx.clip(index)
+            link_or_copy(results[leader], dst)
+            print(f"Reused clip {leader} for image {index}/ Clip {leader} reutilizado para imagen {index}")
+            _ready(index, dst)
+
+    return results, failures
+
@@ -0,0 +1,134 @@
+# kenburns.py
+# Samuel Angarita
+# English: Offline Ken Burns motion engine - renders zoom_in / zoom_out / pan clips from a still image with ffmpeg
+# Español: Motor de movimiento Ken Burns sin conexión - renderiza clips zoom_in / zoom_out / pan desde una imagen fija con ffmpeg
+
+import subprocess
+from pathlib import Path
+
+from config import JobContext, default_context
+from metrics import run_ffmpeg
+from profiles import get_profile
+
+# Output matches what we request from Veo (16:9, 720p) and the prompt timing (4 s at 24 fps)
+# La salida coincide con lo que pedimos a Veo (16:9, 720p) y el tiempo del prompt (4 s a 24 fps)
+MOTION_W       = 1280
+MOTION_H       = 720
+MOTION_FPS     = 24
+MOTION_SECONDS = 4
+MOTION_AR      = 48000  # silent audio track so clips concat like Veo clips
+
+# Oversampling before zoompan avoids the integer-rounding jitter of small crops
+# Sobremuestrear antes de zoompan evita la vibración por redondeo de recortes pequeños
+OVERSAMPLE = 4
+
+TRANSITIONS = ("zoom_in", "zoom_out", "pan")
+
+# Length of the black placeholder used when neither Veo nor the motion engine produced a clip
+# Duración del marcador negro usado cuando ni Veo ni el motor de movimiento produjeron un clip
+PLACEHOLDER_SECONDS = 2
+
+
+# Builds the zoompan expressions for one transition (same moves as prompt.get_prompt)
+# Construye las expresiones de zoompan para una transición (mismos movimientos que prompt.get_prompt)
+def _zoompan(transition: str, frames: int) -> str:
+    # ease-in-out progress 0 -> 1 over the clip
+    # progreso ease-in-out de 0 -> 1 durante el clip
+    ease = f"(1-cos(PI*on/{frames - 1}))/2"
+    center_x = "iw/2-(iw/zoom/2)"
+    center_y = "ih/2-(ih/zoom/2)"
+    if transition == "zoom_in":
+        # 100% -> 130%
+        z, x, y = f"1+0.3*{ease}", center_x, center_y
+    elif transition == "zoom_out":
+        # 120% -> 100%
+        z, x, y = f"1.2-0.2*{ease}", center_x, center_y
+    elif transition == "pan":
+        # Left to right across ~12% of the visible frame width
+        # De izquierda a derecha a lo largo de ~12% del ancho visible
+        z, x, y = "1.12", f"(iw-iw/zoom)*{ease}", center_y
+    else:
+        raise SystemExit(f"Error: unknown command '{transition}'. Allowed: zoom_in, zoom_out, pan")
+    return (f"zoompan=z='{z}':x='{x}':y='{y}':d={frames}"
+            f":s={MOTION_W}x{MOTION_H}:fps={MOTION_FPS}")
+
+
+# Renders a Ken Burns clip for `transition` from a still image
+# Renderiza un clip Ken Burns para `transition` desde una imagen fija
+def render_motion(image_path, transition: str, out: Path, ctx: JobContext = None) -> Path:
+    """
+    Render `transition` (zoom_in, zoom_out, pan) from image_path into out:
+    1280x720, 24 fps, 4 s, H.264 yuv420p with a silent AAC track.
+    No API round trip; takes a few seconds on one core.
+    """
+    ctx = ctx or default_context()
+    image_path = Path(image_path)
+    if not image_path.exists():
+        raise FileNotFoundError(f"Image not found: {image_path}")
+
+    frames = MOTION_FPS * MOTION_SECONDS
+    big_w, big_h = MOTION_W * OVERSAMPLE, MOTION_H * OVERSAMPLE
+    vf = (
+        f"scale={big_w}:{big_h}:force_original_aspect_ratio=increase,"
+        f"crop={big_w}:{big_h},setsar=1,"
+        f"{_zoompan(transition, frames)},format=yuv420p"
+    )
+    out = Path(out)
+    out.unlink(missing_ok=True)  # never write through a hardlink into the clip cache
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-hide_banner", "-loglevel", "error",
+        "-i", str(image_path),
+        "-f", "lavfi", "-i", f"anullsrc=r={MOTION_AR}:cl=stereo",
+        "-vf", vf,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-frames:v", str(frames),
+        "-t", str(MOTION_SECONDS),
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "20",
+        "-c:a", "aac", "-ar", str(MOTION_AR), "-ac", "2",
+        str(out),
+    ]
+    with ctx.encode_slot():
+        try:
+            run_ffmpeg(cmd, ctx.metrics, f"kenburns:{out.name}")
+        except subprocess.CalledProcessError as e:
+            err = (e.stderr or "").strip().splitlines()[-1:]
+            hint = f" ({err[0]})" if err else ""
+            raise RuntimeError(f"Ken Burns render failed for {image_path.name}{hint}") from e
+    print(f"Local motion clip rendered/ Clip de movimiento local renderizado: {out}")
+    return out
+
+
+# Renders a black placeholder clip at the job profile's canvas and frame rate
+# Renderiza un clip negro de marcador con el lienzo y la frecuencia de cuadros del perfil del trabajo
+def render_placeholder(out: Path, ctx: JobContext = None) -> Path:
+    """
+    PLACEHOLDER_SECONDS of black video with a silent AAC track, encoded with
+    the job profile's x264 settings so it concats like a normalized clip.
+    """
+    ctx = ctx or default_context()
+    profile = get_profile(ctx.profile)
+    out = Path(out)
+    out.unlink(missing_ok=True)  # never write through a hardlink into the clip cache
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"color=black:size={profile.width}x{profile.height}:rate={profile.fps}",
+        "-f", "lavfi", "-i", f"anullsrc=r={MOTION_AR}:cl=stereo",
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-t", str(PLACEHOLDER_SECONDS),
+        *profile.video_args(), "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-ar", str(MOTION_AR), "-ac", "2",
+        str(out),
+    ]
+    with ctx.encode_slot():
+        try:
+            run_ffmpeg(cmd, ctx.metrics, f"placeholder:{out.name}")
+        except subprocess.CalledProcessError as e:
+            err = (e.stderr or "").strip().splitlines()[-1:]
+            hint = f" ({err[0]})" if err else ""
+            raise RuntimeError(f"Placeholder render failed for {out.name}{hint}") from e
+    print(f"Dummy video created/ Video ficticio creado: {out}")
+    return out
@@ -4,55 +4,206 @@
 # Español: Orquestador principal del pipeline para creación de videos IA desde imágenes, prompts y música
 
 import json
-from config import PROJECT_ROOT, workdir
-from read import download_image, download_song
-from google_api import calling_veo
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from config import (RENDER_MODE, NORMALIZE_JOBS, MOTION_ENGINE, MOTION_ENGINES, MOTION_FALLBACK,
+                    DOWNLOAD_JOBS, CROSSFADE_SECONDS, INTERMEDIATE_FORMAT, INTERMEDIATE_FORMATS, METRICS_TEXTFILE_DIR,
+                    MUSIC_LOUDNORM, RENDITIONS, HLS_SEGMENT_SECONDS, JobContext, default_context)
+from read import download_image, download_song, image_decoder
+from google_api import generate_all, VEO_MODEL, VEO_CONFIG
 from prompt import get_prompt
-from combine import ensure_ffmpeg_available, create_txt, combine_videos, add_music
+from combine import (ensure_ffmpeg_available, create_txt, prepare_clips, concat_clips, add_music,
+                     render_single_pass, prepare_music, crossfade_clips, can_stream_copy, finalize_video,
+                     render_ladder, OverlapNormalizer, TARGET_AR, TARGET_AC)
+from kenburns import render_motion
+from profiles import get_profile, parse_ladder
+from stages import Manifest, StageIncomplete, run_stage
+from probe import flush as flush_probes
+
+
+# Downloads every image and the music track
+# Descarga todas las imágenes y la pista de música
+def _download_stage(data: dict, ctx: JobContext) -> list[Path]:
+    # Music and images download concurrently; image decoding runs in worker processes
+    # La música y las imágenes se descargan en paralelo; la decodificación corre en procesos aparte
+    urls = [img["url"] for img in data["images"]]
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_JOBS) as fetchers, image_decoder(len(urls)) as decoder:
+        # Download background music from URL (the largest file, so it starts first)
+        # Descargar música de fondo desde URL (el archivo más grande, así que empieza primero)
+        print("Downloading music/ Descargando música")
+        music = fetchers.submit(download_song, data["music"]["url"], ctx)
+        # Download all images from URLs specified in input.json
+        # Descargar todas las imágenes desde URLs especificadas en input.json
+        images = []
+        for i, url in enumerate(urls, start=1):  # start=1 so it matches downloaded_image1.jpg, ...
+            print(f"Downloading image {i}/ Descargando imagen {i}")
+            images.append(fetchers.submit(download_image, url, i, ctx, decoder))
+        return [f.result() for f in images] + [music.result()]
+
+# Generates every clip (Veo or local Ken Burns); incomplete when any Veo image needed a fallback
+# Genera todos los clips (Veo o Ken Burns local); incompleta cuando alguna imagen Veo usó un respaldo
+def _generate_stage(jobs: list, transitions: dict, engines: dict, ctx: JobContext,
+                    normalizer: OverlapNormalizer = None) -> list[Path]:
+    # With a normalizer, every clip is handed over for normalizing the moment it is ready
+    # Con un normalizador, cada clip se entrega para normalizar en cuanto está listo
+    on_clip = normalizer.submit if normalizer is not None else None
+
+    def _local(index: int) -> Path:
+        return render_motion(ctx.image(index), transitions[index], ctx.clip(index), ctx)
+
+    def _local_ready(index: int) -> Path:
+        clip = _local(index)
+        if on_clip is not None:
+            on_clip(index, clip)
+        return clip
+
+    # Images assigned to the local engine never touch the API; they render while Veo works
+    # Las imágenes asignadas al motor local nunca usan la API; se renderizan mientras Veo trabaja
+    local = [y for y, engine in engines.items() if engine == "local"]
+    results, failures = {}, {}
+    veo_jobs = [job for job in jobs if engines[job[2]] == "veo"]
+    try:
+        with ThreadPoolExecutor(max_workers=NORMALIZE_JOBS) as pool:
+            pending = {y: pool.submit(_local_ready, y) for y in local}
+            if veo_jobs:
+                fallback = _local if MOTION_FALLBACK == "local" else None
+                try:
+                    veo_results, failures = generate_all(veo_jobs, ctx=ctx, fallback=fallback, on_clip=on_clip)
+                    results.update(veo_results)
+                except (TimeoutError, RuntimeError, SystemExit) as e:
+                    # Friendly, short messages only (no secrets, no long traces).
+                    # Mensajes amigables y cortos solamente (sin secretos, sin trazas largas).
+                    print(f"Video generation failed/ Fallo en generación de video: {e}")
+                    results.update({y: f.result() for y, f in pending.items()})
+                    raise StageIncomplete(list(results.values()), str(e))
+            results.update({y: f.result() for y, f in pending.items()})
+    finally:
+        if normalizer is not None:
+            normalizer.drain()
+
+    for y in sorted(results):
+        if y in failures:
+            print(f"Video generation failed/ Fallo en generación de video ({y}): {failures[y]}")
+        else:
+            print(f"Video generated successfully/ Video generado exitosamente: {results[y]}")
+    outputs = [results[y] for y in sorted(results)]
+    if failures:
+        raise StageIncomplete(outputs, f"{len(failures)} clip(s) used a fallback")
+    return outputs
+
+# Remuxes the merged video to Final.mp4 or replaces its audio with the music track
+# Remuxa el video fusionado a Final.mp4 o reemplaza su audio con la pista de música
+def _mux_stage(music_enabled: bool, ctx: JobContext) -> list[Path]:
+    # Add background music to the merged video (if enabled)
+    # Agregar música de fondo al video fusionado (si está habilitado)
+    if music_enabled:
+        print("Adding background music/ Añadiendo música de fondo")
+        return [add_music(ctx)]
+
+    print("Music disabled - finalizing video/ Música deshabilitada - finalizando video")
+    return [finalize_video(ctx)]
+
+
+# Reports the stage to the job context (progress hooks) and runs it through the manifest
+# Reporta la etapa al contexto del trabajo (ganchos de progreso) y la ejecuta con el manifiesto
+def _stage(manifest: Manifest, ctx: JobContext, name: str, inputs, fn) -> list[Path]:
+    ctx.report(name)
+    try:
+        with ctx.metrics.stage(name):
+            return run_stage(manifest, name, inputs, fn)
+    finally:
+        # One write of the persistent ffprobe cache per stage, not one per probed file
+        # Una escritura de la caché persistente de ffprobe por etapa, no una por archivo
+        flush_probes()
+
+# Writes the run report (metrics.json) and Prometheus text file (metrics.prom) for the job
+# Escribe el reporte de ejecución (metrics.json) y el archivo de texto Prometheus (metrics.prom) del trabajo
+def _write_metrics(ctx: JobContext):
+    try:
+        ctx.metrics.write_json(ctx.metrics_json)
+        ctx.metrics.write_prometheus(ctx.metrics_prom, job=ctx.name)
+        if METRICS_TEXTFILE_DIR is not None:
+            ctx.metrics.write_prometheus(METRICS_TEXTFILE_DIR / f"aivideo_{ctx.name}.prom", job=ctx.name)
+        print(f"Run metrics saved/ Métricas de ejecución guardadas: {ctx.metrics_json}")
+    except OSError as e:
+        print(f"Could not write metrics/ No se pudieron escribir las métricas: {e}")
 
 
 # Main pipeline function that orchestrates the entire AI video creation process
 # Función principal del pipeline que orquesta todo el proceso de creación de videos IA
-def main():
-    # Main pipeline function that orchestrates the entire video creation process
-    # Función principal del pipeline que orquesta todo el proceso de creación de video
-    # Read input.json FROM Code/.work instead of Code/
-    # Leer input.json DESDE Code/.work en lugar de Code/
-    with open(workdir / "input.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
+def main(ctx: JobContext = None) -> Path:
+    """
+    Stages: download -> generate -> music -> normalize -> concat -> mux
+    (or download -> generate -> music -> render in single-pass mode; in
+    overlap mode clips are normalized during generate as each one arrives).
+    Each stage records its input fingerprint and outputs in manifest.json;
+    a rerun skips every stage whose inputs and outputs are unchanged.
+    ctx selects the job work directory (Code/.work by default); input.json
+    is read from it and every artifact is written into it.
+    Timings are written to metrics.json / metrics.prom in the workdir,
+    also when the run fails.
+    Returns the path of Final.mp4.
+    """
+    ctx = ctx or default_context()
+    try:
+        return _run_pipeline(ctx)
+    finally:
+        _write_metrics(ctx)
 
-    # Download all images from URLs specified in input.json
-    # Descargar todas las imágenes desde URLs especificadas en input.json
-    for i, img in enumerate(data["images"]):
-        download_image(img["url"], i+1)  # +1 so it starts at 1,...
-        print(f"Downloading image {i+1}/ Descargando imagen {i+1}")
 
-    # Download background music from URL
-    # Descargar música de fondo desde URL
-    download_song(data["music"]["url"])
-    print("Downloading music/ Descargando música")
+# Runs every stage for one job (see main)
+# Ejecuta todas las etapas de un trabajo (ver main)
+def _run_pipeline(ctx: JobContext) -> Path:
+    # Read input.json FROM the job workdir (Code/.work by default) instead of Code/
+    # Leer input.json DESDE el directorio del trabajo (Code/.work por defecto) en lugar de Code/
+    with open(ctx.input_json, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    # Stage manifest lives next to the artifacts it describes
+    # El manifiesto de etapas vive junto a los artefactos que describe
+    manifest = Manifest(ctx.manifest)
+    music_enabled = bool(data["music"]["enabled"])
+    # Encode profile: input.json "profile" wins over the job default (ENCODE_PROFILE)
+    # Perfil de codificación: "profile" de input.json tiene prioridad sobre el valor del trabajo (ENCODE_PROFILE)
+    profile = get_profile(data.get("profile", ctx.profile))
+    ctx.profile = profile.name
+    # Crossfade seconds between clips: input.json "crossfade" wins over CROSSFADE_SECONDS
+    # Segundos de fundido entre clips: "crossfade" de input.json tiene prioridad sobre CROSSFADE_SECONDS
+    crossfade = float(data.get("crossfade", CROSSFADE_SECONDS))
+    if crossfade < 0:
+        raise SystemExit(f"Error: crossfade must be >= 0 seconds, got {crossfade}")
+    if INTERMEDIATE_FORMAT not in INTERMEDIATE_FORMATS:
+        raise SystemExit(f"Error: unknown INTERMEDIATE_FORMAT '{INTERMEDIATE_FORMAT}'. "
+                         f"Allowed: {', '.join(INTERMEDIATE_FORMATS)}")
+    # Output ladder (RENDITIONS), checked before any work is done
+    # Escalera de salida (RENDITIONS), verificada antes de hacer cualquier trabajo
+    ladder = parse_ladder(RENDITIONS)
+
+    _stage(manifest, ctx, "download",
+           {"images": [img["url"] for img in data["images"]], "music": data["music"]["url"]},
+           lambda: _download_stage(data, ctx))
 
-    # google_api.py calling main
-    # Llamada principal de google_api.py
+    # google_api.py calling main: submit every generation up front, poll them together
+    # Llamada principal de google_api.py: enviar todas las generaciones y consultarlas juntas
     # Start enumerate at 1 so index matches your filenames (downloaded_image1.jpg, AIvideo1.mp4, ...)
     # Comenzar enumeración en 1 para que el índice coincida con nombres de archivo (downloaded_image1.jpg, AIvideo1.mp4, ...)
-    for y, tran in enumerate(data["images"], start=1):
-        try:
-            # Use workdir for image path, not a hard-coded ".work"
-            # Usar workdir para ruta de imagen, no un ".work" codificado
-            result = calling_veo(
-                get_prompt(tran["transition"]),
-                str(workdir / f"downloaded_image{y}.jpg"),
-                y
-            )
-            print(f"Video generated successfully/ Video generado exitosamente: {result}")
-        except (TimeoutError, RuntimeError, SystemExit) as e:
-            # Friendly, short messages only (no secrets, no long traces).
-            # Mensajes amigables y cortos solamente (sin secretos, sin trazas largas).
-            print(f"Video generation failed/ Fallo en generación de video: {e}")
-
-    # Imagine AI videos have been downloaded as AIvideo1.mp4, AIvideo2.mp4, ...
-    # Imaginar que los videos IA han sido descargados como AIvideo1.mp4, AIvideo2.mp4, ...
+    jobs = [
+        (get_prompt(tran["transition"]), str(ctx.image(y)), y)
+        for y, tran in enumerate(data["images"], start=1)
+    ]
+    # Motion engine per image: "veo" (API) or "local" (Ken Burns), default from MOTION_ENGINE
+    # Motor de movimiento por imagen: "veo" (API) o "local" (Ken Burns), por defecto MOTION_ENGINE
+    transitions = {y: tran["transition"] for y, tran in enumerate(data["images"], start=1)}
+    engines = {y: tran.get("engine", MOTION_ENGINE) for y, tran in enumerate(data["images"], start=1)}
+    for y, engine in engines.items():
+        if engine not in MOTION_ENGINES:
+            raise SystemExit(f"Error: unknown engine '{engine}' for image {y}. Allowed: {', '.join(MOTION_ENGINES)}")
+    # "overlap" mode normalizes each clip as soon as it is generated, so encoding runs during the API wait
+    # El modo "overlap" normaliza cada clip en cuanto se genera, así la codificación ocurre durante la espera de la API
+    normalizer = OverlapNormalizer(ctx) if RENDER_MODE == "overlap" else None
+    _stage(manifest, ctx, "generate",
+           {"jobs": [(p, Path(img), y) for p, img, y in jobs], "model": VEO_MODEL, "config": VEO_CONFIG,
+            "engines": engines, "fallback": MOTION_FALLBACK},
+           lambda: _generate_stage(jobs, transitions, engines, ctx, normalizer))
 
     print("Starting video processing/ Iniciando procesamiento de video")
 
@@ -63,31 +214,73 @@ def main():
     # Create concatenation list file for ffmpeg
     # Crear archivo de lista de concatenación para ffmpeg
     print("Creating video list/ Creando lista de videos")
-    create_txt(len(data["images"]))  # example: builds mylist for N files AIvideo1/2/3.mp4
+    clips = create_txt(len(data["images"]), ctx, [transitions[y] for y in sorted(transitions)])  # example: builds mylist for N files AIvideo1/2/3.mp4
+    target = [profile.fingerprint(), TARGET_AR, TARGET_AC]
 
-    # Concatenate all AI-generated videos into one merged video
-    # Concatenar todos los videos generados por IA en un video fusionado
-    print("Combining videos/ Combinando videos")
-    combine_videos()
+    # Transcode + loudness-normalize the track once (cached across jobs) so the mux is a stream copy
+    # Transcodificar + normalizar el volumen de la pista una vez (en caché entre trabajos) para que el mux sea una copia
+    music_input = None
+    if music_enabled:
+        try:
+            music_input = _stage(manifest, ctx, "music",
+                                 {"music": ctx.music, "bitrate": profile.audio_bitrate, "loudnorm": MUSIC_LOUDNORM},
+                                 lambda: [prepare_music(ctx)])[0]
+        except RuntimeError as e:
+            print(f"Music preparation failed - encoding it during the mux/ Preparación de música falló - se codificará en el mux: {e}")
+            ctx.music_prepared.unlink(missing_ok=True)
+            music_input = ctx.music
 
-    # Add background music to the merged video (if enabled)
-    # Agregar música de fondo al video fusionado (si está habilitado)
-    if data["music"]["enabled"]:
-        print("Adding background music/ Añadiendo música de fondo")
-        add_music()
-    else:
-        print("Music disabled - finalizing video/ Música deshabilitada - finalizando video")
-        # Rename merged.mp4 to Final.mp4 when music is disabled
-        # Renombrar merged.mp4 a Final.mp4 cuando la música está deshabilitada
-        import shutil
-        from pathlib import Path
-        merged_path = workdir / "merged.mp4"
-        final_path = workdir / "Final.mp4"
-        if merged_path.exists():
-            shutil.move(str(merged_path), str(final_path))
-            print(f"Final video saved/ Video final guardado: {final_path}")
+    # Clips that must be re-encoded anyway: normalize, concat and mux in a single ffmpeg pass
+    # Clips que deben re-codificarse de todos modos: normalizar, concatenar y mezclar en una sola pasada
+    # (matching clips take the step-by-step path, which joins them by stream copy, and so do
+    # crossfades, where only the overlaps are re-encoded)
+    # (los clips que coinciden usan la ruta por pasos, que los une por copia, y también los
+    # fundidos, donde solo se re-codifican los solapamientos)
+    rendered = False
+    if RENDER_MODE == "single" and not crossfade and not can_stream_copy(clips):
+        try:
+            _stage(manifest, ctx, "render",
+                   {"clips": clips, "target": target, "music": music_input},
+                   lambda: [render_single_pass(music=music_enabled, ctx=ctx)])
+            rendered = True
+        except RuntimeError as e:
+            print(f"Single-pass render failed - using step-by-step path/ Renderizado en una pasada falló - usando ruta por pasos: {e}")
+
+    # Fallback: the original multi-step path (merged video -> Final.mp4)
+    # Respaldo: la ruta original por pasos (video fusionado -> Final.mp4)
+    if not rendered:
+        if normalizer is not None:
+            prepared = _stage(manifest, ctx, "normalize", {"clips": clips, "target": target, "overlap": True},
+                              lambda: normalizer.finish(clips))
+        else:
+            prepared = _stage(manifest, ctx, "normalize", {"clips": clips, "target": target},
+                              lambda: prepare_clips(clips, ctx)[0])
+        normalized = prepared != clips
+
+        # Concatenate all AI-generated videos into one merged video
+        # Concatenar todos los videos generados por IA en un video fusionado
+        print("Combining videos/ Combinando videos")
+        if crossfade:
+            _stage(manifest, ctx, "concat", {"clips": prepared, "normalized": normalized, "crossfade": crossfade},
+                   lambda: [crossfade_clips(prepared, crossfade, normalized, ctx)])
+        else:
+            _stage(manifest, ctx, "concat", {"clips": prepared, "normalized": normalized},
+                   lambda: [concat_clips(prepared, normalized, ctx)])
+
+        _stage(manifest, ctx, "mux", {"merged": ctx.merged, "music": music_input,
+                                      "audio_bitrate": profile.audio_bitrate},
+               lambda: _mux_stage(music_enabled, ctx))
+
+    # Extra renditions (and HLS) encoded from one decode of Final.mp4
+    # Resoluciones extra (y HLS) codificadas con una sola decodificación de Final.mp4
+    if ladder:
+        _stage(manifest, ctx, "ladder", {"final": ctx.final, "ladder": [f"{r.height}:{r.maxrate}" for r in ladder],
+                                         "hls": HLS_SEGMENT_SECONDS, "profile": profile.name},
+               lambda: render_ladder(ladder, HLS_SEGMENT_SECONDS, ctx))
 
     print("Video processing complete/ Procesamiento de video completado")
+    ctx.report("done")
+    return ctx.final
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,221 @@
+# metrics.py
+# Samuel Angarita
+# English: Run instrumentation - stage and clip timings, download bytes, Veo timings and ffmpeg progress, exported as JSON and Prometheus text
+# Español: Instrumentación de ejecución - tiempos por etapa y clip, bytes descargados, tiempos Veo y progreso de ffmpeg, exportados como JSON y texto Prometheus
+
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+class RunMetrics:
+    """
+    Thread-safe collector for one pipeline run.
+      stages    name -> wall / cpu seconds (cpu counts only this job: the stage
+                thread plus the ffmpeg runs recorded here, so concurrent
+                batch / service jobs don't charge each other)
+      items     per clip / image timings, e.g. ("download", 3) -> wall / cpu
+      downloads bytes downloaded per source ("assets", "veo")
+      veo       index -> seconds queued before submit vs. seconds generating
+      encodes   one entry per ffmpeg run: wall, child cpu, fps, speed, frames
+      live      label -> latest ffmpeg progress while an encode is running
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.items = {}
+        self.downloads = {}
+        self.veo = {}
+        self.encodes = []
+        self.live = {}
+        self._encode_cpu = 0.0   # CPU seconds of every ffmpeg child recorded so far
+
+    @contextmanager
+    def stage(self, name: str):
+        # Wall and CPU time of a whole pipeline stage: thread CPU plus this job's ffmpeg children
+        # Tiempo real y de CPU de una etapa completa: CPU del hilo más los hijos ffmpeg de este trabajo
+        with self._lock:
+            encode_cpu = self._encode_cpu
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+                entry["wall"] += time.perf_counter() - wall
+                entry["cpu"] += time.thread_time() - cpu + self._encode_cpu - encode_cpu
+
+    @contextmanager
+    def item(self, kind: str, index):
+        # Wall and Python-thread CPU time of one clip / image (ffmpeg CPU is in encodes)
+        # Tiempo real y de CPU del hilo de Python para un clip / imagen (la CPU de ffmpeg está en encodes)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.items[f"{kind}:{index}"] = {"wall": time.perf_counter() - wall,
+                                                 "cpu": time.thread_time() - cpu}
+
+    def add_bytes(self, count: int, source: str = "assets"):
+        with self._lock:
+            self.downloads[source] = self.downloads.get(source, 0) + count
+
+    def record_veo(self, index: int, queued: float, generating: float, attempts: int):
+        with self._lock:
+            self.veo[index] = {"queue": queued, "generation": generating, "attempts": attempts}
+
+    def progress(self, label: str, values: dict):
+        with self._lock:
+            self.live[label] = values
+
+    def live_progress(self) -> dict:
+        with self._lock:
+            return {k: dict(v) for k, v in self.live.items()}
+
+    def record_encode(self, label: str, wall: float, cpu, values: dict):
+        with self._lock:
+            self.live.pop(label, None)
+            self.encodes.append({"label": label, "wall": wall, "cpu": cpu, **values})
+            self._encode_cpu += cpu or 0.0
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started,
+                "wall": time.time() - self.started,
+                "stages": {k: dict(v) for k, v in self.stages.items()},
+                "items": {k: dict(v) for k, v in self.items.items()},
+                "bytes_downloaded": dict(self.downloads),
+                "veo": {str(k): dict(v) for k, v in self.veo.items()},
+                "encodes": [dict(e) for e in self.encodes],
+            }
+
+    def write_json(self, path: Path):
+        _atomic_write(Path(path), json.dumps(self.to_dict(), indent=2))
+
+    def write_prometheus(self, path: Path, job: str = "default"):
+        # Text exposition format, e.g. for node_exporter's textfile collector
+        # Formato de texto de exposición, p. ej. para el textfile collector de node_exporter
+        data = self.to_dict()
+        job = job.replace("\\", "\\\\").replace('"', '\\"')
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP aivideo_{name} {help_text}")
+            lines.append(f"# TYPE aivideo_{name} gauge")
+            for labels, value in samples:
+                extra = "".join(f',{k}="{v}"' for k, v in labels.items())
+                lines.append(f'aivideo_{name}{{job="{job}"{extra}}} {value:.6g}')
+
+        metric("run_wall_seconds", "Wall time of the run", [({}, data["wall"])])
+        metric("stage_wall_seconds", "Wall time per pipeline stage",
+               [({"stage": k}, v["wall"]) for k, v in data["stages"].items()])
+        metric("stage_cpu_seconds", "CPU time per pipeline stage (stage thread and this job's ffmpeg runs)",
+               [({"stage": k}, v["cpu"]) for k, v in data["stages"].items()])
+        metric("downloaded_bytes", "Bytes downloaded per source",
+               [({"source": k}, v) for k, v in data["bytes_downloaded"].items()])
+        veo = data["veo"].values()
+        metric("veo_queue_seconds_sum", "Seconds Veo requests waited before submission",
+               [({}, sum(v["queue"] for v in veo))])
+        metric("veo_generation_seconds_sum", "Seconds from Veo submission to finished clip",
+               [({}, sum(v["generation"] for v in veo))])
+        metric("veo_clips", "Clips generated through Veo", [({}, len(data["veo"]))])
+
+        # Encodes grouped by kind (label prefix) to keep label cardinality low
+        # Codificaciones agrupadas por tipo (prefijo de la etiqueta) para limitar la cardinalidad
+        kinds = {}
+        for e in data["encodes"]:
+            k = kinds.setdefault(e["label"].split(":")[0], {"n": 0, "wall": 0.0, "cpu": 0.0, "frames": 0})
+            k["n"] += 1
+            k["wall"] += e["wall"]
+            k["cpu"] += e["cpu"] or 0.0
+            k["frames"] += e.get("frames") or 0
+        metric("encode_count", "ffmpeg runs per kind", [({"kind": k}, v["n"]) for k, v in kinds.items()])
+        metric("encode_wall_seconds", "ffmpeg wall time per kind", [({"kind": k}, v["wall"]) for k, v in kinds.items()])
+        metric("encode_cpu_seconds", "ffmpeg CPU time per kind", [({"kind": k}, v["cpu"]) for k, v in kinds.items()])
+        metric("encode_fps", "Average frames per second per kind",
+               [({"kind": k}, v["frames"] / v["wall"]) for k, v in kinds.items() if v["wall"] > 0])
+        _atomic_write(Path(path), "\n".join(lines) + "\n")
+
+
+# Writes through a temp file so readers never see a half-written report
+# Escribe mediante un archivo temporal para que nadie lea un reporte a medias
+def _atomic_write(path: Path, text: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+
+# Parses ffmpeg "-progress" values (fps=, speed=1.5x, frame=, out_time_us=)
+# Interpreta los valores de "-progress" de ffmpeg (fps=, speed=1.5x, frame=, out_time_us=)
+def _progress_values(raw: dict) -> dict:
+    values = {}
+    for key, cast in (("frame", int), ("fps", float), ("out_time_us", int)):
+        try:
+            values["frames" if key == "frame" else key] = cast(raw[key])
+        except (KeyError, ValueError):
+            pass
+    try:
+        values["speed"] = float(raw.get("speed", "").rstrip("x"))
+    except ValueError:
+        pass
+    return values
+
+
+# Runs ffmpeg like subprocess.run(check=True, capture_output=True) while recording its progress
+# Ejecuta ffmpeg como subprocess.run(check=True, capture_output=True) registrando su progreso
+def run_ffmpeg(cmd: list[str], metrics: RunMetrics = None, label: str = "ffmpeg") -> subprocess.CompletedProcess:
+    """
+    Adds "-progress pipe:1 -nostats" so ffmpeg reports frame / fps / speed on
+    stdout; each block updates metrics.live[label] and the final one is kept
+    in metrics.encodes with wall time and the child's CPU time (POSIX).
+    Raises subprocess.CalledProcessError (with stderr) on failure.
+    """
+    if metrics is None:
+        return subprocess.run(cmd, check=True, capture_output=True, text=True)
+
+    full = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+    start = time.perf_counter()
+    proc = subprocess.Popen(full, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    # Drain stderr on a side thread so a chatty ffmpeg can't block on a full pipe
+    # Vaciar stderr en un hilo aparte para que ffmpeg no se bloquee con la tubería llena
+    err_chunks = []
+    drain = threading.Thread(target=lambda: err_chunks.append(proc.stderr.read()), daemon=True)
+    drain.start()
+
+    raw, values = {}, {}
+    for line in proc.stdout:
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            continue
+        raw[key] = value.strip()
+        if key == "progress":
+            values = _progress_values(raw)
+            metrics.progress(label, values)
+    drain.join()
+
+    cpu = None
+    if hasattr(os, "wait4"):
+        # wait4 gives this child's own rusage, unlike the process-wide RUSAGE_CHILDREN
+        # wait4 da el uso de recursos de este hijo, a diferencia del RUSAGE_CHILDREN global
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        cpu = usage.ru_utime + usage.ru_stime
+    else:
+        proc.wait()
+    proc.stdout.close()
+    proc.stderr.close()
+
+    stderr = "".join(err_chunks)
+    metrics.record_encode(label, time.perf_counter() - start, cpu, values)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output="", stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, "", stderr)
@@ -0,0 +1,236 @@
+# policy.py
+# Samuel Angarita
+# English: Polling, retry and circuit-breaker policies for long-running Veo operations
+# Español: Políticas de consulta, reintento y cortacircuitos para operaciones Veo de larga duración
+
+import random
+import threading
+import time
+
+
+# HTTP status codes and API status names treated as temporary
+# Códigos HTTP y nombres de estado de la API tratados como temporales
+TRANSIENT_CODES = {408, 429, 500, 502, 503, 504}
+TRANSIENT_STATUSES = {"RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL", "ABORTED", "DATA_LOSS"}
+QUOTA_CODES = {429}
+QUOTA_STATUSES = {"RESOURCE_EXHAUSTED"}
+
+
+# Reads a numeric status code from API / HTTP exceptions when present
+# Lee un código de estado numérico de excepciones de API / HTTP cuando existe
+def _error_code(exc: Exception):
+    for attr in ("code", "status_code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+# Reads the symbolic API status (e.g. RESOURCE_EXHAUSTED) when present
+# Lee el estado simbólico de la API (ej. RESOURCE_EXHAUSTED) cuando existe
+def _error_status(exc: Exception) -> str:
+    status = getattr(exc, "status", None)
+    if isinstance(status, str):
+        return status.upper()
+    text = str(exc).upper()
+    for name in TRANSIENT_STATUSES:
+        if name in text:
+            return name
+    return ""
+
+# True when the error means the API quota / rate limit is exhausted
+# Verdadero cuando el error indica que la cuota / límite de la API se agotó
+def is_quota_error(exc: Exception) -> bool:
+    return _error_code(exc) in QUOTA_CODES or _error_status(exc) in QUOTA_STATUSES
+
+# True when the error is worth retrying (rate limits, 5xx, network hiccups)
+# Verdadero cuando vale la pena reintentar el error (límites, 5xx, fallos de red)
+def is_transient_error(exc: Exception) -> bool:
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    return _error_code(exc) in TRANSIENT_CODES or _error_status(exc) in TRANSIENT_STATUSES
+
+
+class PollSchedule:
+    """
+    Polling interval that starts short and backs off geometrically.
+    Veo clips usually finish in tens of seconds, so early polls catch fast
+    jobs while later polls avoid spending calls on slow ones.
+    """
+
+    def __init__(self, initial: float = 3.0, factor: float = 1.5, maximum: float = 20.0):
+        if initial <= 0 or factor < 1 or maximum < initial:
+            raise ValueError("Invalid poll schedule")
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+
+    def first(self) -> float:
+        # Delay before the first status check of a new operation
+        # Espera antes de la primera consulta de estado de una operación nueva
+        return self.initial
+
+    def next(self, previous: float) -> float:
+        # Next delay, growing from the previous one up to the maximum
+        # Siguiente espera, creciendo desde la anterior hasta el máximo
+        return min(self.maximum, previous * self.factor)
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff ("full jitter") for transient API errors.
+    delay(n) is a random value in [0, min(cap, base * 2**n)].
+    """
+
+    def __init__(self, max_attempts: int = 4, base: float = 2.0, cap: float = 60.0, rng=None):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be >= 1")
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self._rng = rng or random.Random()
+
+    def should_retry(self, exc: Exception, attempt: int) -> bool:
+        # attempt counts failures so far for this request (1 = first failure)
+        # attempt cuenta los fallos hasta ahora para esta solicitud (1 = primer fallo)
+        return attempt < self.max_attempts and is_transient_error(exc)
+
+    def delay(self, attempt: int) -> float:
+        # Random wait so many clients don't retry in lockstep
+        # Espera aleatoria para que muchos clientes no reintenten al mismo tiempo
+        return self._rng.uniform(0, min(self.cap, self.base * (2 ** max(0, attempt - 1))))
+
+
+class CircuitBreaker:
+    """
+    Stops new submissions once the API reports quota exhaustion.
+
+    closed    -> requests flow normally
+    open      -> no requests until reset_seconds have passed
+    half-open -> one probe request; success closes, quota failure re-opens
+                 with a doubled cooldown (up to max_reset_seconds)
+    After give_up_seconds spent open, exhausted() is True and callers should
+    stop waiting and fall back. Thread-safe, so concurrent jobs can share one
+    breaker and back off together.
+    """
+
+    def __init__(self, failure_threshold: int = 2, reset_seconds: float = 60.0,
+                 max_reset_seconds: float = 600.0, give_up_seconds: float = 900.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.max_reset_seconds = max_reset_seconds
+        self.give_up_seconds = give_up_seconds
+        self._clock = clock
+        self._failures = 0
+        self._cooldown = reset_seconds
+        self._opened_at = None
+        self._first_opened_at = None
+        self._probing = False
+        self._lock = threading.RLock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._clock() - self._opened_at >= self._cooldown:
+                return "half-open"
+            return "open"
+
+    def allow_request(self) -> bool:
+        # Decide whether a new API request may be sent right now
+        # Decidir si se puede enviar una nueva solicitud a la API ahora
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def cancel_request(self):
+        # An allowed request was not sent after all: free the half-open probe for the next one
+        # Una solicitud permitida al final no se envió: liberar la prueba semiabierta para la siguiente
+        with self._lock:
+            self._probing = False
+
+    def retry_at(self):
+        # Monotonic time at which requests may flow again (None when closed)
+        # Tiempo monotónico en que las solicitudes pueden volver a fluir (None si está cerrado)
+        with self._lock:
+            if self._opened_at is None:
+                return None
+            return self._opened_at + self._cooldown
+
+    def exhausted(self) -> bool:
+        # True once we've waited on an open circuit longer than the budget
+        # Verdadero cuando esperamos con el circuito abierto más que el presupuesto
+        with self._lock:
+            if self._first_opened_at is None:
+                return False
+            return self._clock() - self._first_opened_at >= self.give_up_seconds
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._cooldown = self.reset_seconds
+            self._opened_at = None
+            self._first_opened_at = None
+            self._probing = False
+
+    def record_failure(self, exc: Exception):
+        # Only quota errors count toward opening the circuit
+        # Solo los errores de cuota cuentan para abrir el circuito
+        with self._lock:
+            if not is_quota_error(exc):
+                if self._probing:
+                    self._probing = False
+                return
+            now = self._clock()
+            if self._probing:
+                # Probe failed: re-open with a longer cooldown
+                # La prueba falló: reabrir con una espera más larga
+                self._probing = False
+                self._cooldown = min(self.max_reset_seconds, self._cooldown * 2)
+                self._opened_at = now
+                print(f"Quota still exhausted - pausing {self._cooldown:.0f}s/ Cuota aún agotada - pausando {self._cooldown:.0f}s")
+                return
+            self._failures += 1
+            if self._opened_at is None and self._failures >= self.failure_threshold:
+                self._opened_at = now
+                if self._first_opened_at is None:
+                    self._first_opened_at = now
+                print(f"Quota exhausted - pausing Veo requests {self._cooldown:.0f}s/ Cuota agotada - pausando solicitudes Veo {self._cooldown:.0f}s")
+
+
+class TokenBucket:
+    """
+    Rate limit shared by every job that submits Veo generations.
+    Holds up to `burst` tokens and refills at rate_per_minute; each
+    generate_videos call takes one token. Thread-safe.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int = 1, clock=time.monotonic):
+        if rate_per_minute <= 0 or burst < 1:
+            raise ValueError("Invalid token bucket")
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def try_take(self) -> float:
+        # Take one token; returns 0.0 on success or the seconds until one is available
+        # Tomar una ficha; devuelve 0.0 si lo logra o los segundos hasta que haya una
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
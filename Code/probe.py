@@ -0,0 +1,304 @@
+# probe.py
+# Samuel Angarita
+# English: Media metadata layer - one ffprobe call per file, cached by path, size and mtime
+# Español: Capa de metadatos de medios - una llamada a ffprobe por archivo, en caché por ruta, tamaño y mtime
+
+import json
+import os
+import subprocess
+import threading
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Optional
+
+from config import PROBE_CACHE_FILE
+
+# Maximum entries kept in the on-disk store (oldest are dropped first)
+# Máximo de entradas guardadas en disco (las más antiguas se eliminan primero)
+DISK_CACHE_MAX_ENTRIES = 5000
+# Bump when MediaInfo gains fields so stored entries without them are ignored
+# Incrementar cuando MediaInfo gane campos para ignorar entradas guardadas sin ellos
+KEY_VERSION = "2"
+
+
+@dataclass(frozen=True)
+class VideoStream:
+    codec: str
+    width: int
+    height: int
+    pix_fmt: str
+    sar: str
+    fps: str  # avg_frame_rate as reported by ffprobe, e.g. "30/1"
+    extradata: str = ""  # hash of the codec extradata (H.264 SPS/PPS), e.g. "CRC32:1a2b3c4d"
+
+
+@dataclass(frozen=True)
+class AudioStream:
+    codec: str
+    sample_rate: int
+    channels: int
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    path: str
+    duration: float
+    format_name: str
+    video: Optional[VideoStream]
+    audio: Optional[AudioStream]
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio is not None
+
+    def video_signature(self) -> tuple:
+        # Fields that must match for concat-demuxer stream copy
+        # Campos que deben coincidir para copia de stream con el demuxer concat
+        v = self.video
+        return (v.codec, v.width, v.height, v.pix_fmt, v.sar, v.fps) if v else ()
+
+    def audio_signature(self) -> tuple:
+        a = self.audio
+        return (a.codec, a.sample_rate, a.channels) if a else ()
+
+
+_lock = threading.Lock()
+_memory = {}        # cache key -> MediaInfo
+_disk = None        # cache key -> dict (loaded lazily)
+_pending = {}       # cache key -> dict probed since the last flush()
+_cache_file = PROBE_CACHE_FILE   # on-disk store, None = memory only
+
+
+# Builds the cache key; changes whenever the file is rewritten
+# Construye la clave de caché; cambia cada vez que el archivo se reescribe
+def _cache_key(path: Path) -> str:
+    st = path.stat()
+    return f"{KEY_VERSION}|{path.resolve()}|{st.st_size}|{st.st_mtime_ns}"
+
+# Converts a stored dict back into a MediaInfo
+# Convierte un diccionario guardado de vuelta en MediaInfo
+def _from_dict(d: dict) -> MediaInfo:
+    return MediaInfo(
+        path=d["path"],
+        duration=d["duration"],
+        format_name=d["format_name"],
+        video=VideoStream(**d["video"]) if d.get("video") else None,
+        audio=AudioStream(**d["audio"]) if d.get("audio") else None,
+    )
+
+# Parses `ffprobe -show_streams -show_format -of json` output
+# Analiza la salida de `ffprobe -show_streams -show_format -of json`
+def _parse(path: Path, data: dict) -> MediaInfo:
+    video = audio = None
+    for s in data.get("streams", []):
+        kind = s.get("codec_type")
+        if kind == "video" and video is None:
+            video = VideoStream(
+                codec=s.get("codec_name", ""),
+                width=int(s.get("width", 0)),
+                height=int(s.get("height", 0)),
+                pix_fmt=s.get("pix_fmt", ""),
+                sar=s.get("sample_aspect_ratio", ""),
+                fps=s.get("avg_frame_rate", ""),
+                extradata=s.get("extradata_hash", ""),
+            )
+        elif kind == "audio" and audio is None:
+            audio = AudioStream(
+                codec=s.get("codec_name", ""),
+                sample_rate=int(s.get("sample_rate", 0) or 0),
+                channels=int(s.get("channels", 0) or 0),
+            )
+    fmt = data.get("format", {})
+    try:
+        duration = float(fmt.get("duration", 0.0))
+    except (TypeError, ValueError):
+        duration = 0.0
+    return MediaInfo(str(path), duration, fmt.get("format_name", ""), video, audio)
+
+# Points the on-disk store at another file; None keeps probes in memory only (e.g. cold benchmark runs)
+# Apunta el almacén en disco a otro archivo; None guarda los probes solo en memoria (p. ej. benchmarks en frío)
+def set_cache_file(path):
+    """Flushes pending probes first; returns the previous store so callers can restore it."""
+    global _cache_file, _disk
+    flush()
+    with _lock:
+        previous = _cache_file
+        _cache_file = Path(path) if path else None
+        _disk = None
+        _pending.clear()
+    return previous
+
+# Loads the on-disk store once per process
+# Carga el almacén en disco una vez por proceso
+def _load_disk() -> dict:
+    global _disk
+    if _disk is None:
+        _disk = {}
+        if _cache_file and _cache_file.exists():
+            try:
+                _disk = json.loads(_cache_file.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                _disk = {}
+    return _disk
+
+# Writes the probes made since the last flush to the on-disk store (called once per pipeline stage)
+# Escribe en disco los probes hechos desde el último flush (se llama una vez por etapa del pipeline)
+def flush():
+    """
+    Re-reads the store first so entries written meanwhile by other batch /
+    service processes are kept, then writes it atomically under a temp
+    name unique to this process and thread.
+    """
+    global _disk
+    with _lock:
+        if not _cache_file or not _pending:
+            return
+        path = _cache_file
+        pending = dict(_pending)
+        _pending.clear()
+        try:
+            store = json.loads(path.read_text(encoding="utf-8")) if path.exists() else {}
+        except (OSError, ValueError):
+            store = {}
+        store.update(pending)
+        while len(store) > DISK_CACHE_MAX_ENTRIES:
+            del store[next(iter(store))]
+        _disk = store
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(store), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Probe cache write failed/ Fallo al escribir caché de ffprobe: {e}")
+
+
+# Returns metadata for a media file, running ffprobe at most once per file version
+# Devuelve metadatos de un archivo multimedia, ejecutando ffprobe como máximo una vez por versión
+def probe(path) -> MediaInfo:
+    """
+    Probe `path` with a single ffprobe call and return a MediaInfo.
+    Results are cached in memory and in PROBE_CACHE_FILE (when set, written
+    by flush(); see set_cache_file()), keyed by path, size and mtime.
+    Unreadable files yield a MediaInfo with no streams and are not cached.
+    """
+    path = Path(path)
+    try:
+        key = _cache_key(path)
+    except OSError:
+        return MediaInfo(str(path), 0.0, "", None, None)
+
+    with _lock:
+        info = _memory.get(key)
+        if info is not None:
+            return info
+        stored = _load_disk().get(key) if _cache_file else None
+        if stored is not None:
+            info = _from_dict(stored)
+            _memory[key] = info
+            return info
+
+    # Run ffprobe outside the lock so parallel workers don't serialize
+    # Ejecutar ffprobe fuera del bloqueo para no serializar trabajadores en paralelo
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-show_streams", "-show_format",
+        "-show_data_hash", "CRC32",
+        "-of", "json",
+        str(path),
+    ]
+    res = subprocess.run(cmd, capture_output=True, text=True)
+    try:
+        data = json.loads(res.stdout or "{}")
+    except ValueError:
+        data = {}
+    info = _parse(path, data)
+    if res.returncode != 0 or not data.get("streams"):
+        return info
+
+    with _lock:
+        _memory[key] = info
+        if _cache_file:
+            _load_disk()[key] = _pending[key] = asdict(info)
+    return info
+
+
+_keyframes = {}     # cache key -> keyframe times (memory only)
+
+
+# Returns the video keyframe times of a file in seconds, from a packet scan (no decode)
+# Devuelve los tiempos de los fotogramas clave de un archivo en segundos, leyendo paquetes (sin decodificar)
+def keyframes(path) -> list[float]:
+    """
+    Times are relative to the first video packet, sorted, and cached in
+    memory by path, size and mtime. Unreadable files yield [].
+    """
+    path = Path(path)
+    try:
+        key = _cache_key(path)
+    except OSError:
+        return []
+    with _lock:
+        if key in _keyframes:
+            return _keyframes[key]
+
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0",
+        str(path),
+    ]
+    res = subprocess.run(cmd, capture_output=True, text=True)
+    if res.returncode != 0:
+        return []
+    times, first = [], None
+    for line in res.stdout.splitlines():
+        pts, _, flags = line.partition(",")
+        try:
+            t = float(pts)
+        except ValueError:
+            continue
+        first = t if first is None else min(first, t)
+        if "K" in flags:
+            times.append(t)
+    times = sorted(t - first for t in times)
+
+    with _lock:
+        _keyframes[key] = times
+    return times
+
+
+# Quick container check before a downloaded clip is used: reads every packet, decodes nothing
+# Verificación rápida del contenedor antes de usar un clip descargado: lee cada paquete, no decodifica nada
+def quick_check(path) -> str:
+    """
+    Returns "" when `path` is a readable video with packets and a duration,
+    else a short reason (truncated or damaged files make the demuxer
+    complain on stderr). Not cached: meant for files that were just written.
+    """
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-count_packets", "-select_streams", "v:0",
+        "-show_entries", "stream=nb_read_packets:format=duration",
+        "-of", "json",
+        str(path),
+    ]
+    res = subprocess.run(cmd, capture_output=True, text=True)
+    errors = res.stderr.strip().splitlines()
+    if res.returncode != 0 or errors:
+        return errors[-1] if errors else "unreadable"
+    try:
+        data = json.loads(res.stdout or "{}")
+        packets = int((data.get("streams") or [{}])[0].get("nb_read_packets", 0))
+        duration = float(data.get("format", {}).get("duration", 0.0))
+    except (TypeError, ValueError):
+        return "unreadable"
+    if packets <= 0:
+        return "no video packets"
+    if duration <= 0:
+        return "no duration"
+    return ""
@@ -0,0 +1,116 @@
+# profiles.py
+# Samuel Angarita
+# English: Named encode profiles (draft / standard / archive) controlling canvas, x264 settings and audio bitrate, and the output rendition ladder
+# Español: Perfiles de codificación con nombre (draft / standard / archive) que controlan lienzo, ajustes x264 y bitrate de audio, y la escalera de resoluciones de salida
+
+import re
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class EncodeProfile:
+    """
+    Settings for every re-encode of a job (normalize, concat filter, single pass).
+    threads is the x264 thread count when the caller passes no per-worker
+    budget (0 lets ffmpeg decide); tune = None leaves x264 untuned.
+    """
+    name: str
+    width: int
+    height: int
+    fps: int
+    preset: str
+    crf: int
+    tune: Optional[str] = None
+    threads: int = 0
+    audio_bitrate: str = "192k"
+
+    def video_args(self, threads: int = 0) -> list[str]:
+        # x264 arguments; `threads` (when set) is the caller's share of the CPU, else the profile's count
+        # Argumentos x264; `threads` (si se indica) es la parte de la CPU del llamador, si no la del perfil
+        args = ["-c:v", "libx264", "-preset", self.preset, "-crf", str(self.crf)]
+        if self.tune:
+            args += ["-tune", self.tune]
+        threads = threads or self.threads
+        if threads:
+            args += ["-threads", str(threads)]
+        return args
+
+    def canvas_filter(self, width: int = None, height: int = None, fps=None) -> str:
+        # Letterbox into the profile canvas (or the given one) at constant frame rate
+        # Encajar en el lienzo del perfil (o el indicado) con frecuencia de cuadros constante
+        width, height, fps = width or self.width, height or self.height, fps or self.fps
+        return (
+            f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color=black,"
+            f"setsar=1,fps={fps},format=yuv420p"
+        )
+
+    def fingerprint(self) -> dict:
+        return asdict(self)
+
+
+PROFILES = {
+    # Seconds-fast preview for reviewing a listing
+    # Vista previa en segundos para revisar un anuncio
+    "draft": EncodeProfile("draft", 854, 480, 24, "ultrafast", 30, tune="fastdecode", audio_bitrate="96k"),
+    # Default delivery quality (the original 1080p30 settings)
+    # Calidad de entrega por defecto (los ajustes 1080p30 originales)
+    "standard": EncodeProfile("standard", 1920, 1080, 30, "medium", 20, audio_bitrate="192k"),
+    # Slow, high-quality master
+    # Máster lento de alta calidad
+    "archive": EncodeProfile("archive", 1920, 1080, 30, "slow", 16, tune="film", audio_bitrate="320k"),
+}
+
+
+def get_profile(name: str) -> EncodeProfile:
+    # Look up a profile by name; unknown names stop the job like unknown transitions
+    # Buscar un perfil por nombre; nombres desconocidos detienen el trabajo como transiciones desconocidas
+    profile = PROFILES.get(str(name).lower())
+    if profile is None:
+        raise SystemExit(f"Error: unknown profile '{name}'. Allowed: {', '.join(PROFILES)}")
+    return profile
+
+
+@dataclass(frozen=True)
+class Rendition:
+    """
+    One rung of the output ladder: the height (width follows the source's
+    display aspect ratio) and the peak video bitrate, e.g. Rendition(720, "2800k").
+    """
+    height: int
+    maxrate: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.height}p"
+
+    def width_for(self, aspect: float) -> int:
+        # Keep the source display aspect ratio, rounded to an even width for yuv420p
+        # Mantener la relación de aspecto de la fuente, redondeada a un ancho par para yuv420p
+        return round(self.height * aspect / 2) * 2
+
+    def video_args(self, profile: EncodeProfile, threads: int = 0) -> list[str]:
+        # The profile's x264 settings, capped at maxrate (VBV buffer of two seconds)
+        # Los ajustes x264 del perfil, limitados a maxrate (buffer VBV de dos segundos)
+        bufsize = f"{2 * bits_per_second(self.maxrate) // 1000}k"
+        return [*profile.video_args(threads), "-maxrate", self.maxrate, "-bufsize", bufsize]
+
+
+def bits_per_second(rate: str) -> int:
+    # ffmpeg-style bitrate ("192k", "5M", "800000") as an integer
+    # Bitrate al estilo ffmpeg ("192k", "5M", "800000") como entero
+    number, unit = re.fullmatch(r"(\d+)([km]?)", str(rate).lower()).groups()
+    return int(number) * {"": 1, "k": 1000, "m": 1000 * 1000}[unit]
+
+
+def parse_ladder(spec: str) -> list[Rendition]:
+    # "1080:5000k,720:2800k,480:1400k" -> renditions, tallest first; bad specs stop the job
+    # "1080:5000k,720:2800k,480:1400k" -> resoluciones, la más alta primero; especificaciones inválidas detienen el trabajo
+    ladder = []
+    for rung in filter(None, (r.strip() for r in str(spec).split(","))):
+        m = re.fullmatch(r"([1-9]\d*)[pP]?:(\d+[kKmM]?)", rung)
+        if m is None or int(m.group(1)) % 2:
+            raise SystemExit(f"Error: invalid rendition '{rung}'. Expected <even height>:<maxrate>, e.g. 720:2800k")
+        ladder.append(Rendition(int(m.group(1)), m.group(2).lower()))
+    return sorted({r.height: r for r in ladder}.values(), key=lambda r: r.height, reverse=True)
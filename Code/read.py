@@ -3,58 +3,176 @@
 # English: Asset download module for images and music files with validation and error handling
 # Español: Módulo de descarga de assets para archivos de imágenes y música con validación y manejo de errores
 
-from io import BytesIO
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-import requests
-from PIL import Image
 
-from config import workdir                                                   
+from config import (HTTP_POOL_SIZE, IMAGE_JOBS, IMAGE_TARGET_W, IMAGE_TARGET_H, JobContext,
+                    default_context)
+from clip_cache import AssetCache, default_asset_cache, link_or_copy
 
 # User agent string for HTTP requests to identify our application
 # Cadena de agente de usuario para solicitudes HTTP para identificar nuestra aplicación
 USER_AGENT = "ai-video-creator/1.0"
 
-# Helper function to perform HTTP GET requests with error handling and custom user agent
-# Función auxiliar para realizar solicitudes HTTP GET con manejo de errores y agente de usuario personalizado
-def _http_get(url: str, timeout=30) -> bytes:
-    # Generic HTTP GET function with error handling and user agent
-    # Función genérica HTTP GET con manejo de errores y agente de usuario
-    resp = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=timeout)
-    resp.raise_for_status()
-    return resp.content
+_session = None
+_session_lock = threading.Lock()
 
-# Downloads and validates an image from URL, converts to JPEG format and saves to work directory
-# Descarga y valida una imagen desde URL, convierte a formato JPEG y guarda en directorio de trabajo
-def download_image(url: str, index: int) -> Path:
-    """Download an image and verify it. Saved as downloaded_image{index}.jpg in workdir."""
-    # Download and validate image from URL, convert to JPEG format
-    # Descargar y validar imagen desde URL, convertir a formato JPEG
-    data = _http_get(url, timeout=60)
-    img = Image.open(BytesIO(data))
-    # Ensure image is RGB for JPEG compatibility
-    # Asegurar que la imagen sea RGB para compatibilidad JPEG
-    img = img.convert("RGB")  # ensure jpg-compatible
-    out = workdir / f"downloaded_image{index}.jpg"                            
+
+# Shared session so every download reuses pooled TCP/TLS connections
+# Sesión compartida para que cada descarga reutilice conexiones TCP/TLS del pool
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            # Imported here so image-decoding workers and combine-only runs never load requests
+            # Importado aquí para que los procesos de imágenes y las ejecuciones solo de combinación no carguen requests
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.headers["User-Agent"] = USER_AGENT
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+# Downloads url (or revalidates it against the asset cache) without copying it anywhere yet
+# Descarga url (o la revalida contra la caché de assets) sin copiarla a ningún lugar todavía
+def _download(url: str, tmp: Path, timeout=60, ctx: JobContext = None, cache: AssetCache = None) -> tuple[Path, bool]:
+    """
+    Conditional GET (If-None-Match / If-Modified-Since) when the URL is cached:
+    a 304 costs no body bytes. New content is streamed to disk and stored by
+    its SHA-256. Returns (path, temporary): the cache entry, or tmp itself when
+    caching is off or the cache write failed (the caller moves or deletes it).
+    """
+    ctx = ctx or default_context()
+    cache = cache if cache is not None else default_asset_cache(ctx.cache_root)
+    record, entry = cache.lookup(url) if cache is not None else (None, None)
+    headers = {}
+    if entry is not None:
+        if record.get("etag"):
+            headers["If-None-Match"] = record["etag"]
+        if record.get("last_modified"):
+            headers["If-Modified-Since"] = record["last_modified"]
+
+    part = cache.temp_path() if cache is not None else tmp
+    with _get_session().get(url, headers=headers, stream=True, timeout=timeout) as resp:
+        if resp.status_code == 304 and entry is not None:
+            print(f"Asset unchanged - using cache/ Asset sin cambios - usando caché: {url}")
+            return entry, False
+        resp.raise_for_status()
+        # Stream to disk in chunks, hashing as we go
+        # Descargar a disco por fragmentos, calculando el hash al mismo tiempo
+        digest = hashlib.sha256()
+        try:
+            with open(part, "wb") as f:
+                for chunk in resp.iter_content(chunk_size=1024 * 256):
+                    if chunk:
+                        f.write(chunk)
+                        digest.update(chunk)
+                        ctx.metrics.add_bytes(len(chunk))
+        except BaseException:
+            part.unlink(missing_ok=True)
+            raise
+        etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+
+    if cache is None:
+        return part, True
+    try:
+        return cache.store(url, part, digest.hexdigest(), etag, last_modified), False
+    except OSError as e:
+        print(f"Asset cache write failed/ Fallo al escribir caché de assets: {e}")
+        os.replace(part, tmp)
+        return tmp, True
+
+# Places the content of url at dst, from the asset cache when the server says it is unchanged
+# Coloca el contenido de url en dst, desde la caché de assets cuando el servidor indica que no cambió
+def _fetch(url: str, dst: Path, timeout=60, ctx: JobContext = None, cache: AssetCache = None) -> Path:
+    """Downloads url (see _download) and hardlinks (or copies) the cache entry to dst."""
+    tmp = dst.with_name(f".{dst.name}.{threading.get_ident()}.tmp")
+    src, temporary = _download(url, tmp, timeout, ctx, cache)
+    if temporary:
+        os.replace(src, dst)
+    else:
+        link_or_copy(src, dst)
+    return dst
+
+# Decodes a downloaded image and writes the RGB JPEG the engines consume (runs in a worker process)
+# Decodifica una imagen descargada y escribe el JPEG RGB que consumen los motores (corre en un proceso aparte)
+def prepare_image(source: str, out: str, width: int = IMAGE_TARGET_W, height: int = IMAGE_TARGET_H) -> str:
+    """
+    Applies the EXIF orientation and shrinks the image (never enlarges it)
+    until it just covers width x height. For JPEGs, draft mode lets libjpeg
+    decode at 1/2, 1/4 or 1/8 scale, so a huge photo never sits fully
+    decoded in memory.
+    """
+    from PIL import Image, ImageOps
+    with Image.open(source) as img:
+        # Rotated photos are stored sideways: ask draft for the size before rotation
+        # Las fotos rotadas se guardan de lado: pedir a draft el tamaño antes de rotar
+        sideways = img.getexif().get(0x0112) in (5, 6, 7, 8)
+        img.draft("RGB", (height, width) if sideways else (width, height))
+        img = ImageOps.exif_transpose(img)
+        # Ensure image is RGB for JPEG compatibility
+        # Asegurar que la imagen sea RGB para compatibilidad JPEG
+        img = img.convert("RGB")  # ensure jpg-compatible
+    scale = max(width / img.width, height / img.height)
+    if scale < 1:
+        size = (max(width, round(img.width * scale)), max(height, round(img.height * scale)))
+        img = img.resize(size, Image.LANCZOS)
     # Save with high quality JPEG compression
     # Guardar con compresión JPEG de alta calidad
     img.save(out, format="JPEG", quality=92)
+    return out
+
+# Worker processes for prepare_image; a no-op context when one image or IMAGE_JOBS=1
+# Procesos para prepare_image; un contexto vacío con una sola imagen o IMAGE_JOBS=1
+def image_decoder(count: int):
+    workers = min(IMAGE_JOBS, count)
+    if workers <= 1:
+        return nullcontext(None)
+    # spawn: forking a process that already runs download threads is unsafe
+    # spawn: hacer fork de un proceso que ya ejecuta hilos de descarga no es seguro
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+# Downloads and validates an image from URL, converts to JPEG format and saves to work directory
+# Descarga y valida una imagen desde URL, convierte a formato JPEG y guarda en directorio de trabajo
+def download_image(url: str, index: int, ctx: JobContext = None, decoder: ProcessPoolExecutor = None) -> Path:
+    """
+    Download an image and verify it. Saved as downloaded_image{index}.jpg in the job workdir.
+    The download is streamed to disk; decoding runs in `decoder` (see image_decoder) when given.
+    """
+    ctx = ctx or default_context()
+    with ctx.metrics.item("download", index):
+        # Download (or revalidate) the original file and convert it to JPEG straight from the cache entry
+        # Descargar (o revalidar) el archivo original y convertirlo a JPEG directamente desde la caché
+        source, temporary = _download(url, ctx.source_image(index), timeout=60, ctx=ctx)
+        out = ctx.image(index)
+        out.unlink(missing_ok=True)
+        try:
+            if decoder is None:
+                prepare_image(str(source), str(out))
+            else:
+                decoder.submit(prepare_image, str(source), str(out)).result()
+        finally:
+            # Without the cache the original is only needed for the conversion
+            # Sin la caché el original solo se necesita para la conversión
+            if temporary:
+                source.unlink(missing_ok=True)
     print(f"Image saved/ Imagen guardada: {out}")
     return out
 
 # Downloads music or video file from URL using streaming for large files and saves to work directory
 # Descarga archivo de música o video desde URL usando streaming para archivos grandes y guarda en directorio de trabajo
-def download_song(url: str) -> Path:
-    """Download music/video file to workdir as downloaded_music.mp4 (streamed)."""
-    # Download music/video file using streaming for large files
-    # Descargar archivo de música/video usando streaming para archivos grandes
-    out = workdir / "downloaded_music.mp4"                                   
-    with requests.get(url, stream=True, headers={"User-Agent": USER_AGENT}, timeout=60) as r:
-        r.raise_for_status()
-        # Stream download in chunks to handle large files efficiently
-        # Descarga por streaming en fragmentos para manejar archivos grandes eficientemente
-        with open(out, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024 * 256):
-                if chunk:
-                    f.write(chunk)
+def download_song(url: str, ctx: JobContext = None) -> Path:
+    """Download music/video file to the job workdir as downloaded_music.mp4 (streamed, cached)."""
+    ctx = ctx or default_context()
+    with ctx.metrics.item("download", "music"):
+        out = _fetch(url, ctx.music, timeout=60, ctx=ctx)
     print(f"Music saved/ Música guardada: {out}")
-    return out
\ No newline at end of file
+    return out
@@ -0,0 +1,219 @@
+# service.py
+# Samuel Angarita
+# English: Local HTTP job service - queues render requests and schedules them around Veo quota and CPU slots
+# Español: Servicio HTTP local de trabajos - encola solicitudes de render y las planifica según la cuota Veo y la CPU
+
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from config import (workdir, JobContext, MOTION_ENGINES, SERVICE_HOST, SERVICE_PORT, SERVICE_MAX_JOBS,
+                    SERVICE_KEEP_FINISHED, VEO_CALLS_PER_MINUTE, BATCH_MAX_API_CALLS, BATCH_MAX_ENCODES)
+from policy import CircuitBreaker, TokenBucket
+from prompt import get_prompt
+from profiles import PROFILES
+from main import main as run_job
+
+# Per-job work directories for service requests
+# Directorios de trabajo por trabajo para solicitudes del servicio
+SERVICE_ROOT = workdir / "service"
+
+# Rough progress per stage, used for the "progress" field
+# Progreso aproximado por etapa, usado para el campo "progress"
+STAGE_PROGRESS = {"queued": 0.0, "download": 0.05, "generate": 0.15, "music": 0.6, "render": 0.8,
+                  "normalize": 0.7, "concat": 0.8, "mux": 0.85, "ladder": 0.9, "done": 1.0}
+
+
+# Checks a job spec has the same shape as input.json
+# Verifica que una especificación de trabajo tenga la misma forma que input.json
+def validate_spec(spec) -> str:
+    """Return an error message, or "" when the spec is usable."""
+    if not isinstance(spec, dict):
+        return "Body must be a JSON object"
+    music = spec.get("music")
+    if not isinstance(music, dict) or "url" not in music or "enabled" not in music:
+        return "'music' must have 'url' and 'enabled'"
+    if "profile" in spec and str(spec["profile"]).lower() not in PROFILES:
+        return f"'profile' must be one of {', '.join(PROFILES)}"
+    if "crossfade" in spec and (not isinstance(spec["crossfade"], (int, float)) or spec["crossfade"] < 0):
+        return "'crossfade' must be a number of seconds >= 0"
+    images = spec.get("images")
+    if not isinstance(images, list) or not images:
+        return "'images' must be a non-empty list"
+    for i, img in enumerate(images, start=1):
+        if not isinstance(img, dict) or "url" not in img or "transition" not in img:
+            return f"image {i} must have 'url' and 'transition'"
+        try:
+            get_prompt(img["transition"])
+        except SystemExit as e:
+            return str(e)
+        if img.get("engine", "veo") not in MOTION_ENGINES:
+            return f"image {i}: 'engine' must be one of {', '.join(MOTION_ENGINES)}"
+    return ""
+
+
+class JobScheduler:
+    """
+    Runs queued jobs on a worker pool. All jobs share:
+      - a token bucket on generate_videos calls (VEO_CALLS_PER_MINUTE)
+      - a cap on Veo operations in flight (BATCH_MAX_API_CALLS)
+      - a cap on CPU-heavy ffmpeg encodes (BATCH_MAX_ENCODES)
+      - a circuit breaker, so quota exhaustion pauses every job at once
+    so one job can encode while another is waiting on the API. Only the
+    newest keep_finished finished jobs stay in the status table.
+    """
+
+    def __init__(self, root: Path = SERVICE_ROOT, max_jobs: int = SERVICE_MAX_JOBS,
+                 calls_per_minute: float = VEO_CALLS_PER_MINUTE,
+                 max_api_calls: int = BATCH_MAX_API_CALLS, max_encodes: int = BATCH_MAX_ENCODES,
+                 keep_finished: int = SERVICE_KEEP_FINISHED):
+        self.root = Path(root)
+        self.keep_finished = keep_finished
+        self.api_rate = TokenBucket(calls_per_minute, burst=max_api_calls)
+        self.breaker = CircuitBreaker()
+        self.api_slots = threading.BoundedSemaphore(max_api_calls)
+        self.encode_slots = threading.BoundedSemaphore(max_encodes)
+        self._pool = ThreadPoolExecutor(max_workers=max_jobs)
+        self._lock = threading.Lock()
+        self.jobs = {}  # id -> status dict
+        self._contexts = {}  # id -> JobContext (for live encode progress)
+
+    def submit(self, spec: dict) -> dict:
+        # Write the spec into a fresh job workdir and queue it
+        # Escribir la especificación en un directorio nuevo y encolarla
+        job_id = uuid.uuid4().hex[:12]
+        ctx = JobContext(self.root / job_id, name=job_id, api_slots=self.api_slots,
+                         encode_slots=self.encode_slots, api_rate=self.api_rate, breaker=self.breaker,
+                         on_stage=lambda stage: self._update(job_id, stage=stage)).ensure()
+        ctx.input_json.write_text(json.dumps(spec, indent=2), encoding="utf-8")
+        with self._lock:
+            self._contexts[job_id] = ctx
+            self.jobs[job_id] = {"id": job_id, "status": "queued", "stage": "queued", "progress": 0.0,
+                                 "submitted": time.time(), "error": None, "result": None}
+        self._pool.submit(self._run, job_id, ctx)
+        return self.status(job_id)
+
+    def status(self, job_id: str):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if not job:
+                return None
+            job = dict(job)
+            ctx = self._contexts[job_id]
+        # Current ffmpeg fps / speed per running encode, from the -progress feed
+        # fps / velocidad actuales de cada codificación en curso, desde el flujo -progress
+        job["encoding"] = ctx.metrics.live_progress()
+        return job
+
+    def list(self) -> list:
+        with self._lock:
+            return [dict(j) for j in self.jobs.values()]
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            job = self.jobs[job_id]
+            job.update(fields)
+            if "stage" in fields:
+                job["progress"] = max(job["progress"], STAGE_PROGRESS.get(fields["stage"], job["progress"]))
+
+    def _run(self, job_id: str, ctx: JobContext):
+        self._update(job_id, status="running", started=time.time())
+        try:
+            final = run_job(ctx)
+            self._update(job_id, status="done", result=str(final), finished=time.time())
+        except (Exception, SystemExit) as e:
+            print(f"Job failed/ Trabajo falló [{job_id}]: {e}")
+            self._update(job_id, status="failed", error=str(e), finished=time.time())
+        self._forget_finished()
+
+    def _forget_finished(self):
+        # Drop the oldest finished jobs beyond keep_finished so a long-running server doesn't grow forever
+        # Olvidar los trabajos terminados más viejos por encima de keep_finished para que el servidor no crezca sin fin
+        with self._lock:
+            finished = sorted((j["finished"], job_id) for job_id, j in self.jobs.items()
+                              if j["status"] in ("done", "failed"))
+            for _, job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+                del self.jobs[job_id]
+                del self._contexts[job_id]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+# HTTP front end: POST /jobs, GET /jobs, GET /jobs/<id>, GET /jobs/<id>/result
+# Interfaz HTTP: POST /jobs, GET /jobs, GET /jobs/<id>, GET /jobs/<id>/result
+class JobHandler(BaseHTTPRequestHandler):
+    scheduler: JobScheduler = None
+
+    def _send_json(self, code: int, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send_json(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+            spec = json.loads(self.rfile.read(length) or b"null")
+        except ValueError:
+            return self._send_json(400, {"error": "invalid JSON"})
+        error = validate_spec(spec)
+        if error:
+            return self._send_json(400, {"error": error})
+        self._send_json(202, self.scheduler.submit(spec))
+
+    def do_GET(self):
+        parts = [p for p in self.path.split("?")[0].split("/") if p]
+        if parts == ["jobs"]:
+            return self._send_json(200, self.scheduler.list())
+        if len(parts) < 2 or parts[0] != "jobs":
+            return self._send_json(404, {"error": "not found"})
+        job = self.scheduler.status(parts[1])
+        if job is None:
+            return self._send_json(404, {"error": "unknown job"})
+        if len(parts) == 2:
+            return self._send_json(200, job)
+        if parts[2:] == ["result"]:
+            if job["status"] != "done":
+                return self._send_json(409, {"error": f"job is {job['status']}"})
+            return self._send_file(Path(job["result"]))
+        self._send_json(404, {"error": "not found"})
+
+    def _send_file(self, path: Path):
+        # Stream Final.mp4 back in chunks
+        # Enviar Final.mp4 de vuelta por fragmentos
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(path.stat().st_size))
+        self.send_header("Content-Disposition", f'attachment; filename="{path.name}"')
+        self.end_headers()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 256), b""):
+                self.wfile.write(chunk)
+
+
+# Starts the service and blocks until interrupted
+# Inicia el servicio y bloquea hasta ser interrumpido
+def serve(host: str = SERVICE_HOST, port: int = SERVICE_PORT):
+    JobHandler.scheduler = JobScheduler()
+    server = ThreadingHTTPServer((host, port), JobHandler)
+    print(f"Job service listening/ Servicio de trabajos escuchando: http://{host}:{port}/jobs")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        JobHandler.scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    serve()
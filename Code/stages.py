@@ -0,0 +1,131 @@
+# stages.py
+# Samuel Angarita
+# English: Stage manifest for a resumable pipeline - reruns only the stages whose inputs changed
+# Español: Manifiesto de etapas para un pipeline reanudable - re-ejecuta solo las etapas cuyas entradas cambiaron
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+
+# Raised by a stage that produced usable but incomplete outputs (e.g. dummy clips)
+# Lanzada por una etapa que produjo salidas utilizables pero incompletas (ej. clips ficticios)
+class StageIncomplete(Exception):
+    def __init__(self, outputs, reason: str = ""):
+        super().__init__(reason)
+        self.outputs = outputs
+
+
+class Manifest:
+    """
+    JSON manifest stored in the work directory:
+      {"stages": {name: {"inputs": <fingerprint>, "outputs": {path: sha256}}},
+       "files":  {"path|size|mtime_ns": sha256}}
+    A stage is fresh when its input fingerprint matches the recorded one and
+    every recorded output still exists with the same content hash.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.data = {"stages": {}, "files": {}}
+        if self.path.exists():
+            try:
+                self.data = json.loads(self.path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                print("Manifest unreadable - starting fresh/ Manifiesto ilegible - empezando de nuevo")
+        self.data.setdefault("stages", {})
+        self.data.setdefault("files", {})
+
+    def file_hash(self, path: Path) -> str:
+        # Content hash, memoized by size + mtime so unchanged files are not re-read
+        # Hash de contenido, memorizado por tamaño + mtime para no releer archivos sin cambios
+        path = Path(path)
+        st = path.stat()
+        memo_key = f"{path.resolve()}|{st.st_size}|{st.st_mtime_ns}"
+        digest = self.data["files"].get(memo_key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            self.data["files"][memo_key] = digest
+        return digest
+
+    def fingerprint(self, inputs) -> str:
+        # Hash JSON-able inputs; Path values are replaced by their content hash
+        # Hash de entradas serializables; los valores Path se reemplazan por su hash de contenido
+        def _norm(v):
+            if isinstance(v, Path):
+                return {"file": str(v), "sha256": self.file_hash(v) if v.exists() else None}
+            if isinstance(v, dict):
+                return {str(k): _norm(x) for k, x in v.items()}
+            if isinstance(v, (list, tuple)):
+                return [_norm(x) for x in v]
+            return v
+        blob = json.dumps(_norm(inputs), sort_keys=True)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def is_fresh(self, stage: str, fingerprint: str) -> bool:
+        rec = self.data["stages"].get(stage)
+        if not rec or rec.get("inputs") != fingerprint:
+            return False
+        for out, digest in rec.get("outputs", {}).items():
+            p = Path(out)
+            if not p.exists() or self.file_hash(p) != digest:
+                return False
+        return True
+
+    def outputs(self, stage: str) -> list[Path]:
+        rec = self.data["stages"].get(stage, {})
+        return [Path(p) for p in rec.get("outputs", {})]
+
+    def record(self, stage: str, fingerprint: str, outputs: list[Path]):
+        self.data["stages"][stage] = {
+            "inputs": fingerprint,
+            "outputs": {str(p): self.file_hash(p) for p in outputs},
+        }
+        self.save()
+
+    def invalidate(self, stage: str):
+        if self.data["stages"].pop(stage, None) is not None:
+            self.save()
+
+    def save(self):
+        # Drop memo entries for files that no longer exist, then write atomically
+        # Eliminar memos de archivos que ya no existen y escribir de forma atómica
+        live = {}
+        for key, digest in self.data["files"].items():
+            if Path(key.split("|", 1)[0]).exists():
+                live[key] = digest
+        self.data["files"] = live
+        # Unique temp name: concurrent batch / service processes never share a partial file
+        # Nombre temporal único: procesos concurrentes de lote / servicio nunca comparten un archivo parcial
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(self.data, indent=2), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+# Runs `fn` unless the manifest says the stage is already up to date for these inputs
+# Ejecuta `fn` a menos que el manifiesto indique que la etapa ya está al día para estas entradas
+def run_stage(manifest: Manifest, name: str, inputs, fn) -> list[Path]:
+    """
+    fn() returns the list of output paths. It may raise StageIncomplete to
+    hand back outputs without recording the stage, so the next run retries it.
+    """
+    fingerprint = manifest.fingerprint(inputs)
+    if manifest.is_fresh(name, fingerprint):
+        print(f"Stage '{name}' up to date - skipping/ Etapa '{name}' al día - omitiendo")
+        return manifest.outputs(name)
+
+    print(f"Running stage '{name}'/ Ejecutando etapa '{name}'")
+    manifest.invalidate(name)
+    try:
+        outputs = [Path(p) for p in fn()]
+    except StageIncomplete as e:
+        print(f"Stage '{name}' incomplete - will rerun next time/ Etapa '{name}' incompleta - se re-ejecutará: {e}")
+        return [Path(p) for p in e.outputs]
+    manifest.record(name, fingerprint, outputs)
+    return outputs
@@ -0,0 +1,178 @@
+# veo_backend.py
+# Samuel Angarita
+# English: Pluggable Veo backends - the Google GenAI client and a configurable local stand-in for offline runs
+# Español: Backends Veo intercambiables - el cliente Google GenAI y un sustituto local configurable para ejecuciones sin conexión
+
+import hashlib
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from types import SimpleNamespace
+
+from config import FAKE_VEO_LATENCY, FAKE_VEO_FAILURE_RATE, FAKE_VEO_CLIP_SECONDS
+
+
+class VeoBackend(ABC):
+    """
+    The calls generate_all needs from a Veo provider:
+      submit(prompt, model, config) -> operation (.done, .error, .response)
+      refresh(operation)            -> the same operation with fresh status
+      download(video)               -> clip bytes for response.generated_videos[i].video
+      stream(video)                 -> (chunks, size, sha256): the clip as an iterable of
+                                       byte chunks plus its expected size / SHA-256 hex
+                                       when the provider knows them (else None)
+    Subclasses must implement submit, refresh and download; stream is optional.
+    """
+
+    @abstractmethod
+    def submit(self, prompt: str, model: str, config: dict):
+        ...
+
+    @abstractmethod
+    def refresh(self, operation):
+        ...
+
+    @abstractmethod
+    def download(self, video) -> bytes:
+        ...
+
+    def stream(self, video):
+        # Default for providers that only hand back whole files: one chunk, nothing to verify against
+        # Por defecto para proveedores que solo entregan archivos completos: un fragmento, nada que verificar
+        return iter((self.download(video),)), None, None
+
+
+class GenaiBackend(VeoBackend):
+    """
+    Google GenAI client (the production backend). With api_key, clips that
+    come back as a URI are streamed over HTTP instead of loaded whole.
+    """
+
+    def __init__(self, client, api_key: str = None):
+        self.client = client
+        self.api_key = api_key
+
+    def submit(self, prompt: str, model: str, config: dict):
+        from google.genai import types
+        # Submit the request without waiting for the result
+        # Enviar la solicitud sin esperar el resultado
+        return self.client.models.generate_videos(
+            model=model,
+            prompt=prompt,
+            config=types.GenerateVideosConfig(**config),
+        )
+
+    def refresh(self, operation):
+        return self.client.operations.get(operation)
+
+    def download(self, video) -> bytes:
+        return self.client.files.download(file=video)
+
+    def stream(self, video):
+        uri = getattr(video, "uri", None)
+        if getattr(video, "video_bytes", None) or not uri or not self.api_key:
+            return super().stream(video)
+        import requests
+        resp = requests.get(uri, headers={"x-goog-api-key": self.api_key}, stream=True, timeout=120)
+        resp.raise_for_status()
+        # Content-Length is the body size only when the transfer isn't compressed
+        # Content-Length es el tamaño del cuerpo solo si la transferencia no está comprimida
+        length = resp.headers.get("Content-Length", "")
+        size = int(length) if length.isdigit() and not resp.headers.get("Content-Encoding") else None
+
+        def chunks():
+            with resp:
+                yield from resp.iter_content(chunk_size=1024 * 1024)
+        return chunks(), size, None
+
+
+class FakeVeoBackend(VeoBackend):
+    """
+    Local stand-in for load tests and profiling without an API key.
+    Each operation finishes after `latency` seconds (+/- jitter), fails with
+    a transient UNAVAILABLE error with probability failure_rate, and returns
+    clip_path (or a generated 1280x720 test pattern of clip_seconds).
+    Safe to share between jobs; submitted / failed count the calls made.
+    """
+
+    def __init__(self, latency: float = FAKE_VEO_LATENCY, failure_rate: float = FAKE_VEO_FAILURE_RATE,
+                 clip_path: Path = None, clip_seconds: float = FAKE_VEO_CLIP_SECONDS, jitter: float = 0.25,
+                 seed: int = None, clock=time.monotonic):
+        if latency < 0 or not 0 <= failure_rate <= 1 or not 0 <= jitter < 1:
+            raise ValueError("Invalid fake Veo settings")
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.clip_path = Path(clip_path) if clip_path else None
+        self.clip_seconds = clip_seconds
+        self.jitter = jitter
+        self.submitted = 0
+        self.failed = 0
+        self._rng = random.Random(seed)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tmp = None
+        self._rendered = None
+
+    def submit(self, prompt: str, model: str, config: dict):
+        with self._lock:
+            self.submitted += 1
+            name = f"fake-{self.submitted}"
+            delay = self.latency * self._rng.uniform(1 - self.jitter, 1 + self.jitter)
+            fails = self._rng.random() < self.failure_rate
+        return SimpleNamespace(name=name, done=False, error=None, response=None,
+                               ready_at=self._clock() + delay, fails=fails)
+
+    def refresh(self, operation):
+        if operation.done or self._clock() < operation.ready_at:
+            return operation
+        operation.done = True
+        if operation.fails:
+            with self._lock:
+                self.failed += 1
+            operation.error = {"code": 14, "status": "UNAVAILABLE", "message": "fake transient failure"}
+        else:
+            operation.response = SimpleNamespace(generated_videos=[SimpleNamespace(video=self._clip())])
+        return operation
+
+    def download(self, video) -> bytes:
+        return Path(video).read_bytes()
+
+    def stream(self, video):
+        path = Path(video)
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+
+        def chunks():
+            with open(path, "rb") as f:
+                yield from iter(lambda: f.read(1024 * 1024), b"")
+        return chunks(), path.stat().st_size, digest.hexdigest()
+
+    def _clip(self) -> Path:
+        # Render the test-pattern clip once and hand the same file to every operation
+        # Renderizar el clip de patrón de prueba una vez y entregar el mismo archivo a cada operación
+        if self.clip_path is not None:
+            return self.clip_path
+        with self._lock:
+            if self._rendered is None:
+                self._tmp = tempfile.TemporaryDirectory(prefix="fake_veo_")
+                out = Path(self._tmp.name) / "clip.mp4"
+                cmd = [
+                    "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+                    "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=24:duration={self.clip_seconds}",
+                    "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={self.clip_seconds}",
+                    "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+                    "-c:a", "aac", "-ac", "2", "-shortest", str(out),
+                ]
+                try:
+                    subprocess.run(cmd, check=True, capture_output=True, text=True)
+                except subprocess.CalledProcessError as e:
+                    self._tmp.cleanup()
+                    raise RuntimeError(f"Fake Veo clip render failed: {(e.stderr or '').strip()[-200:]}") from e
+                self._rendered = out
+            return self._rendered